@@ -115,6 +115,55 @@ class NoiseModelFN:
 
         return np.stack(marker_visibility, axis=0)
 
+    def transition_matrix(self):
+        return np.array([self.transition_probs[s] for s in self.states])
+
+    # Simulates N independent chains in parallel, equivalent in distribution to N calls of rollout(T).
+    # States are kept as indices into self.states, hidden markers as a boolean [N x 4] array.
+    # rng can be a np.random.Generator or np.random.RandomState, by default the global numpy state is used.
+    # Returns a boolean [N x T x 4] array, True where the marker is visible.
+    def rollout_batch(self, N, T, rng=None, initial_state=None):
+        if rng is None:
+            rng = np.random
+        if initial_state is None:
+            initial_state = self.state
+        all_idx = self.states.index('all')
+        some_idx = self.states.index('some')
+
+        cum_P = np.cumsum(self.transition_matrix(), axis=1)
+        p_ranges = np.array([self.p1, self.p2, self.p3, self.p4])
+
+        state = np.full([N], self.states.index(initial_state))
+        marker_ps = np.zeros([N, 4])
+        is_hidden = np.zeros([N, 4], dtype=bool)
+        has_markers = np.zeros([N], dtype=bool)
+        marker_visibility = np.zeros([N, T, 4], dtype=bool)
+
+        for t in range(T):
+            u = rng.random([N, 1])
+            state = np.minimum(np.sum(u >= cum_P[state, :], axis=1), len(self.states) - 1)
+
+            in_some = state == some_idx
+            # markers are wiped whenever the chain leaves 'some' and redrawn when it enters it again
+            has_markers[np.logical_not(in_some)] = False
+            new_markers = np.logical_and(in_some, np.logical_not(has_markers))
+            n_new = np.count_nonzero(new_markers)
+            if n_new > 0:
+                p_vals = rng.uniform(p_ranges[:, 0], p_ranges[:, 1], [n_new, 4])
+                perm = np.argsort(rng.random([n_new, 4]), axis=1)
+                marker_ps[new_markers, :] = np.take_along_axis(p_vals, perm, axis=1)
+                is_hidden[new_markers, :] = False
+                has_markers[new_markers] = True
+
+            r = rng.random([N, 4])
+            # hidden markers reappear with probability 1 - p, visible ones vanish with probability p
+            is_hidden = np.where(is_hidden, r >= 1 - marker_ps, r < marker_ps)
+
+            marker_visibility[:, t, :] = np.where(np.expand_dims(in_some, axis=1), np.logical_not(is_hidden),
+                                                  np.expand_dims(state == all_idx, axis=1))
+
+        return marker_visibility
+
 
 class NoiseModelFP:
     def __init__(self, states, transition_probs, initial_probs, scale, fp_prob, radius):
@@ -207,6 +256,74 @@ class NoiseModelFP:
             false_positives.append(self.sample_FPs())
         return false_positives
 
+    # Draws one random FP location on the sphere with self.radius for every row of the batch
+    def sample_locs(self, n, rng):
+        theta = rng.uniform(0, 3.14, [n])
+        phi = rng.uniform(0, 2 * 3.14, [n])
+        return self.radius * np.stack([np.sin(theta) * np.cos(phi),
+                                       np.sin(theta) * np.sin(phi),
+                                       np.cos(theta)], axis=1)
+
+    # Adds one location in a random empty slot for all rows in the boolean mask rows
+    def add_locs_batch(self, locs, has_loc, rows, rng):
+        n = np.count_nonzero(rows)
+        if n == 0:
+            return
+        keys = rng.random([n, has_loc.shape[1]])
+        keys[has_loc[rows, :]] = np.inf
+        slot = np.argmin(keys, axis=1)
+        row_idx = np.nonzero(rows)[0]
+        locs[row_idx, slot, :] = self.sample_locs(n, rng)
+        has_loc[row_idx, slot] = True
+
+    # Simulates N independent rollouts in parallel, equivalent in distribution to N calls of rollout(T) on fresh models.
+    # Instead of ragged lists the false positives of every frame are packed into n_slots fixed slots.
+    # rng can be a np.random.Generator or np.random.RandomState, by default the global numpy state is used.
+    # Returns the positions [N x T x n_slots x 3] (zero in empty slots) and the validity mask [N x T x n_slots].
+    def rollout_batch(self, N, T, rng=None, n_slots=2):
+        if rng is None:
+            rng = np.random
+        n_locs_max = len(self.states)
+        cum_P = np.cumsum(self.P, axis=1)
+        cum_init_p = np.cumsum(self.init_p)
+
+        state = np.minimum(np.sum(rng.random([N, 1]) >= cum_init_p, axis=1), n_locs_max - 1)
+        locs = np.zeros([N, n_locs_max, 3])
+        has_loc = np.zeros([N, n_locs_max], dtype=bool)
+
+        fp_dets = np.zeros([N, T, n_slots, 3])
+        fp_valid = np.zeros([N, T, n_slots], dtype=bool)
+
+        for t in range(T):
+            state = np.minimum(np.sum(rng.random([N, 1]) >= cum_P[state, :], axis=1), n_locs_max - 1)
+
+            has_loc[state == 0, :] = False
+            n_locs = np.sum(has_loc, axis=1)
+
+            in_state1 = state == 1
+            self.add_locs_batch(locs, has_loc, np.logical_and(in_state1, n_locs == 0), rng)
+            drop = np.logical_and(in_state1, n_locs == 2)
+            drop_first = rng.random([N]) < 0.5
+            has_loc[np.logical_and(drop, drop_first), 0] = False
+            has_loc[np.logical_and(drop, np.logical_not(drop_first)), 1] = False
+
+            in_state2 = state == 2
+            self.add_locs_batch(locs, has_loc, np.logical_and(in_state2, n_locs <= 1), rng)
+            self.add_locs_batch(locs, has_loc, np.logical_and(in_state2, n_locs == 0), rng)
+
+            emitted = np.logical_and(has_loc, rng.random([N, n_locs_max]) < self.fp_prob)
+            emitted[state == 0, :] = False
+            fps = locs + np.sqrt(self.scale) * rng.standard_normal([N, n_locs_max, 3])
+
+            # pack the emitted false positives into the first slots, keeping the order of the locations
+            order = np.argsort(np.logical_not(emitted), axis=1, kind='stable')[:, :n_slots]
+            valid = np.take_along_axis(emitted, order, axis=1)
+            fp_valid[:, t, :] = valid
+            fp_dets[:, t, :, :] = np.where(np.expand_dims(valid, axis=2),
+                                           np.take_along_axis(fps, np.expand_dims(order, axis=2), axis=1), 0)
+
+        return fp_dets, fp_valid
+
 
 noise_model_FP_states = [0, 1, 2]
 noise_model_FP_transition_probs = np.array([[0.8, 0.2, 0], [0.2, 0.6, 0.2], [0, 0.8, 0.2]])
@@ -0,0 +1,205 @@
+import datetime
+import hashlib
+import json
+import os
+
+import numpy as np
+import torch
+from scipy import io
+
+import dataStore
+import multiObjectTracking
+import trackerModels
+import viconData
+from rotations import rotation_matrices_to_quats
+
+
+# Python counterpart of MultipleObjectTracking/bulkMOT.m with getUnprocessedFiles.m: tracks every new recording of a
+# dataset directory (e.g. datasets/flock3) with a learned tracker and exports the results to <dataset>/RESULTS.
+# processedFiles.json in the dataset directory records the size, modification time and sha256 of every processed
+# recording. A recording is tracked again only if its content changed, the hash is only recomputed for files whose
+# size or modification time differ from the manifest. The manifest is replaced atomically after every recording, so
+# an interrupted run keeps the recordings it finished.
+
+MANIFEST_NAME = 'processedFiles.json'
+RESULTS_DIR = 'RESULTS'
+PATTERN_DIR = 'patterns'
+FORMAT_VERSION = 1
+# a .mat file with formattedData (readTxtData.m) is used instead of the .txt log of the same name, like in birdsMOT.m
+RECORDING_EXTENSIONS = ['.mat', '.txt']
+# text files of the MATLAB pipeline next to the recordings
+NOT_RECORDINGS = ['processedFiles', 'recordingLengths']
+
+
+def file_hash(file_name, block_size=1 << 20):
+    sha256 = hashlib.sha256()
+    with open(file_name, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+def load_manifest(dataset_dir):
+    file_name = os.path.join(dataset_dir, MANIFEST_NAME)
+    if not os.path.exists(file_name):
+        return {'version': FORMAT_VERSION, 'files': {}}
+    with open(file_name) as f:
+        return json.load(f)
+
+
+def save_manifest(dataset_dir, manifest):
+    # written next to the old manifest and renamed, readers see either the old or the new one
+    tmp_name = os.path.join(dataset_dir, MANIFEST_NAME + '.tmp')
+    with open(tmp_name, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_name, os.path.join(dataset_dir, MANIFEST_NAME))
+
+
+def find_recordings(dataset_dir):
+    # file names of the recordings of a dataset directory, one per name without extension
+    recordings = {}
+    for file_name in sorted(os.listdir(dataset_dir)):
+        stem, extension = os.path.splitext(file_name)
+        if extension not in RECORDING_EXTENSIONS or stem in NOT_RECORDINGS:
+            continue
+        if stem not in recordings or RECORDING_EXTENSIONS.index(extension) < \
+                RECORDING_EXTENSIONS.index(os.path.splitext(recordings[stem])[1]):
+            recordings[stem] = file_name
+    return list(recordings.values())
+
+
+def find_unprocessed(dataset_dir, manifest):
+    """
+    Returns the recordings that are new or changed since they were processed, with their file info (size, mtime,
+    sha256). Unchanged recordings whose modification time moved are updated in the manifest in place.
+    """
+    unprocessed = []
+    for file_name in find_recordings(dataset_dir):
+        stat = os.stat(os.path.join(dataset_dir, file_name))
+        info = {'size': stat.st_size, 'mtime': stat.st_mtime}
+        entry = manifest['files'].get(file_name)
+        if entry is not None and entry['size'] == info['size'] and entry['mtime'] == info['mtime']:
+            continue
+        info['sha256'] = file_hash(os.path.join(dataset_dir, file_name))
+        if entry is not None and entry['sha256'] == info['sha256']:
+            entry.update(info)
+            continue
+        unprocessed.append((file_name, info))
+    return unprocessed
+
+
+def load_detections(file_name):
+    # unlabeled detections [T x maxDetectionsPerFrame x 3] of a .txt log or a .mat file
+    if file_name.endswith('.txt'):
+        return viconData.read_vicon_txt(file_name)
+    content = io.loadmat(file_name)
+    if 'formattedData' in content:
+        return content['formattedData']
+    return multiObjectTracking.load_unlabeled_detections(file_name)
+
+
+def load_tracker(model):
+    """
+    Loads a saved tracker (file name) and checks that it can track frame by frame. The detection layout of its input
+    (missing flags, false positive slots) is taken from the model by MultiObjectTracker.
+    """
+    if isinstance(model, str):
+        model = torch.load(model, map_location=lambda storage, loc: storage)
+    if not trackerModels.can_stream(model):
+        raise ValueError('{} has no step(), batch tracking needs a tracker like trackerModels.SOTTracker'
+                         .format(type(model).__name__))
+    # raises for input layouts MultiObjectTracker cannot build
+    trackerModels.input_layout(model)
+    return model.eval()
+
+
+_worker_model = None
+_worker_options = None
+
+
+def _init_worker(model, options):
+    global _worker_model, _worker_options
+    _worker_model = model
+    _worker_options = options
+
+
+def _init_pool_worker(model, options):
+    # one process per recording, the recordings are the parallelism
+    torch.set_num_threads(1)
+    _init_worker(model, options)
+
+
+def track_recording(job):
+    """
+    Ingestion, tracking and export of one recording in a worker. job: (dataset directory, file name).
+    Returns the file name, the result directory (relative to the dataset directory) and an error message or None.
+    """
+    dataset_dir, file_name = job
+    output_dir = os.path.join(RESULTS_DIR, os.path.splitext(file_name)[0])
+    try:
+        options = dict(_worker_options)
+        scale = options.pop('scale')
+        names, patterns = viconData.read_vsk_patterns(os.path.join(dataset_dir, PATTERN_DIR))
+        detections = load_detections(os.path.join(dataset_dir, file_name))
+
+        mot = multiObjectTracking.MultiObjectTracker(_worker_model, patterns * scale, **options)
+        positions, rotations, fps = mot.run(detections * scale, verbose=False)
+
+        # same content as exportToCSV.m: positions in the units of the recording and quaternions in (w, x, y, z)
+        # order, NaN while a bird is not tracked. Readable with viconData.load_vicon_store.
+        quats = np.full(rotations.shape[:2] + (4,), np.nan)
+        is_tracked = np.logical_not(np.isnan(positions[:, :, 0]))
+        quats[is_tracked] = rotation_matrices_to_quats(rotations[is_tracked])
+        dataStore.save_store(os.path.join(dataset_dir, output_dir), {'pos': positions / scale, 'quats': quats},
+                             flags={'subjects': names, 'source': file_name, 'fps': fps})
+    except Exception as e:
+        return file_name, output_dir, '{}: {}'.format(type(e).__name__, e)
+    return file_name, output_dir, None
+
+
+def run_batch(dataset_dir, model, n_workers=4, scale=0.1, **tracker_options):
+    """
+    Tracks all new or changed recordings of dataset_dir in a pool of n_workers processes.
+    model:           tracker for multiObjectTracking.MultiObjectTracker or the file name of a saved one
+    scale:           factor from the units of the recordings and patterns (mm) to the ones of the model (cm)
+    tracker_options: further arguments of MultiObjectTracker, e.g. gate_radius
+    Failed recordings are reported and stay unprocessed. Returns the file names of the processed recordings.
+    A model that cannot track frame by frame raises a ValueError before any recording is read.
+    """
+    model = load_tracker(model)
+    manifest = load_manifest(dataset_dir)
+    unprocessed = find_unprocessed(dataset_dir, manifest)
+    save_manifest(dataset_dir, manifest)
+    print('{} new or changed recordings in {}'.format(len(unprocessed), dataset_dir))
+    if not unprocessed:
+        return []
+
+    file_info = dict(unprocessed)
+    jobs = [(dataset_dir, file_name) for file_name, _ in unprocessed]
+    options = dict(tracker_options, scale=scale)
+    processed = []
+
+    def record(result):
+        file_name, output_dir, error = result
+        if error is not None:
+            print('Error in file {}: {}'.format(file_name, error))
+            return
+        manifest['files'][file_name] = dict(file_info[file_name], output=output_dir,
+                                            processed=datetime.datetime.now().isoformat())
+        save_manifest(dataset_dir, manifest)
+        processed.append(file_name)
+        print('Processed {} ({}/{})'.format(file_name, len(processed), len(jobs)))
+
+    if n_workers > 1 and len(jobs) > 1:
+        import multiprocessing
+        # forked workers inherit the model instead of unpickling it
+        context = multiprocessing.get_context('fork' if 'fork' in multiprocessing.get_all_start_methods() else None)
+        with context.Pool(min(n_workers, len(jobs)), initializer=_init_pool_worker,
+                          initargs=(model, options)) as pool:
+            for result in pool.imap_unordered(track_recording, jobs):
+                record(result)
+    else:
+        _init_worker(model, options)
+        for job in jobs:
+            record(track_recording(job))
+    return processed
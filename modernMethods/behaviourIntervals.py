@@ -0,0 +1,73 @@
+import numpy as np
+
+import dataStore
+from snippetExtraction import find_runs, gather_windows
+
+
+# Run length encoding of the behaviour masks of ../behaviour (isFlying.pkl, isStarting.pkl, ... [K x T] per behaviour).
+# Every bout, a run of frames of one bird with the behaviour, is a row (start, length, bird, behaviour) of an interval
+# table. The rows are sorted by behaviour and length and offsets [B + 1] delimits the rows of every behaviour, so all
+# bouts of a behaviour longer than N frames are a slice found by a binary search. The table of a recording is a few
+# integers per bout and is stored with dataStore, the snippet libraries are cut from it without scanning the masks.
+
+BEHAVIOURS = ['isFlying', 'isStarting', 'isLanding', 'isWalking', 'isSitting']
+TABLE_KEYS = ['starts', 'lengths', 'birds', 'behaviours']
+
+
+def build_interval_table(masks, behaviours=BEHAVIOURS):
+    """
+    Interval table of the masks {behaviour: [K x T]}, all masks of one recording, nonzero frames have the behaviour.
+    Returns the columns {'starts', 'lengths', 'birds', 'behaviours'} [R] (behaviour index into behaviours) and the
+    offsets [B + 1]: the bouts of behaviours[b] are the rows offsets[b]:offsets[b + 1], sorted by length.
+    """
+    columns = {key: [] for key in TABLE_KEYS}
+    for b, behaviour in enumerate(behaviours):
+        birds, starts, lengths = find_runs(np.asarray(masks[behaviour]) != 0)
+        columns['starts'].append(starts)
+        columns['lengths'].append(lengths)
+        columns['birds'].append(birds)
+        columns['behaviours'].append(np.full(len(starts), b))
+    table = {key: np.concatenate(values).astype(np.int64) for key, values in columns.items()}
+    order = np.lexsort((table['starts'], table['birds'], table['lengths'], table['behaviours']))
+    table = {key: values[order] for key, values in table.items()}
+    offsets = np.searchsorted(table['behaviours'], np.arange(len(behaviours) + 1))
+    return table, offsets
+
+
+def query_intervals(table, offsets, behaviour, min_length=0, behaviours=BEHAVIOURS):
+    # rows {'starts', 'lengths', 'birds', 'behaviours'} of the bouts of behaviour longer than min_length frames (views)
+    b = behaviours.index(behaviour)
+    lo = offsets[b] + np.searchsorted(table['lengths'][offsets[b]:offsets[b + 1]], min_length, side='right')
+    return {key: values[lo:offsets[b + 1]] for key, values in table.items()}
+
+
+def save_interval_table(dir_name, table, offsets, behaviours=BEHAVIOURS, flags=None):
+    # flags: further information of the recording for the manifest, e.g. the source of the masks
+    flags = dict(flags if flags is not None else {}, behaviours=list(behaviours))
+    return dataStore.save_store(dir_name, dict(table, offsets=offsets), flags=flags)
+
+
+def load_interval_table(dir_name):
+    # table, offsets and behaviours of save_interval_table, the columns are loaded into memory
+    arrays, manifest = dataStore.load_store(dir_name)
+    table = {key: np.array(arrays[key]) for key in TABLE_KEYS}
+    return table, np.array(arrays['offsets']), manifest['flags']['behaviours']
+
+
+def behaviour_snippets(pos, table, offsets, behaviour, min_length, snippet_length, behaviours=BEHAVIOURS):
+    """
+    Snippets [N x snippet_length x 3] of the positions pos [K x T x 3] during the bouts of behaviour longer than
+    min_length frames. A bout is cut into consecutive snippets from its start, if its length is no multiple of
+    snippet_length the last snippet ends with the bout and overlaps the one before. Bouts shorter than snippet_length
+    and bouts that do not end within pos are skipped.
+    """
+    bouts = query_intervals(table, offsets, behaviour, max(min_length, snippet_length - 1), behaviours)
+    inside = bouts['starts'] + bouts['lengths'] <= pos.shape[1]
+    starts, lengths, birds = bouts['starts'][inside], bouts['lengths'][inside], bouts['birds'][inside]
+    n_snippets = -(-lengths // snippet_length)
+    # snippet n of a bout starts n * snippet_length frames after the start of the bout, the last one ends with the bout
+    first_snippet = np.cumsum(n_snippets) - n_snippets
+    offsets_in_bout = (np.arange(np.sum(n_snippets)) - np.repeat(first_snippet, n_snippets)) * snippet_length
+    offsets_in_bout = np.minimum(offsets_in_bout, np.repeat(lengths - snippet_length, n_snippets))
+    return gather_windows(pos, np.repeat(birds, n_snippets), np.repeat(starts, n_snippets) + offsets_in_bout,
+                          snippet_length)
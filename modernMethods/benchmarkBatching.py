@@ -0,0 +1,90 @@
+import gc
+import time
+from types import SimpleNamespace
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+import dataLoading
+
+# Compares the epoch time of the old batching in the training loops (shuffle by copying, torch.split of every array,
+# gc.collect() in every iteration) with dataLoading.make_batch_loader. A small model stands in for the tracker, such
+# that the batching makes up a noticeable part of the epoch.
+
+T = 100
+N = 10000
+BATCH_SIZE = 64
+N_EPOCHS = 3
+
+
+def make_data():
+    rng = np.random.default_rng(0)
+    data = SimpleNamespace()
+    data.X_train = torch.from_numpy(rng.normal(size=[T, N, 12]).astype(np.float32))
+    data.X_train_shuffled = torch.from_numpy(rng.normal(size=[T, N, 16]).astype(np.float32))
+    data.quat_train = torch.from_numpy(rng.normal(size=[T, N, 3, 3]).astype(np.float32))
+    data.pattern_table = torch.from_numpy(rng.normal(size=[9, 4, 3]).astype(np.float32))
+    data.pattern_idx_train = torch.from_numpy(rng.integers(0, 9, N))
+    return data
+
+
+def make_model():
+    torch.manual_seed(0)
+    model = nn.Sequential(nn.Linear(16 + 12, 64), nn.ReLU(), nn.Linear(64, 9))
+    return model, torch.optim.Adam(model.parameters())
+
+
+def step(model, optimizer, dets, quat_truth, pattern_batch):
+    model.zero_grad()
+    pattern_input = pattern_batch.view(1, -1, 12).expand(dets.size(0), -1, -1)
+    pred = model(torch.cat([dets, pattern_input], dim=2))
+    loss = torch.mean((pred - quat_truth.view(dets.size(0), -1, 9)) ** 2)
+    loss.backward()
+    optimizer.step()
+
+
+def old_epoch(data, model, optimizer):
+    randperm = torch.randperm(N)
+    data.X_train = data.X_train[:, randperm, :]
+    data.X_train_shuffled = data.X_train_shuffled[:, randperm, :]
+    data.quat_train = data.quat_train[:, randperm, :]
+    data.pattern_idx_train = data.pattern_idx_train[randperm]
+    gc.collect()
+    detection_batches = torch.split(data.X_train_shuffled, BATCH_SIZE, 1)
+    quat_truth_batches = torch.split(data.quat_train, BATCH_SIZE, 1)
+    pattern_batches = torch.split(data.pattern_table[data.pattern_idx_train], BATCH_SIZE, 0)
+    for dets, quat_truth, pattern_batch in zip(detection_batches[:-1], quat_truth_batches[:-1],
+                                               pattern_batches[:-1]):
+        gc.collect()
+        step(model, optimizer, dets, quat_truth, pattern_batch)
+
+
+def time_epochs(run_epoch):
+    times = []
+    for epoch in range(N_EPOCHS):
+        start = time.perf_counter()
+        run_epoch()
+        times.append(time.perf_counter() - start)
+    return times
+
+
+if __name__ == '__main__':
+    data = make_data()
+    model, optimizer = make_model()
+    old_times = time_epochs(lambda: old_epoch(data, model, optimizer))
+    print('torch.split + gc:       ' + ', '.join('{:.2f}s'.format(t) for t in old_times))
+
+    for num_workers in [0, 2]:
+        data = make_data()
+        model, optimizer = make_model()
+        loader = dataLoading.make_batch_loader(data, 'train', ['X_shuffled', 'quat', 'pattern'], BATCH_SIZE,
+                                               num_workers=num_workers, seed=0)
+
+        def loader_epoch():
+            for batch in loader:
+                step(model, optimizer, batch['X_shuffled'], batch['quat'], batch['pattern'])
+
+        new_times = time_epochs(loader_epoch)
+        print('DataLoader, {} workers:  '.format(num_workers) + ', '.join('{:.2f}s'.format(t) for t in new_times))
+        print('speedup (median epoch): {:.2f}x'.format(np.median(old_times) / np.median(new_times)))
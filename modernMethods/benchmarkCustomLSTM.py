@@ -0,0 +1,107 @@
+import time
+from math import sqrt
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from fusedLSTM import run_pattern_lstm
+
+# Compares the per step loop of posQuatPrediction.customLSTM (reproduced below) with fusedLSTM.run_pattern_lstm on
+# the CPU, for the default sizes of posQuatPrediction (fc5_det_dim=100, fc4_pat_dim=50, hidden_dim=500, T=100).
+
+T = 100
+# with small batches the Python and kernel launch overhead of the loop dominates, with large ones the matmuls
+BATCH_SIZES = [8, 64]
+DET_DIM = 100
+PAT_DIM = 50
+HIDDEN_DIM = 500
+N_RUNS = 5
+
+
+class Cell(nn.Module):
+    # same layers and step as customLSTMCell
+    def __init__(self):
+        super().__init__()
+        self.hidden_size = HIDDEN_DIM
+        self.i2h = nn.Linear(HIDDEN_DIM, 4 * HIDDEN_DIM)
+        self.h2h = nn.Linear(HIDDEN_DIM, 4 * HIDDEN_DIM)
+        self.det2vec = nn.Linear(DET_DIM, HIDDEN_DIM)
+        self.pat2vec = nn.Linear(PAT_DIM, HIDDEN_DIM)
+        self.fc1 = nn.Linear(HIDDEN_DIM, HIDDEN_DIM)
+        std = 1.0 / sqrt(HIDDEN_DIM)
+        for w in self.parameters():
+            w.data.uniform_(-std, std)
+
+    def forward(self, x_det, x_pat, hidden):
+        if hidden is None:
+            hidden = (torch.zeros([1, x_det.size(1), HIDDEN_DIM]), torch.zeros([1, x_det.size(1), HIDDEN_DIM]))
+        h, c = hidden
+        hh = self.fc1(h)
+        x = F.relu(self.det2vec(x_det) + hh) - F.relu(self.pat2vec(x_pat) + hh)
+        h = h.view(h.size(1), -1)
+        c = c.view(c.size(1), -1)
+        x = x.view(x.size(1), -1)
+        preact = self.i2h(x) + self.h2h(h)
+        gates = preact[:, :3 * self.hidden_size].sigmoid()
+        g_t = preact[:, 3 * self.hidden_size:].tanh()
+        i_t = gates[:, :self.hidden_size]
+        f_t = gates[:, self.hidden_size:2 * self.hidden_size]
+        o_t = gates[:, -self.hidden_size:]
+        c_t = torch.mul(c, f_t) + torch.mul(i_t, g_t)
+        h_t = torch.mul(o_t, c_t.tanh())
+        return h_t.view(1, h_t.size(0), -1), c_t.view(1, c_t.size(0), -1)
+
+
+def loop(cell, x, x_pat):
+    # the loop of customLSTM.forward before the fused version
+    hidden = None
+    x = torch.unsqueeze(x, dim=0)
+    x_pat = torch.unsqueeze(x_pat, dim=0)
+    lstm_out = []
+    for det, pat in zip(torch.unbind(x, dim=1), torch.unbind(x_pat, dim=1)):
+        hidden = cell(det, pat, hidden)
+        lstm_out.append(hidden[0].clone())
+    return torch.squeeze(torch.stack(lstm_out, dim=1))
+
+
+def fused(cell, x, x_pat):
+    return run_pattern_lstm(cell, x, x_pat)[0]
+
+
+def timed(function, backward):
+    times = []
+    for run in range(N_RUNS + 1):
+        start = time.perf_counter()
+        if backward:
+            function().sum().backward()
+        else:
+            with torch.no_grad():
+                function()
+        times.append(time.perf_counter() - start)
+    # the first run includes the TorchScript compilation
+    return min(times[1:])
+
+
+if __name__ == '__main__':
+    torch.manual_seed(0)
+    cell = Cell()
+    for N in BATCH_SIZES:
+        x = torch.randn(T, N, DET_DIM)
+        pat = torch.randn(1, N, PAT_DIM)
+        x_pat = pat.expand(T, -1, -1)
+        print('batch size {}, {} threads'.format(N, torch.get_num_threads()))
+
+        with torch.no_grad():
+            reference = loop(cell, x, x_pat)
+            print('  max abs difference, patterns per frame: {:.2e}'.format(
+                (fused(cell, x, x_pat) - reference).abs().max()))
+            print('  max abs difference, compact patterns:   {:.2e}'.format(
+                (fused(cell, x, pat) - reference).abs().max()))
+
+        for backward in [False, True]:
+            name = 'forward + backward' if backward else 'forward'
+            loop_time = timed(lambda: loop(cell, x, x_pat), backward)
+            fused_time = timed(lambda: fused(cell, x, pat), backward)
+            print('  {}: loop {:.1f} ms, fused {:.1f} ms, speedup {:.2f}x'.format(
+                name, 1000 * loop_time, 1000 * fused_time, loop_time / fused_time))
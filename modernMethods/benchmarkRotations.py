@@ -0,0 +1,85 @@
+import time
+
+import numpy as np
+import torch
+from pyquaternion import Quaternion
+
+from dataStream import random_quat_tracks
+from rotations import qrot, quat_multiply, quats_to_rotation_matrices
+
+# Compares the per frame pyquaternion calls that were spread over data generation and visualisation with the batched
+# kernels of rotations, and the torch qrot on markers repeated over the batch with the broadcasting version.
+
+T = 200
+N = 500
+
+
+def timed(f, repeats=3):
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = f()
+        times.append(time.perf_counter() - start)
+    return result, min(times)
+
+
+def per_frame_rotation_matrices(quats):
+    rotation_matrices = np.zeros(quats.shape[:2] + (3, 3))
+    for t in range(quats.shape[0]):
+        for n in range(quats.shape[1]):
+            rotation_matrices[t, n] = Quaternion(quats[t, n]).rotation_matrix
+    return rotation_matrices
+
+
+def per_frame_products(quats, rotation):
+    products = np.zeros(quats.shape)
+    for t in range(quats.shape[0]):
+        for n in range(quats.shape[1]):
+            products[t, n] = (Quaternion(quats[t, n]) * rotation).elements
+    return products
+
+
+def report(name, old_time, new_time):
+    print('{:32s} {:8.3f}s -> {:8.4f}s ({:.1f}x)'.format(name, old_time, new_time, old_time / new_time))
+
+
+if __name__ == '__main__':
+    rng = np.random.default_rng(0)
+    quats = random_quat_tracks(rng, N, T)
+    pattern = rng.normal(0, 3, [4, 3])
+    print('{} frames x {} sequences'.format(T, N))
+
+    old, old_time = timed(lambda: per_frame_rotation_matrices(quats), repeats=1)
+    new, new_time = timed(lambda: quats_to_rotation_matrices(quats))
+    assert np.array_equal(old, new)
+    report('rotation matrices', old_time, new_time)
+
+    old, old_time = timed(lambda: np.matmul(per_frame_rotation_matrices(quats), pattern.T).swapaxes(2, 3), repeats=1)
+    new, new_time = timed(lambda: qrot(quats[:, :, None, :], pattern))
+    assert np.allclose(old, new)
+    report('rotated patterns', old_time, new_time)
+
+    rotation = Quaternion(axis=[0, 0, 1], angle=0.7)
+    old, old_time = timed(lambda: per_frame_products(quats, rotation), repeats=1)
+    new, new_time = timed(lambda: quat_multiply(quats, rotation.elements))
+    assert np.allclose(old, new)
+    report('quaternion products', old_time, new_time)
+
+    quats_torch = torch.from_numpy(quats).float().requires_grad_()
+    markers = torch.from_numpy(pattern[0]).float()
+
+    def repeated():
+        # what the old qrot did with the markers, a full [T x N x 3] copy before rotating
+        rotated = qrot(quats_torch, markers.repeat([T, N, 1]))
+        rotated.sum().backward()
+        return rotated
+
+    def broadcast():
+        rotated = qrot(quats_torch, markers)
+        rotated.sum().backward()
+        return rotated
+
+    old, old_time = timed(repeated)
+    new, new_time = timed(broadcast)
+    assert torch.allclose(old, new)
+    report('torch qrot forward + backward', old_time, new_time)
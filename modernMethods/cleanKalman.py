@@ -1,8 +1,9 @@
 import numpy as np
-import pandas as pd
 from matplotlib import pyplot as plt
 from viz import visualize
 import pickle as pkl
+import smoothing
+import snippetExtraction
 from scipy import io
 
 
@@ -30,27 +31,10 @@ def plot_trajectories(pos):
 
 
 def get_snippets(pos, quats, length, interval):
-    snippets = []
-    quat_snippets = []
-    for k in range(n_objects):
-        traj = pos[k, :, :]
-        qtraj = quats[k, :, :]
-        T = traj.shape[0]
-        r_bnd = T - length
-        for t in range(0, r_bnd, interval):
-            tr = traj[t:t+length, :]
-            qtr = qtraj[t:t+length, :]
-            if not np.any(np.isnan(tr)):
-                tr_norm = np.linalg.norm(tr, axis=1)
-                diff = tr_norm[1:] - tr_norm[:-1]
-                if np.any(diff > 50):
-                    print('Big Jump encountered!')
-                else:
-                    snippets.append(tr)
-                    quat_snippets.append(qtr)
-            else:
-                print('NaN encountered!')
-    return np.stack(snippets, axis=0), np.stack(quat_snippets, axis=0)
+    snippets, [quat_snippets], stats = snippetExtraction.extract_snippets(pos, length, interval, max_jump=50,
+                                                                          jump_measure='norm', arrays=[quats])
+    print('{valid} of {windows} snippets, {nan} with NaN, {jump} with big jumps'.format(**stats))
+    return snippets, quat_snippets
 
 
 def center_snippets(snips):
@@ -133,18 +117,8 @@ def save_as_training_data(snips, quat_snips):
 
 plt.subplot(121)
 plot_trajectories(pos)
-pos_smoothened = np.zeros([n_objects, T - rolling_median_window_size + 1, 3])
-quats_smoothened = np.zeros([n_objects, T - rolling_median_window_size + 1, 4])
-for k in range(n_objects):
-    pos_smoothened[k, :, :] = pd.DataFrame(pos[k, :, :]).rolling(rolling_median_window_size).median().to_numpy()[rolling_median_window_size - 1:, :]
-    quats_smoothened[k, :, :] = pd.DataFrame(quats[k, :, :]).rolling(rolling_median_window_size).median().to_numpy()[rolling_median_window_size - 1:, :]
-
-pos_smoothened2 = np.zeros([n_objects, T - rolling_median_window_size + 1 - rolling_mean_window_size + 1, 3])
-quats_smoothened2 = np.zeros([n_objects, T - rolling_median_window_size + 1 - rolling_mean_window_size + 1, 4])
-
-for k in range(n_objects):
-    pos_smoothened2[k, :, :] = pd.DataFrame(pos_smoothened[k, :, :]).rolling(rolling_mean_window_size).mean().to_numpy()[rolling_mean_window_size-1:, :]
-    quats_smoothened2[k, :, :] = pd.DataFrame(quats_smoothened[k, :, :]).rolling(rolling_mean_window_size).mean().to_numpy()[rolling_mean_window_size-1:, :]
+pos_smoothened2 = smoothing.smooth(pos, rolling_median_window_size, rolling_mean_window_size)
+quats_smoothened2 = smoothing.smooth(quats, rolling_median_window_size, rolling_mean_window_size, quaternions=True)
 
 plt.subplot(122)
 plot_trajectories(pos_smoothened2)
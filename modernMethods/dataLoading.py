@@ -0,0 +1,75 @@
+import torch
+from torch.utils.data import Dataset, DataLoader, BatchSampler, RandomSampler, SequentialSampler
+
+
+# Batching for the training loops in posQuatPrediction. The data stays in the [T x N x ...] layout of TrainingData,
+# every batch is gathered with a single index_select per array instead of splitting all arrays every epoch.
+
+
+def attribute_name(key, split):
+    # TrainingData names the shuffled detections X_train_shuffled, all other arrays <key>_<split>
+    if key == 'X_shuffled':
+        return 'X_' + split + '_shuffled'
+    return key + '_' + split
+
+
+class SequenceBatches(Dataset):
+    """
+    Serves batches of sequences of one split ('train' or 'test') of a TrainingData object (after convert_to_torch).
+    It is indexed with a list of sequence indices, as produced by a BatchSampler, and returns a dict with one
+    [T x B x ...] tensor per key, e.g. keys=['X_shuffled', 'quat', 'pattern'] reads X_train_shuffled, quat_train and
+    the compact patterns [B x 4 x 3] of the batch.
+    """
+    def __init__(self, data, split, keys):
+        self.keys = keys
+        self.arrays = {key: getattr(data, attribute_name(key, split)) for key in keys if key != 'pattern'}
+        if 'pattern' in keys:
+            self.pattern_table = data.pattern_table
+            self.pattern_idx = getattr(data, 'pattern_idx_' + split)
+        self.n_sequences = getattr(data, 'X_' + split).shape[1]
+        # the indices are created where the data is, index_select on the GPU needs them there
+        self.device = getattr(data, 'X_' + split).device
+
+    def __len__(self):
+        return self.n_sequences
+
+    def __getitem__(self, indices):
+        indices = torch.as_tensor(indices, dtype=torch.long, device=self.device)
+        # sorted indices read memory mapped arrays front to back, the order within a batch does not matter
+        indices = torch.sort(indices)[0]
+        batch = {}
+        for key in self.keys:
+            if key == 'pattern':
+                batch[key] = self.pattern_table[self.pattern_idx[indices]]
+            else:
+                batch[key] = self.arrays[key].index_select(1, indices)
+        return batch
+
+
+def make_batch_loader(data, split, keys, batch_size, shuffle=True, num_workers=0, seed=None, drop_last=True):
+    """
+    DataLoader over SequenceBatches. With shuffle the sequences are permuted by index every epoch, the data itself is
+    never reordered. Batches are prefetched by num_workers background processes and pinned if a GPU is available
+    (only if the data is not on the GPU already, then the batches are gathered in the main process).
+    """
+    dataset = SequenceBatches(data, split, keys)
+    if shuffle:
+        generator = torch.Generator()
+        if seed is not None:
+            generator.manual_seed(seed)
+        sampler = RandomSampler(dataset, generator=generator)
+    else:
+        sampler = SequentialSampler(dataset)
+
+    on_gpu = getattr(data, 'X_' + split).is_cuda
+    if on_gpu:
+        num_workers = 0
+    return DataLoader(dataset, sampler=BatchSampler(sampler, batch_size, drop_last), batch_size=None,
+                      num_workers=num_workers, pin_memory=torch.cuda.is_available() and not on_gpu,
+                      persistent_workers=num_workers > 0, prefetch_factor=2 if num_workers > 0 else None)
+
+
+def to_device(batch, device):
+    if device is None:
+        return batch
+    return {key: value.to(device, non_blocking=True) for key, value in batch.items()}
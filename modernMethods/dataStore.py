@@ -0,0 +1,84 @@
+import json
+import os
+
+import numpy as np
+
+
+# On disk format for the training arrays: one float32 .npy file per array, written chunk by chunk along the
+# sequence axis, plus a small manifest.json describing shapes, dtypes and the generation settings.
+# The files are opened as memory maps, so data sets larger than RAM only page in the sequences that are used.
+
+MANIFEST_NAME = 'manifest.json'
+FORMAT_VERSION = 1
+
+
+def _storage_dtype(key, array):
+    # marker ids are used as class labels, keeping them int64 lets torch.from_numpy return a LongTensor without a copy
+    if key.startswith('marker_ids'):
+        return np.dtype(np.int64)
+    if np.issubdtype(array.dtype, np.floating):
+        return np.dtype(np.float32)
+    return array.dtype
+
+
+def save_store(dir_name, arrays, flags=None, seed=None, chunk_size=1000):
+    """
+    Writes a dict of [T x N x ...] arrays (and per sequence arrays [N]) into dir_name.
+
+    Every array is written in chunks of chunk_size sequences into a memory mapped .npy file, so at most one chunk is
+    converted to float32 at a time. flags and seed are stored in the manifest next to the shapes and dtypes.
+    """
+    if not os.path.exists(dir_name):
+        os.makedirs(dir_name)
+
+    manifest = {'version': FORMAT_VERSION, 'flags': flags if flags is not None else {}, 'seed': seed,
+                'chunk_size': chunk_size, 'arrays': {}}
+    for key, array in arrays.items():
+        if array is None:
+            continue
+        array = np.asarray(array)
+        dtype = _storage_dtype(key, array)
+        file_name = key + '.npy'
+        out = np.lib.format.open_memmap(os.path.join(dir_name, file_name), mode='w+', dtype=dtype,
+                                        shape=array.shape)
+        if array.ndim < 2:
+            # per sequence values like the pattern indices
+            out[...] = array
+        else:
+            N = array.shape[1]
+            for lo in range(0, N, chunk_size):
+                out[:, lo:lo + chunk_size] = array[:, lo:lo + chunk_size]
+        out.flush()
+        del out
+        manifest['arrays'][key] = {'file': file_name, 'shape': list(array.shape), 'dtype': dtype.name}
+
+    # the manifest is written last, a store without manifest is incomplete
+    tmp_name = os.path.join(dir_name, MANIFEST_NAME + '.tmp')
+    with open(tmp_name, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_name, os.path.join(dir_name, MANIFEST_NAME))
+    return manifest
+
+
+def load_manifest(dir_name):
+    with open(os.path.join(dir_name, MANIFEST_NAME)) as f:
+        return json.load(f)
+
+
+def load_store(dir_name, keys=None):
+    """
+    Opens the arrays of a store as memory maps. Nothing is read until the arrays are indexed.
+
+    The maps are opened copy-on-write, they are writable (as torch.from_numpy requires) but changes never reach
+    the files. Returns (arrays, manifest).
+    """
+    manifest = load_manifest(dir_name)
+    arrays = {}
+    for key, info in manifest['arrays'].items():
+        if keys is not None and key not in keys:
+            continue
+        array = np.load(os.path.join(dir_name, info['file']), mmap_mode='c')
+        if list(array.shape) != info['shape'] or array.dtype.name != info['dtype']:
+            raise ValueError('Array ' + key + ' in ' + dir_name + ' does not match the manifest.')
+        arrays[key] = array
+    return arrays, manifest
@@ -0,0 +1,134 @@
+from itertools import count
+
+import numpy as np
+import torch
+from torch.utils.data import IterableDataset, get_worker_info
+
+from dataSynthesis import synthesize_detections
+
+
+# Generates training batches on demand instead of materialising the whole data set before training starts.
+# Batch b is always generated from the same seed, independent of the number of DataLoader workers, and no batch
+# index is generated twice, so the stream never repeats samples and only keeps the current batches in memory.
+
+
+def random_quat_tracks(rng, N, T):
+    """
+    Batched version of posQuatPrediction.gen_quats, returns N random smooth quaternion tracks of shape [T x N x 4].
+    """
+    theta_range = rng.uniform(0.5, 1, [1, N])
+    theta = np.linspace(-1, 1, T)[:, None] * theta_range * np.pi
+    z_range = rng.integers(1, 10, [1, N])
+    z = rng.uniform(1, 3, [1, N]) * np.sin(np.linspace(0, 1, T)[:, None] * z_range)
+    rx = np.abs(z) ** rng.uniform(1.5, 3, [1, N]) * rng.random([1, N]) + 1
+    ry = np.abs(z) ** rng.uniform(1.5, 3, [1, N]) * rng.random([1, N]) + 1
+    x = rx ** 1.5 * np.sin(theta)
+    y = ry ** 1.5 * np.cos(theta)
+    w = 1 + rng.uniform(0.5, 4, [1, N]) * np.sin(theta) * np.cos(theta) ** 2
+    quats = np.stack([w, x, y, z], axis=2)
+    return quats / np.linalg.norm(quats, axis=2, keepdims=True)
+
+
+def sample_quat_tracks(rng, quat_bank, N):
+    """
+    Draws N tracks from quat_bank [T x M x 4] (e.g. the cleaned Kalman snippets) and rotates each of them by a random
+    angle about the z axis, like the augmentation in posQuatPrediction.gen_data. Returns [T x N x 4].
+    """
+    quats = quat_bank[:, rng.integers(0, quat_bank.shape[1], N), :]
+    half_theta = rng.uniform(0, 6, [1, N]) / 2
+    c, s = np.cos(half_theta), np.sin(half_theta)
+    w, x, y, z = quats[:, :, 0], quats[:, :, 1], quats[:, :, 2], quats[:, :, 3]
+    # quats * (c, 0, 0, s)
+    return np.stack([w * c - z * s, x * c + y * s, y * c - x * s, z * c + w * s], axis=2)
+
+
+def constant_difficulty(noise_std=0.0, p_drop=1.0, p_fp=1.0):
+    return lambda batch_index: {'noise_std': noise_std, 'p_drop': p_drop, 'p_fp': p_fp}
+
+
+def linear_difficulty(n_ramp_batches, max_noise_std=0.0, max_p_drop=1.0, max_p_fp=1.0):
+    """
+    Starts with clean sequences and linearly increases the noise and the fraction of sequences with dropped
+    detections (p_drop) and false positives (p_fp) until batch n_ramp_batches.
+    """
+    def schedule(batch_index):
+        level = min(1.0, batch_index / max(1, n_ramp_batches))
+        return {'noise_std': level * max_noise_std, 'p_drop': level * max_p_drop, 'p_fp': level * max_p_fp}
+    return schedule
+
+
+class SyntheticSequenceStream(IterableDataset):
+    """
+    Endless stream of batches with the layout of posQuatPrediction.TrainingData, meant to be used with
+    DataLoader(stream, batch_size=None, num_workers=...).
+
+    patterns:   [P x 4 x 3] marker patterns
+    nM_FN:      NoiseModelFN for dropped detections or None
+    nM_FP:      NoiseModelFP for false positives or None, if given X_shuffled always contains n_fp_slots extra slots
+    schedule:   function batch_index -> {'noise_std', 'p_drop', 'p_fp'}, see linear_difficulty
+    quat_bank:  [T x M x 4] quaternion tracks to sample from, None generates random tracks
+    n_batches:  stops after this many batches, None never stops
+    """
+    def __init__(self, patterns, nM_FN=None, nM_FP=None, T=100, batch_size=64, seed=0, schedule=None, quat_bank=None,
+                 n_fp_slots=2, n_batches=None):
+        super().__init__()
+        self.patterns = patterns
+        self.nM_FN = nM_FN
+        self.nM_FP = nM_FP
+        self.T = T
+        self.batch_size = batch_size
+        self.seed = seed
+        self.schedule = schedule if schedule is not None else constant_difficulty()
+        self.quat_bank = quat_bank
+        self.n_fp_slots = n_fp_slots
+        self.n_batches = n_batches
+
+    def __iter__(self):
+        worker_info = get_worker_info()
+        if worker_info is None:
+            worker_id, num_workers = 0, 1
+        else:
+            worker_id, num_workers = worker_info.id, worker_info.num_workers
+        # the workers take turns, worker k generates the batches k, k + num_workers, ...
+        for batch_index in count(worker_id, num_workers):
+            if self.n_batches is not None and batch_index >= self.n_batches:
+                return
+            yield self.generate_batch(batch_index)
+
+    def generate_batch(self, batch_index):
+        rng = np.random.default_rng(np.random.SeedSequence(self.seed, spawn_key=(batch_index,)))
+        difficulty = self.schedule(batch_index)
+        T = self.T
+        N = self.batch_size
+
+        if self.quat_bank is not None:
+            quats = sample_quat_tracks(rng, self.quat_bank, N)
+        else:
+            quats = random_quat_tracks(rng, N, T)
+        pattern_idx = rng.integers(0, len(self.patterns), N)
+        quat_idx = np.arange(0, N)
+
+        visibility = None
+        fp_dets = None
+        fp_is_missing = None
+        noise = None
+        n_slots = self.patterns.shape[1]
+        if self.nM_FN is not None:
+            visibility = self.nM_FN.rollout_batch(N, T, rng)
+            # the remaining sequences keep all markers
+            visibility[rng.random(N) >= difficulty['p_drop']] = True
+        if self.nM_FP is not None:
+            fp_dets, fp_valid = self.nM_FP.rollout_batch(N, T, rng, n_slots=self.n_fp_slots)
+            fp_valid[rng.random(N) >= difficulty['p_fp']] = False
+            fp_is_missing = np.logical_not(fp_valid).astype(np.float64)
+            n_slots += self.n_fp_slots
+        if difficulty['noise_std'] > 0:
+            noise = rng.normal(0, difficulty['noise_std'], [N, T, n_slots, 4])
+
+        data = synthesize_detections(quats, self.patterns, pattern_idx, quat_idx, visibility, noise, fp_dets,
+                                     fp_is_missing)
+        return {'X': torch.from_numpy(data['X']).float(),
+                'X_shuffled': torch.from_numpy(data['X_shuffled']).float(),
+                'quat': torch.from_numpy(data['quat']).float(),
+                'pattern': torch.from_numpy(self.patterns[pattern_idx]).float(),
+                'marker_ids': torch.from_numpy(data['marker_ids']).type(torch.LongTensor)}
@@ -0,0 +1,205 @@
+import numpy as np
+
+from rotations import quats_to_rotation_matrices
+
+
+# Array based replacement for the per frame loop in posQuatPrediction.gen_data.
+# All functions work on whole [T x N x ...] blocks at once. synthesize_detections does not draw random numbers itself,
+# generate_sequences adds the random parts with one independent stream per shard and runs the shards in parallel.
+
+
+def rotate_patterns(rotation_matrices, patterns):
+    """
+    Rotates the markers of each pattern with the rotation matrix of the same sequence and frame.
+    rotation_matrices: [T x N x 3 x 3], patterns: [N x n_markers x 3]
+    Returns the rotated markers with shape [T x N x n_markers x 3].
+    """
+    rotated = np.matmul(rotation_matrices, np.expand_dims(np.transpose(patterns, [0, 2, 1]), axis=0))
+    return np.swapaxes(rotated, 2, 3)
+
+
+def order_missing_last(detections, is_missing):
+    """
+    Moves all missing detections behind the visible ones while keeping the relative order within both groups.
+    detections: [T x N x K x D], is_missing: [T x N x K]
+    """
+    order = np.argsort(is_missing, axis=2, kind='stable')
+    return np.take_along_axis(detections, np.expand_dims(order, axis=3), axis=2)
+
+
+def synthesize_detections(quats, patterns, pattern_idx, quat_idx, visibility=None, noise=None,
+                          fp_dets=None, fp_is_missing=None):
+    """
+    Generates the training arrays for N sequences in one go.
+
+    quats:          [T x M x 4] quaternion tracks
+    patterns:       [P x 4 x 3] marker patterns
+    pattern_idx:    [N] pattern used by each sequence
+    quat_idx:       [N] quaternion track used by each sequence
+    visibility:     [N x T x 4] boolean marker visibility, None means all markers are visible
+    noise:          [N x T x K x 4] additive noise for the detections (K = 4 or 6 with false positives), or None
+    fp_dets:        [N x T x K-4 x 3] false positive detections, or None
+    fp_is_missing:  [N x T x K-4] 1 where a false positive slot is empty
+
+    Returns a dict with the same keys and layout as posQuatPrediction.gen_data:
+    X [T x N x 12], X_shuffled [T x N x 4K], quat [T x N x 3 x 3], marker_ids [T x N x 4]
+    The patterns are not repeated per sequence and frame, pattern_idx references them.
+    """
+    T = quats.shape[0]
+    N = len(pattern_idx)
+    n_markers = patterns.shape[1]
+
+    # every quaternion track is shared by all patterns, so only convert each of them once
+    unique_rotation_matrices = quats_to_rotation_matrices(quats)
+    rotation_matrices = unique_rotation_matrices[:, quat_idx, :, :]
+    sequence_patterns = patterns[pattern_idx, :, :]
+
+    rotated_patterns = rotate_patterns(rotation_matrices, sequence_patterns)
+    X = np.reshape(rotated_patterns, [T, N, n_markers * 3])
+
+    if visibility is not None:
+        is_missing = np.logical_not(np.transpose(visibility, [1, 0, 2]))
+    else:
+        is_missing = np.zeros([T, N, n_markers], dtype=bool)
+
+    marker_identities = np.tile(np.arange(0, n_markers, dtype=np.float64), [T, N, 1])
+    marker_identities[is_missing] = n_markers
+
+    detections = np.concatenate([np.where(np.expand_dims(is_missing, axis=3), 0, rotated_patterns),
+                                 np.expand_dims(is_missing.astype(np.float64), axis=3)], axis=3)
+    if fp_dets is not None:
+        fp_is_missing = np.transpose(fp_is_missing, [1, 0, 2])
+        fp_detections = np.concatenate([np.transpose(fp_dets, [1, 0, 2, 3]),
+                                        np.expand_dims(fp_is_missing.astype(np.float64), axis=3)], axis=3)
+        detections = np.concatenate([detections, fp_detections], axis=2)
+        is_missing = np.concatenate([is_missing, fp_is_missing == 1], axis=2)
+
+    if noise is not None:
+        noise = np.copy(np.transpose(noise, [1, 0, 2, 3]))
+        # false positives stay noise free, missing detections stay at the origin
+        noise[:, :, n_markers:, :] = 0
+        noise[np.logical_and(np.expand_dims(is_missing, axis=3),
+                             np.arange(0, 4) < 3)] = 0
+        noise[:, :, :, 3] = 0
+        detections = detections + noise
+
+    detections = order_missing_last(detections, is_missing)
+    X_shuffled = np.reshape(detections, [T, N, -1])
+
+    return {'X': X, 'X_shuffled': X_shuffled, 'quat': rotation_matrices, 'marker_ids': marker_identities}
+
+
+def generate_shard(shard):
+    """
+    Generates one shard of sequences with its own random stream, see generate_sequences.
+    Defined at module level such that it can be sent to worker processes.
+    """
+    quats, patterns, pattern_idx, quat_idx, seed, nM_FN, nM_FP, noise_std, n_fp_slots = shard
+    rng = np.random.default_rng(seed)
+    T = quats.shape[0]
+    N = len(pattern_idx)
+
+    visibility = None
+    fp_dets = None
+    fp_is_missing = None
+    noise = None
+    n_slots = patterns.shape[1]
+    if nM_FN is not None:
+        visibility = nM_FN.rollout_batch(N, T, rng)
+    if nM_FP is not None:
+        fp_dets, fp_valid = nM_FP.rollout_batch(N, T, rng, n_slots=n_fp_slots)
+        fp_is_missing = np.logical_not(fp_valid).astype(np.float64)
+        n_slots += n_fp_slots
+    if noise_std is not None:
+        noise = rng.normal(0, noise_std, [N, T, n_slots, 4])
+
+    return synthesize_detections(quats, patterns, pattern_idx, quat_idx, visibility, noise, fp_dets, fp_is_missing)
+
+
+def generate_sequences(quats, patterns, pattern_idx, quat_idx, seed, nM_FN=None, nM_FP=None, noise_std=None,
+                       n_fp_slots=2, shard_size=1000, n_workers=1):
+    """
+    Generates the same arrays as synthesize_detections, including the random visibility masks, false positives and
+    noise, split into shards of shard_size sequences which are processed by n_workers processes.
+
+    Every shard draws from its own stream spawned from seed (an int or a np.random.SeedSequence). The split into
+    shards does not depend on n_workers, therefore the same seed gives identical arrays for any number of workers.
+    nM_FN / nM_FP / noise_std set to None disable dropped detections / false positives / noise.
+    """
+    if not isinstance(seed, np.random.SeedSequence):
+        seed = np.random.SeedSequence(seed)
+    N = len(pattern_idx)
+    n_shards = max(1, int(np.ceil(N / shard_size)))
+    shard_seeds = seed.spawn(n_shards)
+
+    shards = []
+    for k in range(n_shards):
+        lo = k * shard_size
+        hi = min(N, (k + 1) * shard_size)
+        # only ship the quaternion tracks the shard actually uses
+        used_quats, shard_quat_idx = np.unique(quat_idx[lo:hi], return_inverse=True)
+        shards.append((quats[:, used_quats, :], patterns, pattern_idx[lo:hi], shard_quat_idx, shard_seeds[k],
+                       nM_FN, nM_FP, noise_std, n_fp_slots))
+
+    if n_workers > 1 and n_shards > 1:
+        import multiprocessing
+        if 'fork' in multiprocessing.get_all_start_methods():
+            # forked workers write straight into output arrays in shared memory instead of pickling their shards
+            # back, this also keeps them from re-running the calling training script on import
+            global _shared_outputs
+            n_slots = patterns.shape[1] + (n_fp_slots if nM_FP is not None else 0)
+            _shared_outputs = _allocate_shared_outputs(quats.shape[0], N, patterns.shape[1], n_slots)
+            jobs = [(k * shard_size, shard) for k, shard in enumerate(shards)]
+            try:
+                with multiprocessing.get_context('fork').Pool(min(n_workers, n_shards)) as pool:
+                    for _ in pool.imap_unordered(_write_shard, jobs):
+                        pass
+                results = _shared_outputs
+            finally:
+                _shared_outputs = None
+        else:
+            with multiprocessing.get_context().Pool(min(n_workers, n_shards)) as pool:
+                results = _collect_shards(pool.imap(generate_shard, shards), N)
+    else:
+        results = _collect_shards(map(generate_shard, shards), N)
+    return results
+
+
+_shared_outputs = None
+
+
+def _allocate_shared_outputs(T, N, n_markers, n_slots):
+    import mmap
+    shapes = {'X': [T, N, n_markers * 3], 'X_shuffled': [T, N, n_slots * 4], 'quat': [T, N, 3, 3],
+              'marker_ids': [T, N, n_markers]}
+    outputs = {}
+    for key, shape in shapes.items():
+        n_bytes = int(np.prod(shape)) * np.dtype(np.float64).itemsize
+        # anonymous mappings are shared with forked children
+        outputs[key] = np.frombuffer(mmap.mmap(-1, max(n_bytes, 1)), dtype=np.float64,
+                                     count=int(np.prod(shape))).reshape(shape)
+    return outputs
+
+
+def _write_shard(job):
+    lo, shard = job
+    shard_data = generate_shard(shard)
+    for key, value in shard_data.items():
+        _shared_outputs[key][:, lo:lo + value.shape[1]] = value
+    return lo
+
+
+def _collect_shards(shard_results, N):
+    # writes the shards into preallocated arrays, such that at most one shard is kept twice in memory
+    data = None
+    lo = 0
+    for shard_data in shard_results:
+        if data is None:
+            data = {}
+            for key, value in shard_data.items():
+                data[key] = np.zeros([value.shape[0], N] + list(value.shape[2:]), dtype=value.dtype)
+        n = shard_data['X'].shape[1]
+        for key, value in shard_data.items():
+            data[key][:, lo:lo + n] = value
+        lo += n
+    return data
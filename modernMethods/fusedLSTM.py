@@ -0,0 +1,96 @@
+import warnings
+
+import torch
+import torch.nn.functional as F
+
+
+# Whole-sequence version of posQuatPrediction.customLSTMCell. The detection and pattern projections (det2vec and
+# pat2vec) do not depend on the hidden state and are computed for all time steps in one matmul, fc1 and h2h both read
+# the hidden state and are fused into one matmul per step. The recurrence itself is a TorchScript function, which
+# removes the Python overhead of the per step loop.
+
+
+def script_or_eager(fn):
+    """
+    TorchScript version of fn, or fn itself if this torch version cannot script it. torch.jit.script is deprecated
+    since torch 2.5 but still removes the loop overhead, its FutureWarning is not shown on every import.
+    """
+    try:
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', FutureWarning)
+            return torch.jit.script(fn)
+    except Exception:
+        return fn
+
+
+def pattern_lstm_recurrence(det_proj, pat_proj, w_hidden, b_hidden, w_input, b_input, h, c,
+                            use_pattern: bool):
+    """
+    det_proj:   [T x N x H] det2vec of the detections
+    pat_proj:   [T x N x H] or [1 x N x H] pat2vec of the patterns (ignored if use_pattern is False)
+    w_hidden:   [5H x H] fc1 and h2h weights stacked, b_hidden: [5H]
+    w_input:    [4H x H] i2h weights, b_input: [4H]
+    h, c:       [N x H] initial state
+    Returns the hidden states of all steps [T x N x H] and the final h and c.
+    """
+    hidden_size = h.size(1)
+    det_steps = det_proj.unbind(0)
+    pat_steps = pat_proj.unbind(0)
+    # unbind instead of indexing and a single stack at the end, indexing a step or writing it into a preallocated
+    # output makes autograd create a full [T x N x H] gradient for every step
+    out = []
+    for t in range(len(det_steps)):
+        hidden_proj = F.linear(h, w_hidden, b_hidden)
+        hh = hidden_proj[:, :hidden_size]
+        x = F.relu(det_steps[t] + hh)
+        if use_pattern:
+            if len(pat_steps) == 1:
+                x = x - F.relu(pat_steps[0] + hh)
+            else:
+                x = x - F.relu(pat_steps[t] + hh)
+        preact = F.linear(x, w_input, b_input) + hidden_proj[:, hidden_size:]
+
+        gates = preact[:, :3 * hidden_size].sigmoid()
+        g_t = preact[:, 3 * hidden_size:].tanh()
+        i_t = gates[:, :hidden_size]
+        f_t = gates[:, hidden_size:2 * hidden_size]
+        o_t = gates[:, 2 * hidden_size:]
+
+        c = c * f_t + i_t * g_t
+        h = o_t * c.tanh()
+        out.append(h)
+    return torch.stack(out), h, c
+
+
+pattern_lstm_recurrence = script_or_eager(pattern_lstm_recurrence)
+
+
+def fused_hidden_weights(cell):
+    # fc1 and h2h of a customLSTMCell stacked into one [5H x H] layer
+    h2h_bias = cell.h2h.bias if cell.h2h.bias is not None else cell.h2h.weight.new_zeros(cell.h2h.out_features)
+    return torch.cat([cell.fc1.weight, cell.h2h.weight], dim=0), torch.cat([cell.fc1.bias, h2h_bias], dim=0)
+
+
+def run_pattern_lstm(cell, x_det, x_pat, hidden=None):
+    """
+    Runs a customLSTMCell over whole sequences.
+    x_det: [T x N x D_det], x_pat: [T x N x D_pat], [1 x N x D_pat] for patterns that are constant over time, or None
+    hidden: (h, c) with shape [1 x N x H] each, or None for zeros
+    Returns the hidden states [T x N x H] and the final (h, c) with shape [1 x N x H].
+    """
+    if hidden is None:
+        h = x_det.new_zeros([x_det.size(1), cell.hidden_size])
+        c = x_det.new_zeros([x_det.size(1), cell.hidden_size])
+    else:
+        h = hidden[0].view(x_det.size(1), -1)
+        c = hidden[1].view(x_det.size(1), -1)
+
+    det_proj = cell.det2vec(x_det)
+    use_pattern = x_pat is not None
+    pat_proj = cell.pat2vec(x_pat) if use_pattern else det_proj[:1]
+    w_hidden, b_hidden = fused_hidden_weights(cell)
+    b_input = cell.i2h.bias if cell.i2h.bias is not None else cell.i2h.weight.new_zeros(cell.i2h.out_features)
+
+    out, h, c = pattern_lstm_recurrence(det_proj, pat_proj, w_hidden, b_hidden, cell.i2h.weight, b_input, h, c,
+                                        use_pattern)
+    return out, (h.unsqueeze(0), c.unsqueeze(0))
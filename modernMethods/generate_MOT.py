@@ -1,8 +1,8 @@
 import numpy as np
 import matplotlib.pyplot as plt
 import pickle as pkl
-import pandas as pd
-from pyquaternion import Quaternion as Quaternion
+import smoothing
+from rotations import quats_to_rotation_matrices
 import scipy.io
 
 from BehaviourModel import NoiseModelFN, NoiseModelFP
@@ -34,15 +34,7 @@ def generate_pos():
     n_objects = pos.shape[0]
     T = pos.shape[1]
 
-    pos_smoothened = np.zeros([n_objects, T - rolling_media_window_size + 1, 3])
-    for k in range(n_objects):
-        pos_smoothened[k, :, :] = pd.DataFrame(pos[k, :, :]).rolling(rolling_media_window_size).median().to_numpy()[rolling_media_window_size-1:,
-                                  :]
-
-    pos_smoothened2 = np.zeros([n_objects, T - rolling_media_window_size + 1 - rolling_mean_window_size + 1, 3])
-    for k in range(n_objects):
-        pos_smoothened2[k, :, :] = pd.DataFrame(pos_smoothened[k, :, :]).rolling(
-            rolling_mean_window_size).mean().to_numpy()[rolling_mean_window_size-1:, :]
+    pos_smoothened2 = smoothing.smooth(pos, rolling_media_window_size, rolling_mean_window_size)
 
     pos = pos_smoothened2
     bad_frames = np.any(np.isnan(pos[:, :, 0]), axis=0)
@@ -110,17 +102,7 @@ def generate_quat(intervals):
     plt.subplot(121)
     plot_trajectories(quats)
 
-    quats_smoothened = np.zeros([n_objects, T - rolling_media_window_size + 1, 4])
-    for k in range(n_objects):
-        quats_smoothened[k, :, :] = pd.DataFrame(quats[k, :, :]).rolling(rolling_media_window_size).median().to_numpy()[
-                                  rolling_media_window_size - 1:,
-                                  :]
-
-    quats_smoothened2 = np.zeros([n_objects, T - rolling_media_window_size + 1 - rolling_mean_window_size + 1, 4])
-    for k in range(n_objects):
-        quats_smoothened2[k, :, :] = pd.DataFrame(quats_smoothened[k, :, :]).rolling(
-            rolling_mean_window_size).mean().to_numpy()[rolling_mean_window_size - 1:, :]
-
+    quats_smoothened2 = smoothing.smooth(quats, rolling_media_window_size, rolling_mean_window_size, quaternions=True)
 
     plt.subplot(122)
     plot_trajectories(quats_smoothened2)
@@ -145,12 +127,11 @@ def simulate_markers(pos, quats, visibility, patterns, FPs, scale):
     T = pos.shape[1]
     N_birds = pos.shape[0]
     detections = np.zeros([N_birds, T, 6, 3]) * np.NaN
+    rotation_matrices = quats_to_rotation_matrices(quats)
     for t in range(T):
         for n in range(N_birds):
             p = pos[n, t, :]
-            q = quats[n, t, :]
-            Q = Quaternion(q)
-            R = Q.rotation_matrix
+            R = rotation_matrices[n, t]
             pat = patterns[n, :, :]
 
             rotated_pat = (R @ pat.T).T + p
@@ -0,0 +1,86 @@
+import copy
+
+import torch
+import torch.nn as nn
+
+
+# Turns a trained tracker into a module for CPU inference: BatchNorm layers are folded into the Linear layers in front
+# of them, dropout is removed and the result is optionally converted to bfloat16 or dynamically quantized to int8
+# (Linear and LSTM weights in int8, activations quantized on the fly). In eval mode BatchNorm is an affine map with the
+# running statistics, so the folded float32 model computes the same function up to rounding.
+
+PRECISIONS = ['float32', 'bfloat16', 'int8']
+
+# (Linear, BatchNorm) pairs of trackerModels.SOTTracker, the BatchNorm normalizes the output features of the Linear
+# layer. The pattern encoder only exists if the model was trained without use_const_pat.
+SOT_TRACKER_BATCHNORMS = [('fc1_det', 'bn1'), ('fc2_det', 'bn2'), ('fc3_det', 'bn3'), ('fc4_det', 'bn4'),
+                          ('fc1_pat', 'bn1_pat'), ('fc2_pat', 'bn2_pat'), ('fc3_pat', 'bn3_pat'),
+                          ('fc4_pat', 'bn4_pat'),
+                          ('hidden2out1_prediction', 'hidden2out_bn1'), ('hidden2out2_prediction', 'hidden2out_bn2'),
+                          ('hidden2quat1_prediction', 'hidden2quat_bn1'),
+                          ('hidden2quat2_prediction', 'hidden2quat_bn2'),
+                          ('hidden2pos1_prediction', 'hidden2pos_bn1')]
+
+
+def fold_batchnorm(linear, bn):
+    """
+    Linear layer computing bn(linear(x)) with the running statistics of bn.
+    """
+    scale = bn.weight / torch.sqrt(bn.running_var + bn.eps)
+    bias = linear.bias if linear.bias is not None else torch.zeros_like(bn.running_mean)
+    folded = nn.Linear(linear.in_features, linear.out_features)
+    with torch.no_grad():
+        folded.weight.copy_(linear.weight * scale[:, None])
+        folded.bias.copy_((bias - bn.running_mean) * scale + bn.bias)
+    return folded
+
+
+def remove_dropout(module):
+    for name, child in module.named_children():
+        if isinstance(child, nn.Dropout):
+            setattr(module, name, nn.Identity())
+        else:
+            remove_dropout(child)
+
+
+class CastInputs(nn.Module):
+    """
+    Runs a model converted to another dtype on float32 inputs and returns float32 outputs, for forward and step.
+    """
+    def __init__(self, model, dtype):
+        super(CastInputs, self).__init__()
+        self.model = model
+        self.dtype = dtype
+
+    def forward(self, detections, patterns):
+        outputs = self.model(detections.to(self.dtype), patterns.to(self.dtype))
+        if torch.is_tensor(outputs):
+            return outputs.float()
+        return tuple(output.float() for output in outputs)
+
+    def step(self, detections_t, patterns, state=None):
+        quat, pos, state = self.model.step(detections_t.to(self.dtype), patterns.to(self.dtype), state)
+        return quat.float(), pos.float() if pos is not None else None, state
+
+
+def export_for_inference(model, precision='float32', batchnorms=SOT_TRACKER_BATCHNORMS):
+    """
+    Copy of model in eval mode with the batchnorms [(Linear name, BatchNorm name)] folded, without dropout and in the
+    given precision (see PRECISIONS). Pairs whose layers the model does not have are skipped, the BatchNorm layers are
+    replaced by nn.Identity, so forward and step keep working unchanged.
+    """
+    assert precision in PRECISIONS, 'precision has to be one of {}'.format(PRECISIONS)
+    model = copy.deepcopy(model).cpu().float().eval()
+    for linear_name, bn_name in batchnorms:
+        linear = getattr(model, linear_name, None)
+        bn = getattr(model, bn_name, None)
+        if isinstance(linear, nn.Linear) and isinstance(bn, nn.BatchNorm1d):
+            setattr(model, linear_name, fold_batchnorm(linear, bn))
+            setattr(model, bn_name, nn.Identity())
+    remove_dropout(model)
+
+    if precision == 'bfloat16':
+        return CastInputs(model.to(torch.bfloat16), torch.bfloat16).eval()
+    if precision == 'int8':
+        return torch.ao.quantization.quantize_dynamic(model, {nn.Linear, nn.LSTM}, dtype=torch.qint8)
+    return model
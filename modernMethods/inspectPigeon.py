@@ -1,8 +1,9 @@
 import numpy as np
 import pandas as pd
 from vizTracking import visualize_tracking
-from pyquaternion import Quaternion as Quaternion
+from rotations import pose_to_markers, quats_to_rotation_matrices
 import random
+import snippetExtraction
 
 SEQUENCE_LENGTH = 100
 rolling_meadian_window_size = 5
@@ -22,76 +23,18 @@ pattern = np.array([[0, 0, 0],
                     [1, 1, 1],
                     [1, 0, 0],
                     [0, 1, -1]])
-def qrot(q, v):
-    """
-    Rotate vector(s) v about the rotation described by quaternion(s) q.
-    Expects a tensor of shape (*, 4) for q and a tensor of shape (*, 3) for v,
-    where * denotes any number of dimensions.
-    Returns a tensor of shape (*, 3).+
-
-    source: https://github.com/facebookresearch/QuaterNet/blob/master/common/quaternion.py
-    """
-    assert q.shape[-1] == 4
-    assert v.shape[-1] == 3
-    if not q.shape[0] == v.shape[0]:
-        v = np.tile(v, [q.shape[0], 1])
-
-    original_shape = v.shape
-    q = np.reshape(q, [-1, 4])
-    v = np.reshape(v, [-1, 3])
-
-    qvec = q[:, 1:]
-    uv = np.cross(qvec, v, axis=1)
-    uuv = np.cross(qvec, uv, axis=1)
-    return np.reshape((v + 2 * (q[:, :1] * uv + uuv)), original_shape)
-
-
-def get_plausibility_mask(pos):
-    mask = np.ones(len(pos))
-    mask[np.any(np.isnan(pos), axis=1)] = 0
-    mask = mask[:-1]
-    diff = np.linalg.norm(pos[1:, :] - pos[:-1, :], axis=1)
-    mask[diff > 5] = 0
-    inverted_mask = -mask + 1
-    splitpoints = np.nonzero(inverted_mask)[0]
-    return mask, splitpoints
-
-
-def gen_clean_snippets(pos, quat, splitpoints, length):
-    clean_sections_pos = np.split(pos, splitpoints, axis=0)
-    clean_sections_quat = np.split(quat, splitpoints, axis=0)
-    long_sections_pos = [snip[1:, :]  for snip in clean_sections_pos if len(snip) >= length]
-    long_sections_quat = [snip[1:, :]  for snip in clean_sections_quat if len(snip) >= length]
-    clean_snippets_pos = []
-    clean_snippets_quat = []
-    for sec_pos, sec_quat in zip(long_sections_pos, long_sections_quat):
-        l = len(sec_pos)
-        n_snips = int(l/length)
-        if n_snips == 0:
-            continue
-        sec_pos = sec_pos[:n_snips*length, :]
-        clean_snippets_pos += np.split(sec_pos, n_snips, axis=0)
-        sec_quat = sec_quat[:n_snips*length, :]
-        clean_snippets_quat += np.split(sec_quat, n_snips, axis=0)
-    for i, snip in enumerate(clean_snippets_pos):
-        clean_snippets_pos[i] = snip - np.mean(snip, axis=0)
-
-    return clean_snippets_pos, clean_snippets_quat
 
 
-def gen_detections(pos, quat, pattern):
-    rotated_marker1 = qrot(quat, pattern[0, :])
-    rotated_marker2 = qrot(quat, pattern[1, :])
-    rotated_marker3 = qrot(quat, pattern[2, :])
-    rotated_marker4 = qrot(quat, pattern[3, :])
+def gen_clean_snippets(pos, quat, length):
+    # consecutive snippets of the sections without NaN and jumps larger than 5, the positions are centered
+    snippets_pos, [snippets_quat], stats = snippetExtraction.extract_segment_snippets(pos[None], length, max_jump=5,
+                                                                                      arrays=[quat[None]])
+    print('{valid} snippets of {segments} clean sections, {nan} NaN frames, {jump} jumps'.format(**stats))
+    return snippets_pos - np.mean(snippets_pos, axis=1, keepdims=True), snippets_quat
 
-    detections = np.zeros([pos.shape[0], 4, 3])
-    detections[:, 0, :] = rotated_marker1 + pos
-    detections[:, 1, :] = rotated_marker2 + pos
-    detections[:, 2, :] = rotated_marker3 + pos
-    detections[:, 3, :] = rotated_marker4 + pos
 
-    return np.reshape(detections, [-1, 12])
+def gen_detections(pos, quat, pattern):
+    return np.reshape(pose_to_markers(quat, pos, pattern), [-1, 12])
 
 
 def gen_detections_(pos, quat, pattern, length):
@@ -102,18 +45,14 @@ def gen_detections_(pos, quat, pattern, length):
     pos_snip = pos_snip - np.nanmean(pos_snip, axis=0)
     quat_snip = quat[t0:t0 + length, :]
     detections = np.zeros([length, 4, 3])
+    rotation_matrices = quats_to_rotation_matrices(quat_snip)
     for t in range(length):
-        q = Quaternion(quat_snip[t, :])
-        r = q.rotation_matrix
-        rotated_pattern = (r @ pattern.T).T
+        rotated_pattern = (rotation_matrices[t] @ pattern.T).T
         detections[t, :, :] = rotated_pattern + np.expand_dims(pos_snip[t, :], axis=0)
     return detections, pos_snip, quat_snip
 
 
-[mask, split_points] = get_plausibility_mask(pos[:, :])
-#print(mask)
-#print(split_points)
-snippets_pos, snippets_quat = gen_clean_snippets(pos, quat, split_points, SEQUENCE_LENGTH)
+snippets_pos, snippets_quat = gen_clean_snippets(pos, quat, SEQUENCE_LENGTH)
 print(len(snippets_pos))
 
 for i in range(10, 11):
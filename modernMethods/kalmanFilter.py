@@ -0,0 +1,194 @@
+import numpy as np
+
+from rotations import quats_to_rotation_matrices
+
+
+# Python port of the extended Kalman filter of SingleObjectTracking (setupKalman.m, predictKalman.m, correctKalman.m)
+# for the constant acceleration motion model with brownian quaternions. The state of all birds is kept in stacked
+# arrays, predict and correct handle all of them in one call.
+# State: position (3), velocity (3), acceleration (3), quaternion (4) in (w, x, y, z) order.
+# The default noise parameters are the ones of birdsMOTstreamlined.m and ownMOT.m, i.e. for detections in mm.
+
+STATE_DIM = 13
+POS = slice(0, 3)
+VEL = slice(3, 6)
+ACC = slice(6, 9)
+QUAT = slice(9, 13)
+
+DEFAULT_PROCESS_NOISE = {'position': 30.0, 'motion': 10.0, 'acceleration': 1.0, 'quat': 0.2}
+DEFAULT_INITIAL_NOISE = {'position': 5.0, 'motion': 50.0, 'acceleration': 50.0, 'quat': 0.05}
+DEFAULT_MEASUREMENT_NOISE = 50.0
+
+
+def transition_matrix():
+    # position_{t+1} = position_t + velocity_t + 1/2 acceleration_t, velocity_{t+1} = velocity_t + acceleration_t
+    A = np.eye(STATE_DIM)
+    A[POS, VEL] = np.eye(3)
+    A[POS, ACC] = np.eye(3) / 2
+    A[VEL, ACC] = np.eye(3)
+    return A
+
+
+def noise_diagonal(noise):
+    return np.concatenate([np.full(3, noise['position']), np.full(3, noise['motion']),
+                           np.full(3, noise['acceleration']), np.full(4, noise['quat'])])
+
+
+def rotation_quadratic_forms():
+    """
+    Rot(q) of utility/Rot.m is a quadratic form of the unit quaternion, R_ij = q^T C_ij q.
+    Returns C [3 x 3 x 4 x 4] (symmetric in the last two dimensions), found by polarisation.
+    """
+    def unnormalised_rotation(q):
+        w, x, y, z = q
+        return np.array([[w * w + x * x - y * y - z * z, 2 * (x * y - w * z), 2 * (x * z + w * y)],
+                         [2 * (x * y + w * z), w * w - x * x + y * y - z * z, 2 * (y * z - w * x)],
+                         [2 * (x * z - w * y), 2 * (y * z + w * x), w * w - x * x - y * y + z * z]])
+    basis = np.eye(4)
+    C = np.zeros([3, 3, 4, 4])
+    for a in range(4):
+        C[:, :, a, a] = unnormalised_rotation(basis[a])
+        for b in range(a + 1, 4):
+            C[:, :, a, b] = (unnormalised_rotation(basis[a] + basis[b]) - unnormalised_rotation(basis[a])
+                             - unnormalised_rotation(basis[b])) / 2
+            C[:, :, b, a] = C[:, :, a, b]
+    return C
+
+
+def measurement_forms(patterns):
+    """
+    Precomputes the measurement function of every pattern [P x M x 3]: the rotated marker m of pattern p is
+    q^T B[p, m, i] q for the unit quaternion q. Returns B [P x M x 3 x 4 x 4].
+    """
+    return np.einsum('ijab,pmj->pmiab', rotation_quadratic_forms(), patterns)
+
+
+def masked_correction(P, jacobian, residual, visible, measurement_noise):
+    """
+    Batched Kalman update of N filters with the same number of markers M.
+    P: [N x D x D], jacobian: [N x M x 3 x D], residual: [N x M x 3] detections - predicted markers, visible: [N x M]
+    Returns the state update [N x D] and the updated covariance [N x D x D].
+    """
+    N, D = P.shape[:2]
+    # missing markers get zero rows in the Jacobian and the residual and unit noise, which leaves their rows of
+    # the Kalman gain at zero, such that all filters share one measurement size
+    mask = np.repeat(visible, 3, axis=1).astype(np.float64)
+    H = np.reshape(jacobian, [N, -1, D]) * mask[:, :, None]
+    residual = np.reshape(np.where(visible[:, :, None], residual, 0), [N, -1])
+    R_diag = np.where(mask > 0, measurement_noise, 1.0)
+
+    PHt = np.matmul(P, np.swapaxes(H, 1, 2))
+    S = np.matmul(H, PHt) + R_diag[:, :, None] * np.eye(H.shape[1])
+    K = np.swapaxes(np.linalg.solve(S, np.swapaxes(PHt, 1, 2)), 1, 2)
+    P = P - np.matmul(np.matmul(K, H), P)
+    # rounding errors make P asymmetric, which grows from frame to frame unless removed
+    P = (P + np.swapaxes(P, 1, 2)) / 2
+    return np.matmul(K, residual[:, :, None])[:, :, 0], P
+
+
+class ConstAccEKF():
+    """
+    patterns:           [P x M x 3] patterns of all birds, the filters reference them by pattern_idx
+    process_noise:      variances added to position, motion, acceleration and quaternion in every prediction
+    initial_noise:      initial variances of the same state components
+    measurement_noise:  variance of every detection coordinate
+    """
+    def __init__(self, patterns, process_noise=None, initial_noise=None, measurement_noise=DEFAULT_MEASUREMENT_NOISE):
+        self.patterns = np.asarray(patterns, dtype=np.float64)
+        self.n_markers = self.patterns.shape[1]
+        self.forms = measurement_forms(self.patterns)
+        self.A = transition_matrix()
+        self.Q = np.diag(noise_diagonal(process_noise if process_noise is not None else DEFAULT_PROCESS_NOISE))
+        self.P0 = np.diag(noise_diagonal(initial_noise if initial_noise is not None else DEFAULT_INITIAL_NOISE))
+        self.measurement_noise = measurement_noise
+        self.pattern_idx = np.zeros([0], dtype=np.int64)
+        self.x = np.zeros([0, STATE_DIM])
+        self.P = np.zeros([0, STATE_DIM, STATE_DIM])
+
+    def initialize(self, pattern_idx, pos, quats):
+        """
+        Adds filters with zero velocity and acceleration. pattern_idx: [N], pos: [N x 3], quats: [N x 4]
+        """
+        x = np.zeros([len(pattern_idx), STATE_DIM])
+        x[:, POS] = pos
+        x[:, QUAT] = quats
+        self.pattern_idx = np.concatenate([self.pattern_idx, pattern_idx])
+        self.x = np.concatenate([self.x, x], axis=0)
+        self.P = np.concatenate([self.P, np.tile(self.P0, [len(pattern_idx), 1, 1])], axis=0)
+
+    def remove(self, keep):
+        # keep: boolean mask or indices of the filters that stay
+        self.pattern_idx = self.pattern_idx[keep]
+        self.x = self.x[keep]
+        self.P = self.P[keep]
+
+    def predict(self):
+        self.x = np.matmul(self.x, self.A.T)
+        self.P = np.matmul(np.matmul(self.A, self.P), self.A.T) + self.Q
+
+    def measure(self):
+        """
+        Predicted marker positions [N x M x 3] and the Jacobian of the measurement function [N x M x 3 x STATE_DIM].
+        """
+        q = self.x[:, QUAT]
+        q_norm = np.linalg.norm(q, axis=1)
+        q_unit = q / q_norm[:, None]
+        forms = self.forms[self.pattern_idx]
+        # d (q^T B q) / dq = 2 B q for unit q, the chain rule through q / |q| projects out the radial direction
+        B_q = np.matmul(forms, q_unit[:, None, None, :, None])[..., 0]
+        markers = np.einsum('nmia,na->nmi', B_q, q_unit) + self.x[:, None, POS]
+        projection = (np.eye(4) - q_unit[:, :, None] * q_unit[:, None, :]) / q_norm[:, None, None]
+        jacobian = np.zeros(markers.shape + (STATE_DIM,))
+        jacobian[..., POS] = np.eye(3)
+        jacobian[..., QUAT] = 2 * np.matmul(B_q, projection[:, None, :, :])
+        return markers, jacobian
+
+    def correct(self, detections, visible):
+        """
+        detections: [N x M x 3] detections in marker order (see linearAssignment for finding the order)
+        visible:    [N x M] markers that were detected, the others do not contribute to the update
+        """
+        markers, jacobian = self.measure()
+        update, self.P = masked_correction(self.P, jacobian, detections - markers, visible, self.measurement_noise)
+        self.x = self.x + update
+        self.normalize_quaternions()
+
+    def normalize_quaternions(self):
+        # The measurements do not depend on the norm of the quaternion, left alone it drifts towards zero, where the
+        # linearisation breaks down (correctKalman.m does not normalise). The covariance is transformed with the
+        # Jacobian of q / |q|, which removes its radial part.
+        q = self.x[:, QUAT]
+        q_norm = np.linalg.norm(q, axis=1)
+        q_unit = q / q_norm[:, None]
+        J = np.tile(np.eye(STATE_DIM), [len(q), 1, 1])
+        J[:, QUAT, QUAT] = (np.eye(4) - q_unit[:, :, None] * q_unit[:, None, :]) / q_norm[:, None, None]
+        self.x[:, QUAT] = q_unit
+        self.P = np.matmul(np.matmul(J, self.P), np.swapaxes(J, 1, 2))
+
+    @property
+    def pos(self):
+        return self.x[:, POS]
+
+    @property
+    def quats(self):
+        return self.x[:, QUAT] / np.linalg.norm(self.x[:, QUAT], axis=1, keepdims=True)
+
+
+def run_kalman(detections, visible, patterns, pattern_idx, init_pos, init_quats, **noise):
+    """
+    Filters N sequences at once.
+    detections: [T x N x M x 3] in marker order, visible: [T x N x M]
+    patterns: [P x M x 3], pattern_idx: [N], init_pos: [N x 3], init_quats: [N x 4] state before the first frame
+    Returns the filtered positions [T x N x 3], quaternions [T x N x 4] and rotation matrices [T x N x 3 x 3].
+    """
+    T, N = detections.shape[:2]
+    kf = ConstAccEKF(patterns, **noise)
+    kf.initialize(pattern_idx, init_pos, init_quats)
+    positions = np.zeros([T, N, 3])
+    quats = np.zeros([T, N, 4])
+    for t in range(T):
+        kf.predict()
+        kf.correct(detections[t], visible[t])
+        positions[t] = kf.pos
+        quats[t] = kf.quats
+    return positions, quats, quats_to_rotation_matrices(quats)
@@ -0,0 +1,201 @@
+import numpy as np
+
+from kalmanFilter import DEFAULT_PROCESS_NOISE, DEFAULT_INITIAL_NOISE, DEFAULT_MEASUREMENT_NOISE, masked_correction
+from rotations import pose_to_markers
+
+
+# Python port of the Lie group EKF of LieGroupEKFSE3ConstAcc (LGEKF.m, expSE3ACvec.m, JacOfFonSE3CA.m, Ad.m,
+# HLinSE3AC.m) on SE(3) x R^3 x R^3 with the constant acceleration motion model, see
+# https://hal.archives-ouvertes.fr/hal-00903252/document. The exponential map, adjoint and Jacobians take arrays with
+# any leading shape, e.g. [N] birds or [T x N] frames, and the filter runs all birds in one call like kalmanFilter.
+# Tangent vectors are ordered like in the MATLAB code: rotation (3), translation (3), velocity (3), acceleration (3).
+
+TANGENT_DIM = 12
+ROT = slice(0, 3)
+TRANS = slice(3, 6)
+VEL = slice(6, 9)
+ACC = slice(9, 12)
+
+
+def so3_hat(phi):
+    # vecToSO3Algebra.m, [... x 3] -> [... x 3 x 3]
+    zero = np.zeros_like(phi[..., 0])
+    return np.stack([np.stack([zero, -phi[..., 2], phi[..., 1]], axis=-1),
+                     np.stack([phi[..., 2], zero, -phi[..., 0]], axis=-1),
+                     np.stack([-phi[..., 1], phi[..., 0], zero], axis=-1)], axis=-2)
+
+
+def exp_se3(xi):
+    """
+    expSE3vec.m for [... x 6] vectors (rotation, translation), returns [... x 4 x 4].
+    Rodrigues' formula with Taylor expansions of its coefficients for small angles.
+    """
+    phi = xi[..., :3]
+    theta_sq = np.sum(phi ** 2, axis=-1)
+    theta = np.sqrt(theta_sq)
+    is_small = theta < 1e-4
+    safe_theta = np.where(is_small, 1.0, theta)
+    safe_theta_sq = safe_theta ** 2
+    a = np.where(is_small, 1 - theta_sq / 6, np.sin(safe_theta) / safe_theta)
+    b = np.where(is_small, 0.5 - theta_sq / 24, (1 - np.cos(safe_theta)) / safe_theta_sq)
+    c = np.where(is_small, 1.0 / 6 - theta_sq / 120, (1 - a) / safe_theta_sq)
+
+    W = so3_hat(phi)
+    W_sq = np.matmul(W, W)
+    eye = np.eye(3)
+    R = eye + a[..., None, None] * W + b[..., None, None] * W_sq
+    V = eye + b[..., None, None] * W + c[..., None, None] * W_sq
+
+    X = np.zeros(xi.shape[:-1] + (4, 4))
+    X[..., :3, :3] = R
+    X[..., :3, 3] = np.matmul(V, xi[..., 3:6, None])[..., 0]
+    X[..., 3, 3] = 1
+    return X
+
+
+def exp_se3_ca(s):
+    # expSE3ACvec.m for [... x 12] vectors, returns the pose [... x 4 x 4], velocity and acceleration [... x 3]
+    return exp_se3(s[..., :6]), s[..., VEL], s[..., ACC]
+
+
+def adjoint(X):
+    """
+    Ad.m for the constant acceleration model, [... x 4 x 4] -> [... x 12 x 12]: the adjoint of SE(3) in the
+    (rotation, translation) order of the tangent vectors and the identity for velocity and acceleration.
+    """
+    R = X[..., :3, :3]
+    res = np.zeros(X.shape[:-2] + (TANGENT_DIM, TANGENT_DIM))
+    res[..., ROT, ROT] = R
+    res[..., TRANS, ROT] = np.matmul(so3_hat(X[..., :3, 3]), R)
+    res[..., TRANS, TRANS] = R
+    res[..., 6:, 6:] = np.eye(6)
+    return res
+
+
+def state_transition(v, a):
+    # stateTrans.m: the rotation stays (brownian motion), the position moves by v + a/2 in the body frame, v by a
+    s = np.zeros(v.shape[:-1] + (TANGENT_DIM,))
+    s[..., TRANS] = v + a / 2
+    s[..., VEL] = a
+    return s
+
+
+def transition_jacobian(v, a):
+    # JacOfFonSE3CA.m, [... x 3] velocities and accelerations -> [... x 12 x 12]
+    F = adjoint(exp_se3(-state_transition(v, a)[..., :6]))
+    F[..., TRANS, VEL] += np.eye(3)
+    F[..., TRANS, ACC] += np.eye(3) / 2
+    F[..., VEL, ACC] += np.eye(3)
+    return F
+
+
+def measurement_jacobian(X, patterns):
+    """
+    HLinSE3AC.m without the row of the homogeneous coordinate: derivative of the markers X exp(e) m at e = 0.
+    X: [... x 4 x 4], patterns: [... x M x 3] -> [... x M x 3 x 12]
+    """
+    R = X[..., None, :3, :3]
+    jacobian = np.zeros(patterns.shape + (TANGENT_DIM,))
+    jacobian[..., ROT] = -np.matmul(R, so3_hat(patterns))
+    jacobian[..., TRANS] = R
+    return jacobian
+
+
+def noise_diagonal(noise):
+    return np.repeat([noise['quat'], noise['position'], noise['motion'], noise['acceleration']], 3)
+
+
+class LieGroupEKF():
+    """
+    patterns:           [P x M x 3] patterns of all birds, the filters reference them by pattern_idx
+    process_noise:      variances added to rotation ('quat'), position, motion and acceleration in every prediction
+    initial_noise:      initial variances of the same state components
+    measurement_noise:  variance of every detection coordinate
+    The defaults are the ones of kalmanFilter (birdsMOTstreamlined.m and ownMOT.m), i.e. for detections in mm.
+    """
+    def __init__(self, patterns, process_noise=None, initial_noise=None, measurement_noise=DEFAULT_MEASUREMENT_NOISE):
+        self.patterns = np.asarray(patterns, dtype=np.float64)
+        self.Q = np.diag(noise_diagonal(process_noise if process_noise is not None else DEFAULT_PROCESS_NOISE))
+        self.P0 = np.diag(noise_diagonal(initial_noise if initial_noise is not None else DEFAULT_INITIAL_NOISE))
+        self.measurement_noise = measurement_noise
+        self.pattern_idx = np.zeros([0], dtype=np.int64)
+        self.X = np.zeros([0, 4, 4])
+        self.v = np.zeros([0, 3])
+        self.a = np.zeros([0, 3])
+        self.P = np.zeros([0, TANGENT_DIM, TANGENT_DIM])
+
+    def initialize(self, pattern_idx, pos, rotations):
+        """
+        Adds filters with zero velocity and acceleration, like createLGEKFtrack.m.
+        pattern_idx: [N], pos: [N x 3], rotations: [N x 3 x 3]
+        """
+        N = len(pattern_idx)
+        X = np.tile(np.eye(4), [N, 1, 1])
+        X[:, :3, :3] = rotations
+        X[:, :3, 3] = pos
+        self.pattern_idx = np.concatenate([self.pattern_idx, pattern_idx])
+        self.X = np.concatenate([self.X, X], axis=0)
+        self.v = np.concatenate([self.v, np.zeros([N, 3])], axis=0)
+        self.a = np.concatenate([self.a, np.zeros([N, 3])], axis=0)
+        self.P = np.concatenate([self.P, np.tile(self.P0, [N, 1, 1])], axis=0)
+
+    def remove(self, keep):
+        # keep: boolean mask or indices of the filters that stay
+        self.pattern_idx = self.pattern_idx[keep]
+        self.X = self.X[keep]
+        self.v = self.v[keep]
+        self.a = self.a[keep]
+        self.P = self.P[keep]
+
+    def compose(self, s):
+        # comp.m with expSE3ACvec(s) for tangent vectors s [N x 12]
+        X, v, a = exp_se3_ca(s)
+        self.X = np.matmul(self.X, X)
+        self.v = self.v + v
+        self.a = self.a + a
+
+    def predict(self):
+        F = transition_jacobian(self.v, self.a)
+        self.compose(state_transition(self.v, self.a))
+        self.P = np.matmul(np.matmul(F, self.P), np.swapaxes(F, 1, 2)) + self.Q
+
+    def measure(self):
+        # predicted marker positions [N x M x 3] and the measurement Jacobian [N x M x 3 x 12]
+        patterns = self.patterns[self.pattern_idx]
+        return pose_to_markers(self.rotations, self.pos, patterns), measurement_jacobian(self.X, patterns)
+
+    def correct(self, detections, visible):
+        """
+        detections: [N x M x 3] detections in marker order, visible: [N x M] markers that were detected
+        """
+        markers, jacobian = self.measure()
+        update, self.P = masked_correction(self.P, jacobian, detections - markers, visible, self.measurement_noise)
+        self.compose(update)
+
+    @property
+    def pos(self):
+        return self.X[:, :3, 3]
+
+    @property
+    def rotations(self):
+        return self.X[:, :3, :3]
+
+
+def run_lie_group_kalman(detections, visible, patterns, pattern_idx, init_pos, init_rotations, **noise):
+    """
+    Filters N sequences at once, see kalmanFilter.run_kalman.
+    detections: [T x N x M x 3] in marker order, visible: [T x N x M]
+    patterns: [P x M x 3], pattern_idx: [N], init_pos: [N x 3], init_rotations: [N x 3 x 3] state before the first frame
+    Returns the filtered positions [T x N x 3] and rotation matrices [T x N x 3 x 3].
+    """
+    T, N = detections.shape[:2]
+    kf = LieGroupEKF(patterns, **noise)
+    kf.initialize(pattern_idx, init_pos, init_rotations)
+    positions = np.zeros([T, N, 3])
+    rotations = np.zeros([T, N, 3, 3])
+    for t in range(T):
+        kf.predict()
+        kf.correct(detections[t], visible[t])
+        positions[t] = kf.pos
+        rotations[t] = kf.rotations
+    return positions, rotations
@@ -0,0 +1,207 @@
+from functools import lru_cache
+from itertools import permutations, product
+from math import comb, perm
+
+import numpy as np
+from scipy.optimize import linear_sum_assignment
+from scipy.sparse import coo_matrix, csgraph
+from scipy.spatial import cKDTree
+
+
+# Linear assignment for the Python tracking code (utility/munkers.m and patterns/match_patterns.m on the MATLAB side).
+# Many small problems, like 4 markers x up to 6 detections of hundreds of birds and frames, are solved together by
+# scoring every possible assignment at once. Larger problems with few plausible pairs, like all predicted markers of
+# all tracks x all detections of a frame, are gated first and split into independent components.
+
+
+@lru_cache(maxsize=None)
+def assignment_candidates(n_rows, n_cols, allow_unassigned):
+    """
+    All assignments of n_rows rows to distinct columns as [M x n_rows] column indices, -1 for unassigned rows if
+    allow_unassigned.
+    """
+    if not allow_unassigned:
+        return np.array(list(permutations(range(n_cols), n_rows)), dtype=np.int64).reshape([-1, n_rows])
+    candidates = [c for c in product(range(-1, n_cols), repeat=n_rows)
+                  if len(set(i for i in c if i >= 0)) == sum(i >= 0 for i in c)]
+    return np.array(candidates, dtype=np.int64).reshape([-1, n_rows])
+
+
+def n_assignments(n_rows, n_cols, allow_unassigned):
+    if not allow_unassigned:
+        return perm(n_cols, n_rows)
+    return sum(comb(n_rows, k) * perm(n_cols, k) for k in range(min(n_rows, n_cols) + 1))
+
+
+def batched_linear_assignment(cost, cost_of_non_assignment=None, max_candidates=None, chunk_size=None):
+    """
+    Solves B small assignment problems at once.
+    cost:                       [B x R x C], infeasible pairs (e.g. padding) are inf or NaN
+    cost_of_non_assignment:     cost of leaving a row unassigned (like costOfNonAssignment in ownMOT.m, but unassigned
+                                columns are free), None assigns as many rows as possible
+    Returns the column of every row [B x R] (-1 for unassigned rows) and the total cost [B].
+    Problems with more than max_candidates possible assignments are solved one by one with scipy. On the CPU scipy is
+    faster from about 100 candidates on (4 x 4 has 24 candidates, 4 x 5 has 120 and 4 x 6 has 360), with non
+    assignment costs the augmented scipy problems are slower and the batched solve wins up to about 2000 candidates
+    (4 x 6 with unassigned rows has 1045).
+    """
+    cost = np.where(np.isnan(cost), np.inf, np.asarray(cost, dtype=np.float64))
+    B, R, C = cost.shape
+    transposed = cost_of_non_assignment is None and R > C
+    if transposed:
+        cost = np.swapaxes(cost, 1, 2)
+        B, R, C = cost.shape
+
+    allow_unassigned = cost_of_non_assignment is not None
+    if max_candidates is None:
+        max_candidates = 2000 if allow_unassigned else 60
+    if n_assignments(R, C, allow_unassigned) > max_candidates:
+        assignment, total = _assignment_loop(cost, cost_of_non_assignment)
+    else:
+        candidates = assignment_candidates(R, C, allow_unassigned)
+        # unassigned rows pick the extra column C that holds the cost of non assignment, infeasible pairs count as a
+        # large finite cost such that the number of infeasible pairs is minimised first
+        large = 1e6 * (np.max(np.abs(cost[np.isfinite(cost)]), initial=1.0) + 1)
+        padded = np.concatenate([np.where(np.isfinite(cost), cost, large),
+                                 np.full([B, R, 1], cost_of_non_assignment if allow_unassigned else large)], axis=2)
+        if chunk_size is None:
+            chunk_size = max(1, 2 ** 22 // len(candidates))
+        best = np.zeros(B, dtype=np.int64)
+        for start in range(0, B, chunk_size):
+            chunk = padded[start:start + chunk_size]
+            # [b x M] cost of every candidate, one gather per row
+            totals = np.take(chunk[:, 0, :], candidates[:, 0], axis=1)
+            for r in range(1, R):
+                totals += np.take(chunk[:, r, :], candidates[:, r], axis=1)
+            best[start:start + chunk_size] = np.argmin(totals, axis=1)
+        assignment = candidates[best]
+        chosen = np.take_along_axis(padded, np.expand_dims(np.where(assignment >= 0, assignment, C), 2),
+                                    axis=2)[:, :, 0]
+        assignment = np.where(chosen >= large, -1, assignment)
+        total = np.sum(np.where(assignment >= 0, chosen, 0 if not allow_unassigned else cost_of_non_assignment), axis=1)
+
+    if transposed:
+        assignment = _invert_assignment(assignment, C)
+    return assignment, total
+
+
+def _assignment_loop(cost, cost_of_non_assignment):
+    B, R, C = cost.shape
+    assignment = -np.ones([B, R], dtype=np.int64)
+    for b in range(B):
+        rows, cols = solve_dense(cost[b], cost_of_non_assignment)
+        assignment[b, rows] = cols
+    chosen = np.take_along_axis(cost, np.expand_dims(np.maximum(assignment, 0), 2), axis=2)[:, :, 0]
+    unassigned_cost = 0 if cost_of_non_assignment is None else cost_of_non_assignment
+    return assignment, np.sum(np.where(assignment >= 0, chosen, unassigned_cost), axis=1)
+
+
+def _invert_assignment(assignment, n_rows):
+    # assignment of the transposed problem [B x C] -> [B x R]
+    B = assignment.shape[0]
+    inverted = -np.ones([B, n_rows], dtype=np.int64)
+    batch_idx, col_idx = np.nonzero(assignment >= 0)
+    inverted[batch_idx, assignment[batch_idx, col_idx]] = col_idx
+    return inverted
+
+
+def solve_dense(cost, cost_of_non_assignment=None):
+    """
+    Single assignment problem [R x C] with scipy, inf marks infeasible pairs.
+    Returns the assigned rows and columns.
+    """
+    finite = np.isfinite(cost)
+    if cost_of_non_assignment is None and np.all(finite):
+        return linear_sum_assignment(cost)
+    if not np.any(finite):
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    large = 1e6 * (np.max(np.abs(cost[finite])) + 1)
+    if cost_of_non_assignment is None:
+        rows, cols = linear_sum_assignment(np.where(finite, cost, large))
+    else:
+        # one dummy column per row holding the cost of non assignment, unassigned columns are free
+        R, C = cost.shape
+        augmented = np.full([R, C + R], large)
+        augmented[:, :C] = np.where(finite, cost, large)
+        augmented[np.arange(R), C + np.arange(R)] = cost_of_non_assignment
+        rows, cols = linear_sum_assignment(augmented)
+        is_real = np.logical_and(rows < R, cols < C)
+        rows, cols = rows[is_real], cols[is_real]
+    is_feasible = finite[rows, cols]
+    return rows[is_feasible], cols[is_feasible]
+
+
+def gated_cost(points_a, points_b, gate):
+    """
+    Sparse matrix [len(points_a) x len(points_b)] holding the distances of all pairs closer than gate.
+    """
+    pairs = cKDTree(points_a).sparse_distance_matrix(cKDTree(points_b), gate, output_type='ndarray')
+    # built from the pairs directly, a coo_matrix output would drop pairs at distance 0
+    return coo_matrix((pairs['v'], (pairs['i'], pairs['j'])), shape=[len(points_a), len(points_b)])
+
+
+def sparse_linear_assignment(cost, cost_of_non_assignment=None):
+    """
+    Assignment problem with a sparse cost matrix (scipy.sparse, e.g. from gated_cost), pairs that are not stored are
+    infeasible. The rows and columns are split into connected components, pairs that are the only option of both
+    their row and column are assigned directly, the remaining components are solved one by one.
+    Returns the assigned rows and columns.
+    """
+    cost = coo_matrix(cost)
+    n_rows, n_cols = cost.shape
+    # explicit zeros are feasible pairs as well
+    rows, cols, values = cost.row, cost.col, cost.data
+    if len(values) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+    # bipartite graph with the rows as nodes 0..n_rows-1 and the columns as n_rows..n_rows+n_cols-1
+    graph = coo_matrix((np.ones(len(rows)), (rows, n_rows + cols)), shape=[n_rows + n_cols] * 2)
+    _, labels = csgraph.connected_components(graph, directed=False)
+    pair_component = labels[rows]
+
+    pairs_per_component = np.bincount(pair_component)
+    is_single = pairs_per_component[pair_component] == 1
+    if cost_of_non_assignment is not None:
+        is_single = np.logical_and(is_single, values < cost_of_non_assignment)
+    assigned_rows = [rows[is_single]]
+    assigned_cols = [cols[is_single]]
+
+    remaining = np.nonzero(np.logical_not(is_single))[0]
+    order = remaining[np.argsort(pair_component[remaining], kind='stable')]
+    boundaries = np.nonzero(np.diff(pair_component[order]))[0] + 1
+    for component in np.split(order, boundaries):
+        if len(component) == 0:
+            continue
+        component_rows, row_idx = np.unique(rows[component], return_inverse=True)
+        component_cols, col_idx = np.unique(cols[component], return_inverse=True)
+        dense = np.full([len(component_rows), len(component_cols)], np.inf)
+        dense[row_idx, col_idx] = values[component]
+        r, c = solve_dense(dense, cost_of_non_assignment)
+        assigned_rows.append(component_rows[r])
+        assigned_cols.append(component_cols[c])
+    return np.concatenate(assigned_rows), np.concatenate(assigned_cols)
+
+
+def label_detections(markers, detections, is_missing=None, max_distance=None):
+    """
+    Ground truth marker identities for detections, e.g. to build marker_ids for the X_shuffled sequences.
+    markers:        [... x 4 x 3] true marker positions
+    detections:     [... x K x 3] detections (K = 4, or 6 with false positives)
+    is_missing:     [... x K] empty detection slots, never labelled
+    max_distance:   detections further away from every marker stay unlabelled, None labels as many as possible
+    Returns the marker index of every detection [... x K], n_markers for false positives and missing detections.
+    """
+    batch_shape = markers.shape[:-2]
+    n_markers = markers.shape[-2]
+    markers = np.reshape(markers, [-1, n_markers, 3])
+    detections = np.reshape(detections, [-1, detections.shape[-2], 3])
+    cost = np.linalg.norm(markers[:, :, None, :] - detections[:, None, :, :], axis=3)
+    if is_missing is not None:
+        cost[np.broadcast_to(np.reshape(is_missing, [-1, 1, detections.shape[1]]), cost.shape)] = np.inf
+    # markers further than max_distance from every detection are cheaper to leave unassigned
+    assignment, _ = batched_linear_assignment(cost, max_distance)
+
+    labels = np.full(detections.shape[:2], n_markers, dtype=np.int64)
+    batch_idx, marker_idx = np.nonzero(assignment >= 0)
+    labels[batch_idx, assignment[batch_idx, marker_idx]] = marker_idx
+    return np.reshape(labels, list(batch_shape) + [detections.shape[1]])
@@ -3,7 +3,7 @@ import torch.nn as nn
 import torch.nn.functional as F
 import torch.optim as optim
 
-from pyquaternion import Quaternion as Quaternion
+from rotations import qrot, quats_to_rotation_matrices
 
 #from torchsummary import summary
 import numpy as np
@@ -114,12 +114,11 @@ def add_markers_to_trajectories(trajectory, quats, pattern):
     N = np.shape(trajectory)[1]
 
     detections = np.zeros([T, N, 12])
+    rotation_matrices = quats_to_rotation_matrices(quats)
     for t in range(T):
         for n in range(N):
-            quat = Quaternion(quats[t,n,:])
-            rot_mat = quat.rotation_matrix
             np.random.shuffle(pattern)
-            rotated_pattern = np.dot(rot_mat, pattern.T).T
+            rotated_pattern = np.dot(rotation_matrices[t, n], pattern.T).T
             det = np.reshape(rotated_pattern + trajectory[t, n], -1)
             detections[t, n, :] = det
 
@@ -163,63 +162,9 @@ def complete_gen(pattern, train_size, test_size, both):
         return X_test, Y_pos_test, Y_quat_test, Y_marker_test
 
 
-#TODO compare speed of qrot and stack, with rotation matrix
-# qrot is probably better
-def qrot(q, v):
-    #TODO can I change this function to also work with constant v and changing quaternions?
-    # if not just tile/stack v accordingly
-    """
-    Rotate vector(s) v about the rotation described by quaternion(s) q.
-    Expects a tensor of shape (*, 4) for q and a tensor of shape (*, 3) for v,
-    where * denotes any number of dimensions.
-    Returns a tensor of shape (*, 3).+
-
-    source: https://github.com/facebookresearch/QuaterNet/blob/master/common/quaternion.py
-    """
-    assert q.shape[-1] == 4
-    assert v.shape[-1] == 3
-    assert q.shape[:-1] == v.shape[:-1]
-
-    original_shape = list(v.shape)
-    q = q.view(-1, 4)
-    v = v.view(-1, 3)
-
-    qvec = q[:, 1:]
-    uv = torch.cross(qvec, v, dim=1)
-    uuv = torch.cross(qvec, uv, dim=1)
-    return (v + 2 * (q[:, :1] * uv + uuv)).view(original_shape)
-
-
-def quat2mat(q):
-    """
-    Takes tensors with quaternions in last dimension, i.e. q has shape (*,4),
-        where * can be any positive number of dimensions.
-
-    Original code from: https://github.com/ClementPinard/SfmLearner-Pytorch/blob/master/inverse_warp.py
-    """
-
-    original_shape = list(q.shape)
-    q = q.view(-1, 4)
-
-    w = q[:, 0]
-    x = q[:, 1]
-    y = q[:, 2]
-    z = q[:, 3]
-
-    w2, x2, y2, z2 = w.pow(2), x.pow(2), y.pow(2), z.pow(2)
-    wx, wy, wz = w*x, w*y, w*z
-    xy, xz, yz = x*y, x*z, y*z
-
-    rotMats = torch.stack([w2 + x2 - y2 - z2, 2*xy - 2*wz, 2*wy + 2*xz,
-                          2*wz + 2*xy, w2 - x2 + y2 - z2, 2*yz - 2*wx,
-                          2*xz - 2*wy, 2*wx + 2*yz, w2 - x2 - y2 + z2], dim=1)
-    rotMats = rotMats.view(original_shape[:-1]+ [9])
-    rotMats = rotMats.view(original_shape[:-1]+ [3, 3])
-    return rotMats
-
-
 def quat_rot(q, v):
-    return torch.matmul(quat2mat(q), torch.from_numpy(v.T).float()).permute([0, 1, 3, 2])
+    # q: [T x N x 4], v: pattern [4 x 3] -> [T x N x 4 x 3]
+    return qrot(q.unsqueeze(2), torch.from_numpy(v).float())
 
 class LSTMTracker(nn.Module):
 
@@ -0,0 +1,297 @@
+import time
+from itertools import permutations
+
+import numpy as np
+import torch
+from scipy import io
+
+import linearAssignment
+import trackerModels
+import viconData
+from rotations import rotation_from_6d, pose_to_markers
+from umeyama import umeyama
+
+
+# Python counterpart of MultipleObjectTracking/ownMOT.m built around the learned single object trackers. All live
+# tracks go through one batched model.step() per frame (see trackerModels.SOTTracker.step), detections are matched
+# to the predicted markers of all tracks in one gated assignment, tracks are born by fitting the patterns of untracked
+# birds to unassigned detections and die after they have not been seen for a while.
+# Distances are in the units of the patterns, cm for posQuatPrediction.load_patterns.
+
+
+def load_unlabeled_detections(file_name):
+    """
+    Reads D_unlabeled.mat (T rows of x, y, z triples with NaN for empty columns) and returns the detections as
+    [T x maxDetectionsPerFrame x 3], the same layout as D in ownMOT.m. The detections of each frame are moved to the
+    front, the remaining entries are NaN.
+    """
+    raw = io.loadmat(file_name)['D_unlabeled']
+    detections = np.reshape(raw, [raw.shape[0], -1, 3])
+    is_valid = np.logical_not(np.any(np.isnan(detections), axis=2))
+    order = np.argsort(np.logical_not(is_valid), axis=1, kind='stable')
+    detections = np.take_along_axis(detections, np.expand_dims(order, axis=2), axis=1)
+    max_detections = np.max(np.sum(is_valid, axis=1))
+    return detections[:, :max_detections, :]
+
+
+def load_vicon_csv(file_name):
+    """
+    Reads a VICON export like datasets/20190124_10BirdsWeightTrials05_testdata.csv.
+    Returns the positions [K x T x 3] and quaternions [K x T x 4] in (w, x, y, z) order, NaN where a bird is missing,
+    the same layout as vizTracking.load_corrected_vicon.
+    """
+    arrays, _ = viconData.read_vicon_csv(file_name)
+    return arrays['pos'], arrays['quats']
+
+
+def fit_pattern(detections, pattern):
+    """
+    Finds the pose of a pattern [4 x 3] that explains 3 or 4 detections [M x 3] with unknown marker identities.
+    All assignments of the detections to markers are solved in one batched umeyama.
+    Returns R, t, the mean distance of the detections to the fitted markers and the marker index of every detection.
+    """
+    candidates = np.array(list(permutations(range(len(pattern)), len(detections))))
+    R, t, error = umeyama(pattern[candidates], np.tile(detections[None], [len(candidates), 1, 1]))
+    best = np.argmin(error)
+    return R[best], t[best], error[best], candidates[best]
+
+
+def index_state(state, idx):
+    # selects sequences of a model.step() state, every tensor has the sequences in dim 1
+    if state is None:
+        return None
+    if isinstance(state, tuple):
+        return tuple(index_state(s, idx) for s in state)
+    return state[:, idx]
+
+
+def cat_states(state_a, state_b):
+    if state_a is None:
+        return None
+    if isinstance(state_a, tuple):
+        return tuple(cat_states(a, b) for a, b in zip(state_a, state_b))
+    return torch.cat([state_a, state_b], dim=1)
+
+
+class MultiObjectTracker():
+    """
+    model:                  learned tracker with step(detections_t, patterns, state), e.g. SOTTracker in eval mode
+    patterns:               [P x 4 x 3] one pattern per bird of the recording
+    gate_radius:            detections closer to the predicted position of a track do not start new tracks
+    max_marker_distance:    largest distance between a detection and the predicted marker it is matched to
+    birth_error:            largest mean marker distance of a pattern fit that starts a new track
+    min_birth_detections:   number of detections a new track needs (3 or 4, fits to 3 detections are ambiguous)
+    max_invisible_frames:   tracks without any detection for longer are deleted
+    The detection layout of the model input (missing flags, false positive slots) is taken from the model.
+    """
+    def __init__(self, model, patterns, gate_radius=15.0, max_marker_distance=3.0, birth_error=0.5,
+                 min_birth_detections=4, max_invisible_frames=10, device=None):
+        if not trackerModels.can_stream(model):
+            raise ValueError('{} has no step(), frame by frame tracking needs a tracker like trackerModels.SOTTracker'
+                             .format(type(model).__name__))
+        self.model = model
+        self.patterns = np.asarray(patterns, dtype=np.float64)
+        self.n_markers = self.patterns.shape[1]
+        self.gate_radius = gate_radius
+        self.max_marker_distance = max_marker_distance
+        self.birth_error = birth_error
+        self.min_birth_detections = min_birth_detections
+        self.max_invisible_frames = max_invisible_frames
+        self.with_missing_flag, self.n_false_positive_slots = trackerModels.input_layout(model)
+        self.device = device if device is not None else next(model.parameters()).device
+        self.patterns_torch = torch.from_numpy(self.patterns).float().to(self.device)
+        # birth candidates are collected within the largest marker distance of any pattern
+        self.birth_radius = np.max(np.linalg.norm(self.patterns[:, :, None, :] - self.patterns[:, None, :, :],
+                                                  axis=3)) + max_marker_distance
+        self.reset()
+
+    def reset(self):
+        self.pattern_idx = np.zeros([0], dtype=np.int64)
+        self.pos = np.zeros([0, 3])
+        self.velocity = np.zeros([0, 3])
+        self.rot = np.zeros([0, 3, 3])
+        self.age = np.zeros([0], dtype=np.int64)
+        self.invisible_count = np.zeros([0], dtype=np.int64)
+        self.state = None
+
+    @property
+    def n_tracks(self):
+        return len(self.pattern_idx)
+
+    def initialize(self, pattern_idx, pos, rot):
+        """
+        Starts tracks from known poses, e.g. the first VICON frame (useVICONinit in ownMOT.m).
+        pattern_idx: [K], pos: [K x 3], rot: [K x 3 x 3]
+        """
+        markers = pose_to_markers(rot, pos, self.patterns[pattern_idx])
+        self.add_tracks(np.asarray(pattern_idx), pos, rot, markers, np.ones([len(pattern_idx), self.n_markers], bool))
+
+    def predict(self):
+        # constant velocity prediction of the positions, the orientation is kept
+        return self.pos + self.velocity
+
+    def predicted_markers(self, pos):
+        return pose_to_markers(self.rot, pos, self.patterns[self.pattern_idx])
+
+    def gate(self, detections, pos):
+        """
+        Detections within gate_radius of the predicted position of a track [D], they cannot start new tracks.
+        """
+        if self.n_tracks == 0 or len(detections) == 0:
+            return np.zeros(len(detections), dtype=bool)
+        distances = np.linalg.norm(detections[:, None, :] - pos[None, :, :], axis=2)
+        return np.min(distances, axis=1) < self.gate_radius
+
+    def match_markers(self, detections, markers):
+        """
+        Matches the detections to the predicted markers of all tracks [K x 4 x 3] in one gated assignment, only pairs
+        closer than max_marker_distance are considered (detectionToTrackAssignment in ownMOT.m).
+        Returns the matched detections [K x 4 x 3] (in marker order) and which markers were matched [K x 4].
+        """
+        matched = np.zeros([self.n_tracks, self.n_markers, 3])
+        is_matched = np.zeros([self.n_tracks, self.n_markers], dtype=bool)
+        if len(detections) == 0:
+            return matched, is_matched
+        cost = linearAssignment.gated_cost(np.reshape(markers, [-1, 3]), detections, self.max_marker_distance)
+        marker_rows, det_cols = linearAssignment.sparse_linear_assignment(cost)
+        track_idx, marker_idx = np.divmod(marker_rows, self.n_markers)
+        matched[track_idx, marker_idx] = detections[det_cols]
+        is_matched[track_idx, marker_idx] = True
+        return matched, is_matched
+
+    def model_input(self, matched, is_matched, pos):
+        """
+        Detections relative to the track position, visible markers first and zeros for the missing ones, like the
+        X_shuffled sequences of dataSynthesis.synthesize_detections. Only matched detections are passed on, so the
+        false positive slots of models trained with false positives stay empty.
+        """
+        relative = np.where(is_matched[:, :, None], matched - pos[:, None, :], 0)
+        if self.with_missing_flag:
+            relative = np.concatenate([relative, np.logical_not(is_matched)[:, :, None].astype(np.float64)], axis=2)
+        order = np.argsort(np.logical_not(is_matched), axis=1, kind='stable')
+        relative = np.take_along_axis(relative, order[:, :, None], axis=1)
+        if self.n_false_positive_slots > 0:
+            # empty slots are zeros flagged as missing
+            empty = np.zeros([len(relative), self.n_false_positive_slots, relative.shape[2]])
+            empty[:, :, 3] = 1
+            relative = np.concatenate([relative, empty], axis=1)
+        return torch.from_numpy(relative.reshape([len(relative), -1])).float().to(self.device)
+
+    def run_model(self, matched, is_matched, pos, pattern_idx, state):
+        with torch.no_grad():
+            rot_param, _, state = self.model.step(self.model_input(matched, is_matched, pos),
+                                                  self.patterns_torch[pattern_idx], state)
+            rot = rotation_from_6d(rot_param).double().cpu().numpy()
+        return rot, state
+
+    def update_positions(self, rot, matched, is_matched, pos):
+        # least squares position given the rotation: mean of detection - rotated marker over the matched markers, the
+        # position output of the model is not used
+        rotated = pose_to_markers(rot, np.zeros_like(pos), self.patterns[self.pattern_idx])
+        n_matched = np.sum(is_matched, axis=1)
+        offsets = np.sum(np.where(is_matched[:, :, None], matched - rotated, 0), axis=1)
+        return np.where(n_matched[:, None] > 0, offsets / np.maximum(n_matched, 1)[:, None], pos), n_matched > 0
+
+    def delete_lost_tracks(self):
+        keep = self.invisible_count <= self.max_invisible_frames
+        if np.all(keep):
+            return
+        keep_idx = np.nonzero(keep)[0]
+        self.pattern_idx = self.pattern_idx[keep_idx]
+        self.pos = self.pos[keep_idx]
+        self.velocity = self.velocity[keep_idx]
+        self.rot = self.rot[keep_idx]
+        self.age = self.age[keep_idx]
+        self.invisible_count = self.invisible_count[keep_idx]
+        self.state = index_state(self.state, torch.from_numpy(keep_idx).to(self.device))
+
+    def find_new_tracks(self, detections):
+        """
+        Searches the unassigned detections for the patterns of untracked birds (createNewTracks.m).
+        Returns the pattern, position, rotation, matched detections [B x 4 x 3] and matched markers [B x 4] of the
+        new tracks.
+        """
+        free_patterns = np.setdiff1d(np.arange(len(self.patterns)), self.pattern_idx)
+        births = []
+        is_used = np.zeros(len(detections), dtype=bool)
+        if len(free_patterns) == 0 or len(detections) < self.min_birth_detections:
+            return births
+        distances = np.linalg.norm(detections[:, None, :] - detections[None, :, :], axis=2)
+        for d in range(len(detections)):
+            if is_used[d] or len(free_patterns) == 0:
+                continue
+            neighbours = np.nonzero(np.logical_and(distances[d] < self.birth_radius, np.logical_not(is_used)))[0]
+            if len(neighbours) < self.min_birth_detections:
+                continue
+            neighbours = neighbours[np.argsort(distances[d, neighbours])][:self.n_markers]
+            fits = [fit_pattern(detections[neighbours], self.patterns[p]) for p in free_patterns]
+            best = int(np.argmin([fit[2] for fit in fits]))
+            R, t, error, marker_idx = fits[best]
+            if error > self.birth_error:
+                continue
+            matched = np.zeros([self.n_markers, 3])
+            is_matched = np.zeros([self.n_markers], dtype=bool)
+            matched[marker_idx] = detections[neighbours]
+            is_matched[marker_idx] = True
+            births.append((free_patterns[best], t, R, matched, is_matched))
+            is_used[neighbours] = True
+            free_patterns = np.delete(free_patterns, best)
+        return births
+
+    def add_tracks(self, pattern_idx, pos, rot, matched, is_matched):
+        # the model state of new tracks comes from a step on their first frame
+        with torch.no_grad():
+            _, _, state = self.model.step(self.model_input(matched, is_matched, pos),
+                                          self.patterns_torch[pattern_idx], None)
+        self.state = state if self.state is None or self.n_tracks == 0 else cat_states(self.state, state)
+        self.pattern_idx = np.concatenate([self.pattern_idx, pattern_idx])
+        self.pos = np.concatenate([self.pos, pos], axis=0)
+        self.velocity = np.concatenate([self.velocity, np.zeros_like(pos)], axis=0)
+        self.rot = np.concatenate([self.rot, rot], axis=0)
+        self.age = np.concatenate([self.age, np.ones(len(pattern_idx), dtype=np.int64)])
+        self.invisible_count = np.concatenate([self.invisible_count, np.zeros(len(pattern_idx), dtype=np.int64)])
+
+    def update(self, detections):
+        """
+        Processes one frame, detections: [D x 3] (NaN rows are ignored).
+        Returns the pattern index [K], position [K x 3] and rotation [K x 3 x 3] of every live track.
+        """
+        detections = detections[np.logical_not(np.any(np.isnan(detections), axis=1))]
+        is_gated = np.zeros(len(detections), dtype=bool)
+        if self.n_tracks > 0:
+            pos = self.predict()
+            is_gated = self.gate(detections, pos)
+            matched, is_matched = self.match_markers(detections, self.predicted_markers(pos))
+            # one batched model call for all live tracks
+            rot, self.state = self.run_model(matched, is_matched, pos, self.pattern_idx, self.state)
+            new_pos, is_visible = self.update_positions(rot, matched, is_matched, pos)
+            self.velocity = np.where(is_visible[:, None], new_pos - self.pos, self.velocity)
+            self.pos = new_pos
+            self.rot = rot
+            self.age += 1
+            self.invisible_count = np.where(is_visible, 0, self.invisible_count + 1)
+            self.delete_lost_tracks()
+
+        births = self.find_new_tracks(detections[np.logical_not(is_gated)])
+        if len(births) > 0:
+            self.add_tracks(*[np.stack(values, axis=0) for values in zip(*births)])
+        return self.pattern_idx, self.pos, self.rot
+
+    def run(self, detections, verbose=True):
+        """
+        Tracks a whole recording, detections: [T x maxDetectionsPerFrame x 3].
+        Returns the positions [P x T x 3] and rotation matrices [P x T x 3 x 3] of every pattern (NaN while a bird is
+        not tracked, same layout as estimatedPositions of ownMOT.m) and the processed frames per second.
+        """
+        T = detections.shape[0]
+        positions = np.full([len(self.patterns), T, 3], np.nan)
+        rotations = np.full([len(self.patterns), T, 3, 3], np.nan)
+        start = time.perf_counter()
+        for t in range(T):
+            pattern_idx, pos, rot = self.update(detections[t])
+            positions[pattern_idx, t] = pos
+            rotations[pattern_idx, t] = rot
+        fps = T / (time.perf_counter() - start)
+        if verbose:
+            print('Tracked {} frames at {:.1f} frames per second'.format(T, fps))
+        return positions, rotations, fps
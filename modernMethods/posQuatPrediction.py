@@ -12,8 +12,10 @@ import os
 import pandas as pd
 import re
 from datetime import datetime
+import time
 
 from math import ceil
+from itertools import islice
 
 import matplotlib.pyplot as plt
 
@@ -26,12 +28,25 @@ if use_colab:
     import sys
 
     sys.path.append(colab_path_prefix + 'pyquaternion')
-from pyquaternion import Quaternion as Quaternion
+import dataLoading
+import multiObjectTracking
+import viconData
+import kalmanFilter
+import lieGroupEKF
+import inferenceExport
+from rotations import (quat_multiply, quats_to_rotation_matrices, rotation_matrices_to_quats, rotation_from_6d,
+                       pose_to_markers, marker_loss)
+from umeyama import umeyama, rotation_angle
+from fusedLSTM import run_pattern_lstm
+from trackerModels import SOTTracker, LSTMEncoderTracker, flatten_patterns, expand_patterns
 
 if not use_colab:
     from vizTracking import visualize_tracking
 
     from BehaviourModel import NoiseModelFN, NoiseModelFP
+    from dataSynthesis import generate_sequences
+    import dataStore
+    import dataStream
 
 drop_some_dets = True
 add_false_positives = False
@@ -40,6 +55,16 @@ NOISE_STD = 0.0001
 use_const_pat = False
 generate_data = False
 multi_modal = False
+# root seed for data generation, the same seed gives the same data set for any number of workers
+SEED = 0
+N_WORKERS = os.cpu_count()
+SHARD_SIZE = 1000
+# scaled and rotated copies of every cleaned Kalman snippet, see augment_snippets
+AUGMENTATION_FACTOR = 5
+# batches per epoch when training on a stream of generated data
+STREAM_BATCHES_PER_EPOCH = 600
+# background processes which gather and prefetch the training batches
+N_LOADER_WORKERS = 2
 
 TASK = 'PosQuatPred; '
 MODEL_NAME = 'SOTNet'
@@ -166,13 +191,13 @@ def gen_folder_name(task, name):
 class TrainingData():
     def __init__(self):
 
-        is_numpy = True
+        self.is_numpy = True
 
         self.X_train = None
         self.X_train_shuffled = None
         self.quat_train = None
         self.pos_train = None
-        self.pattern_train = None
+        self.pattern_idx_train = None
         self.delta_pos_train = None
         self.marker_ids_train = None
 
@@ -180,37 +205,51 @@ class TrainingData():
         self.X_test_shuffled = None
         self.quat_test = None
         self.pos_test = None
-        self.pattern_test = None
+        self.pattern_idx_test = None
         self.delta_pos_test = None
         self.marker_ids_test = None
 
-    def shuffle(self):
-        N = self.X_train.shape[1]
-        if self.is_numpy:
-            randperm = np.random.permutation(np.arange(0, N))
-        else:
-            randperm = torch.randperm(N)
-        self.X_train = self.X_train[:, randperm, :]
-        self.X_train_shuffled = self.X_train_shuffled[:, randperm, :]
-        self.quat_train = self.quat_train[:, randperm, :]
-        self.pos_train = self.pos_train[:, randperm, :]
-        print(self.pattern_train.shape)
-        self.pattern_train = self.pattern_train[:, randperm, :, :]
-        if self.marker_ids_train is not None:
-            self.marker_ids_train = self.marker_ids_train[:, randperm, :]
-        if self.delta_pos_train is not None:
-            self.delta_pos_train = self.delta_pos_train[:, randperm, :]
-        if hasattr(self, 'delta_X_train_shuffled') and self.delta_X_train_shuffled is not None:
-            self.delta_X_train_shuffled = self.delta_X_train_shuffled[:, randperm, :]
+        # all sequences share a few patterns, they are stored once in the table and referenced by index
+        self.pattern_table = None
+
+    # compact patterns [N x 4 x 3], broadcast over time by the models and losses
+    @property
+    def pattern_train(self):
+        return self.pattern_table[self.pattern_idx_train]
+
+    @property
+    def pattern_test(self):
+        return self.pattern_table[self.pattern_idx_test]
+
+    def set_patterns(self, data_dict, split):
+        if 'pattern_idx' in data_dict.keys():
+            self.pattern_table = data_dict['pattern_table']
+            setattr(self, 'pattern_idx_' + split, data_dict['pattern_idx'])
         else:
-            print('Haalp')
+            self.set_tiled_patterns(data_dict['pattern'], split)
+
+    def set_tiled_patterns(self, patterns, split):
+        # converts patterns tiled over time [T x N x 4 x 3] (old data sets) into the table and index representation
+        patterns = np.asarray(patterns[0])
+        if self.pattern_table is not None:
+            patterns = np.concatenate([np.asarray(self.pattern_table), patterns], axis=0)
+        pattern_table, pattern_idx = np.unique(patterns, axis=0, return_inverse=True)
+        pattern_idx = np.reshape(pattern_idx, -1)
+        if self.pattern_table is not None:
+            n_old = len(self.pattern_table)
+            for other in ['train', 'test']:
+                if getattr(self, 'pattern_idx_' + other) is not None and other != split:
+                    setattr(self, 'pattern_idx_' + other, pattern_idx[:n_old][getattr(self, 'pattern_idx_' + other)])
+            pattern_idx = pattern_idx[n_old:]
+        self.pattern_table = pattern_table
+        setattr(self, 'pattern_idx_' + split, pattern_idx)
 
     def set_data(self, train_data_dict, test_data_dict):
         self.X_train = train_data_dict['X']
         self.X_train_shuffled = train_data_dict['X_shuffled']
         self.quat_train = train_data_dict['quat']
         self.pos_train = train_data_dict['pos']
-        self.pattern_train = train_data_dict['pattern']
+        self.set_patterns(train_data_dict, 'train')
         if 'marker_ids' in train_data_dict.keys():
             self.marker_ids_train = train_data_dict['marker_ids']
 
@@ -218,7 +257,7 @@ class TrainingData():
         self.X_test_shuffled = test_data_dict['X_shuffled']
         self.quat_test = test_data_dict['quat']
         self.pos_test = test_data_dict['pos']
-        self.pattern_test = test_data_dict['pattern']
+        self.set_patterns(test_data_dict, 'test')
         if 'marker_ids' in test_data_dict.keys():
             self.marker_ids_test = test_data_dict['marker_ids']
 
@@ -251,7 +290,11 @@ class TrainingData():
         self.X_train_shuffled = np.load(dname + '/X_train_shuffled' + postfix)
         self.quat_train = np.load(dname + '/quat_train' + postfix)
         self.pos_train = np.load(dname + '/pos_train' + postfix)
-        self.pattern_train = np.load(dname + '/pattern_train' + postfix)
+        if os.path.isfile(dname + '/pattern_table' + postfix):
+            self.pattern_table = np.load(dname + '/pattern_table' + postfix)
+            self.pattern_idx_train = np.load(dname + '/pattern_idx_train' + postfix)
+        else:
+            self.set_tiled_patterns(np.load(dname + '/pattern_train' + postfix, mmap_mode='r'), 'train')
         if os.path.isfile(dname + '/marker_ids_train' + postfix):
             self.marker_ids_train = np.load(dname + '/marker_ids_train' + postfix)
 
@@ -263,7 +306,10 @@ class TrainingData():
         self.X_test_shuffled = np.load(dname + '/X_test_shuffled' + postfix)
         self.quat_test = np.load(dname + '/quat_test' + postfix)
         self.pos_test = np.load(dname + '/pos_test' + postfix)
-        self.pattern_test = np.load(dname + '/pattern_test' + postfix)
+        if os.path.isfile(dname + '/pattern_idx_test' + postfix):
+            self.pattern_idx_test = np.load(dname + '/pattern_idx_test' + postfix)
+        else:
+            self.set_tiled_patterns(np.load(dname + '/pattern_test' + postfix, mmap_mode='r'), 'test')
         if os.path.isfile(dname + '/marker_ids_test' + postfix):
             self.marker_ids_test = np.load(dname + '/marker_ids_test' + postfix)
 
@@ -285,7 +331,8 @@ class TrainingData():
         np.save(dname + '/X_train_shuffled' + postfix, self.X_train_shuffled)
         np.save(dname + '/quat_train' + postfix, self.quat_train)
         np.save(dname + '/pos_train' + postfix, self.pos_train)
-        np.save(dname + '/pattern_train' + postfix, self.pattern_train)
+        np.save(dname + '/pattern_table' + postfix, self.pattern_table)
+        np.save(dname + '/pattern_idx_train' + postfix, self.pattern_idx_train)
         if self.marker_ids_train is not None:
             np.save(dname + '/marker_ids_train' + postfix, self.marker_ids_train)
 
@@ -294,12 +341,59 @@ class TrainingData():
         np.save(dname + '/X_test_shuffled' + postfix, self.X_test_shuffled)
         np.save(dname + '/quat_test' + postfix, self.quat_test)
         np.save(dname + '/pos_test' + postfix, self.pos_test)
-        np.save(dname + '/pattern_test' + postfix, self.pattern_test)
+        np.save(dname + '/pattern_idx_test' + postfix, self.pattern_idx_test)
         if self.marker_ids_test is not None:
             np.save(dname + '/marker_ids_test' + postfix, self.marker_ids_test)
 
         print('Saved data successfully!')
 
+    # arrays of both splits in the store, named <key>_<split> there and dataLoading.attribute_name(key, split) here
+    STORE_KEYS = ['X', 'X_shuffled', 'quat', 'pos', 'pattern_idx', 'marker_ids']
+
+    def save_store(self, dir_name, name, chunk_size=1000):
+        # float32 memory mapped format, see dataStore.py
+        dname = dir_name + '_' + name + '_store'
+        arrays = {'pattern_table': self.pattern_table}
+        for split in ['train', 'test']:
+            for key in self.STORE_KEYS:
+                arrays[key + '_' + split] = getattr(self, dataLoading.attribute_name(key, split))
+        flags = {'T': T, 'drop_some_dets': drop_some_dets, 'add_false_positives': add_false_positives,
+                 'add_noise': add_noise, 'NOISE_STD': NOISE_STD, 'use_const_pat': use_const_pat}
+        dataStore.save_store(dname, arrays, flags=flags, seed=SEED, chunk_size=chunk_size)
+        print('Saved data store ' + dname)
+
+    # opens a store written by save_store as memory maps, convert_to_torch then wraps them without copying
+    def load_store(self, dir_name, name):
+        dname = dir_name + '_' + name + '_store'
+        arrays, manifest = dataStore.load_store(dname)
+        self.pattern_table = arrays['pattern_table']
+        for split in ['train', 'test']:
+            for key in self.STORE_KEYS:
+                setattr(self, dataLoading.attribute_name(key, split), arrays.get(key + '_' + split))
+        self.is_numpy = True
+        print('Opened data store ' + dname + ' with flags ' + str(manifest['flags']) + ', seed ' + str(manifest['seed']))
+        return manifest
+
+    # round trip of save_store: the arrays opened from the store equal the ones in memory (after the float32 cast)
+    def check_store(self, dir_name, name, chunk_size=1000):
+        stored = TrainingData()
+        stored.load_store(dir_name, name)
+        attributes = ['pattern_table'] + [dataLoading.attribute_name(key, split)
+                                          for split in ['train', 'test'] for key in self.STORE_KEYS]
+        for attribute in attributes:
+            expected, actual = getattr(self, attribute), getattr(stored, attribute)
+            if expected is None:
+                assert actual is None, attribute + ' is in the store but not in memory'
+                continue
+            expected = np.asarray(expected)
+            assert actual is not None and actual.shape == expected.shape, attribute + ' is missing or has another shape'
+            # compared in chunks of sequences like dataStore writes them, the arrays are not copied as a whole
+            chunks = range(0, expected.shape[1], chunk_size) if expected.ndim > 1 else [None]
+            for lo in chunks:
+                part = np.s_[:, lo:lo + chunk_size] if lo is not None else np.s_[:]
+                assert np.array_equal(actual[part], expected[part].astype(actual.dtype)), attribute + ' differs'
+        print('Checked data store ' + dir_name + '_' + name + '_store')
+
     def convert_to_torch(self):
         self.is_numpy = False
         if use_colab:
@@ -309,7 +403,8 @@ class TrainingData():
                 self.delta_X_train_shuffled = torch.from_numpy(self.delta_X_train_shuffled).float().cuda()
             self.quat_train = torch.from_numpy(self.quat_train).float().cuda()
             self.pos_train = torch.from_numpy(self.pos_train).float().cuda()
-            self.pattern_train = torch.from_numpy(self.pattern_train).float().cuda()
+            self.pattern_table = torch.from_numpy(self.pattern_table).float().cuda()
+            self.pattern_idx_train = torch.from_numpy(self.pattern_idx_train).type(torch.LongTensor).cuda()
             if hasattr(self, 'delta_pos_train') and self.delta_pos_train is not None:
                 self.delta_pos_train = torch.from_numpy(self.delta_pos_train).float().cuda()
             if self.marker_ids_train is not None:
@@ -321,7 +416,7 @@ class TrainingData():
                 self.delta_X_test_shuffled = torch.from_numpy(self.delta_X_test_shuffled).float().cuda()
             self.quat_test = torch.from_numpy(self.quat_test).float().cuda()
             self.pos_test = torch.from_numpy(self.pos_test).float().cuda()
-            self.pattern_test = torch.from_numpy(self.pattern_test).float().cuda()
+            self.pattern_idx_test = torch.from_numpy(self.pattern_idx_test).type(torch.LongTensor).cuda()
             if hasattr(self, 'delta_pos_test') and self.delta_pos_test is not None:
                 self.delta_pos_test = torch.from_numpy(self.delta_pos_test).float().cuda()
             if self.marker_ids_test is not None:
@@ -334,7 +429,8 @@ class TrainingData():
                 self.delta_X_train_shuffled = torch.from_numpy(self.delta_X_train_shuffled).float()
             self.quat_train = torch.from_numpy(self.quat_train).float()
             self.pos_train = torch.from_numpy(self.pos_train).float()
-            self.pattern_train = torch.from_numpy(self.pattern_train).float()
+            self.pattern_table = torch.from_numpy(self.pattern_table).float()
+            self.pattern_idx_train = torch.from_numpy(self.pattern_idx_train).type(torch.LongTensor)
             if hasattr(self, 'delta_pos_train') and self.delta_pos_train is not None:
                 self.delta_pos_train = torch.from_numpy(self.delta_pos_train).float()
             if self.marker_ids_train is not None:
@@ -346,7 +442,7 @@ class TrainingData():
                 self.delta_X_test_shuffled = torch.from_numpy(self.delta_X_test_shuffled).float()
             self.quat_test = torch.from_numpy(self.quat_test).float()
             self.pos_test = torch.from_numpy(self.pos_test).float()
-            self.pattern_test = torch.from_numpy(self.pattern_test).float()
+            self.pattern_idx_test = torch.from_numpy(self.pattern_idx_test).type(torch.LongTensor)
             if hasattr(self, 'delta_pos_test') and self.delta_pos_test is not None:
                 self.delta_pos_test = torch.from_numpy(self.delta_pos_test).float()
             if self.marker_ids_test is not None:
@@ -361,7 +457,8 @@ class TrainingData():
         self.delta_X_train_shuffled = self.delta_X_train_shuffled.numpy()
         self.quat_train = self.quat_train.numpy()
         self.pos_train = self.pos_train.numpy()
-        self.pattern_train = self.pattern_train.numpy()
+        self.pattern_table = self.pattern_table.numpy()
+        self.pattern_idx_train = self.pattern_idx_train.numpy()
         self.delta_pos_train = self.delta_pos_train.numpy()
         if self.marker_ids_train is not None:
             self.marker_ids_train = self.marker_ids_train.numpy()
@@ -371,7 +468,7 @@ class TrainingData():
         self.delta_X_test_shuffled = self.delta_X_test_shuffled.numpy()
         self.quat_test = self.quat_test.numpy()
         self.pos_test = self.pos_test.numpy()
-        self.pattern_test = self.pattern_test.numpy()
+        self.pattern_idx_test = self.pattern_idx_test.numpy()
         self.delta_pos_test = self.delta_pos_test.numpy()
         if self.marker_ids_test is not None:
             self.marker_ids_test = self.marker_ids_test.numpy()
@@ -390,8 +487,7 @@ class TrainingData():
             np.concatenate([detection_scale, np.ones([1, 1, 1])], axis=2), [1, 1, 4])
         self.X_test_shuffled = self.X_test_shuffled / np.tile(
             np.concatenate([detection_scale, np.ones([1, 1, 1])], axis=2), [1, 1, 4])
-        self.pattern_train = self.pattern_train / np.expand_dims(detection_scale, 0)
-        self.pattern_test = self.pattern_test / np.expand_dims(detection_scale, 0)
+        self.pattern_table = self.pattern_table / detection_scale
         self.pos_train = self.pos_train / detection_scale
         self.pos_test = self.pos_test / detection_scale
 
@@ -514,53 +610,41 @@ class TrainingLogger():
             plt.savefig(self.folder_name + '/training_progress.png', format='png')
 
 
+# The pattern generators return a pattern table [P x 4 x 3] and the pattern index [N] of every sequence, the
+# patterns are broadcast over time only when they are used (see expand_patterns).
 def gen_pattern_constant(N):
     marker1 = np.array([0, 0, 0])
     marker2 = np.array([0, 0, 0.5])
     marker3 = np.array([-0.7, -1, 0])
     marker4 = np.array([1.1, -1, 0.8])
 
-    pattern = np.stack([marker1, marker2, marker3, marker4], axis=0)
-
-    stacked_marker1 = np.tile(marker1, reps=(T, N, 1))
-    stacked_marker2 = np.tile(marker2, reps=(T, N, 1))
-    stacked_marker3 = np.tile(marker3, reps=(T, N, 1))
-    stacked_marker4 = np.tile(marker4, reps=(T, N, 1))
-
-    pattern = np.stack([stacked_marker1, stacked_marker2, stacked_marker3, stacked_marker4], axis=2)
+    pattern_table = np.expand_dims(np.stack([marker1, marker2, marker3, marker4], axis=0), axis=0)
+    pattern_idx = np.zeros([N], dtype=np.int64)
 
-    # stacked_marker1 = torch.from_numpy(stacked_marker1).float()
-    # stacked_marker2 = torch.from_numpy(stacked_marker2).float()
-    # stacked_marker3 = torch.from_numpy(stacked_marker3).float()
-    # stacked_marker4 = torch.from_numpy(stacked_marker4).float()
-
-    return pattern, stacked_marker1, stacked_marker2, stacked_marker3, stacked_marker4
+    return pattern_table, pattern_idx
 
 
 def gen_pattern_(N):
     # one marker is always the origin
-    marker1 = np.zeros([T, N, 3])
+    marker1 = np.zeros([N, 3])
 
     # The others have to be generated such that they span a 3-dim space
-    marker2 = np.random.uniform(-1, 1, [1, N, 3])
+    marker2 = np.random.uniform(-1, 1, [N, 3])
 
-    marker3 = np.random.uniform(-1, 1, [1, N, 3])
-    ortho_marker2 = np.stack([marker2[:, :, 1] + marker2[:, :, 2], -marker2[:, :, 0], -marker2[:, :, 0]], axis=2)
+    marker3 = np.random.uniform(-1, 1, [N, 3])
+    ortho_marker2 = np.stack([marker2[:, 1] + marker2[:, 2], -marker2[:, 0], -marker2[:, 0]], axis=1)
     marker3 = (marker3 + ortho_marker2) / 2
 
     ortho_marker23 = np.cross(marker2, marker3)
-    scale_marker2 = np.random.uniform(-1, 1, [1, N, 1])
-    scale_marker3 = np.random.uniform(-1, 1, [1, N, 1])
-    scale_ortho = np.random.uniform(0.1, 1, [1, N, 1]) * np.random.choice([-1, 1], size=[1, N, 1], replace=True)
+    scale_marker2 = np.random.uniform(-1, 1, [N, 1])
+    scale_marker3 = np.random.uniform(-1, 1, [N, 1])
+    scale_ortho = np.random.uniform(0.1, 1, [N, 1]) * np.random.choice([-1, 1], size=[N, 1], replace=True)
     marker4 = scale_marker2 * marker2 + scale_marker3 + marker3 + scale_ortho * ortho_marker23
 
-    marker2 = np.tile(marker2, [T, 1, 1])
-    marker3 = np.tile(marker3, [T, 1, 1])
-    marker4 = np.tile(marker4, [T, 1, 1])
-
-    pattern = np.stack([marker1, marker2, marker3, marker4], axis=2)
+    pattern_table = np.stack([marker1, marker2, marker3, marker4], axis=1)
+    pattern_idx = np.arange(0, N)
 
-    return pattern, marker1, marker2, marker3, marker4
+    return pattern_table, pattern_idx
 
 
 def gen_pattern(N):
@@ -569,22 +653,10 @@ def gen_pattern(N):
     else:
         patterns = np.load('data/patterns.npy')
 
-    marker1 = np.zeros([T, N, 3])
-    marker2 = np.zeros([T, N, 3])
-    marker3 = np.zeros([T, N, 3])
-    marker4 = np.zeros([T, N, 3])
+    pattern_table = patterns / 10
+    pattern_idx = np.random.choice(np.arange(0, len(patterns)), [N])
 
-    chosen_pat_idx = np.random.choice(np.arange(0, 9), [N])
-
-    for n in range(N):
-        marker1[:, n, :] = np.squeeze(np.tile(patterns[chosen_pat_idx[n], 0, :], [T, 1, 1])) / 10
-        marker2[:, n, :] = np.squeeze(np.tile(patterns[chosen_pat_idx[n], 1, :], [T, 1, 1])) / 10
-        marker3[:, n, :] = np.squeeze(np.tile(patterns[chosen_pat_idx[n], 2, :], [T, 1, 1])) / 10
-        marker4[:, n, :] = np.squeeze(np.tile(patterns[chosen_pat_idx[n], 3, :], [T, 1, 1])) / 10
-
-    pattern = np.stack([marker1, marker2, marker3, marker4], axis=2)
-
-    return pattern, marker1, marker2, marker3, marker4
+    return pattern_table, pattern_idx
 
 
 def gen_quats(length):
@@ -640,54 +712,44 @@ def gen_pos(N):
     return pos
 
 
-def qrot(q, v):
-    # TODO can I change this function to also work with constant v and changing quaternions?
-    # if not just tile/stack v accordingly
+def rotate_quats(quats, theta):
     """
-    Rotate vector(s) v about the rotation described by quaternion(s) q.
-    Expects a tensor of shape (*, 4) for q and a tensor of shape (*, 3) for v,
-    where * denotes any number of dimensions.
-    Returns a tensor of shape (*, 3).+
-
-    source: https://github.com/facebookresearch/QuaterNet/blob/master/common/quaternion.py
+    Multiplies quaternions [..., 4] from the right with the rotations by theta [...] about the z axis, both are
+    broadcast against each other.
     """
-    assert q.shape[-1] == 4
-    assert v.shape[-1] == 3
-    if not q.shape[:-1] == v.shape[:-1]:
-        q_batch_size = list(q.shape)[1]
-        size = int(q_batch_size / BATCH_SIZE)
-        v = v.repeat([1, size, 1])
-
-    original_shape = list(v.shape)
-    q = q.view(-1, 4)
-    v = v.view(-1, 3)
-
-    qvec = q[:, 1:]
-    uv = torch.cross(qvec, v, dim=1)
-    uuv = torch.cross(qvec, uv, dim=1)
-    return (v + 2 * (q[:, :1] * uv + uuv)).view(original_shape)
-
-
-def rotate_quats(quats, theta):
-    q = Quaternion(axis=[0, 0, 1], angle=theta)
-    rotated_quats = []
-    for quat in quats:
-        qq = Quaternion(quat)
-        rotated_quats.append((qq * q).elements)
-    return rotated_quats
+    theta = np.asarray(theta, dtype=np.float64)
+    zero = np.zeros_like(theta)
+    z_rotation = np.stack([np.cos(theta / 2), zero, zero, np.sin(theta / 2)], axis=-1)
+    return quat_multiply(quats, z_rotation)
 
 
 def rotate_snippet(snip, theta):
-    # theta = np.random.uniform(1, 5)
+    # rotates positions [..., 3] by theta [...] about the z axis, both are broadcast against each other
     c, s = np.cos(theta), np.sin(theta)
-    R = np.array(((c, -s), (s, c)))
-    rotated_xy = np.matmul(R, snip[:, :2].T).T
-    return np.concatenate([rotated_xy, np.expand_dims(snip[:, 2], axis=1)], axis=1)
-
+    x, y = snip[..., 0], snip[..., 1]
+    return np.stack([c * x - s * y, s * x + c * y, snip[..., 2]], axis=-1)
 
-# TODO: vecotrize with qrot() and by shuffling markers while generating them
-def gen_data(N_train, N_test):
 
+def augment_snippets(pos, quats, augmentation_factor):
+    """
+    Makes augmentation_factor randomly scaled and rotated copies of every snippet, pos [T x N x 3] and
+    quats [T x N x 4]. The copies of snippet n are n * augmentation_factor + k, k < augmentation_factor.
+    Uses the global numpy random state, with the same draws as scaling and rotating the copies one by one with
+    np.random.uniform(0.8, 1.1, [1, 3]) and np.random.uniform(0, 6).
+    """
+    T, N = pos.shape[:2]
+    # uniform(low, high) is low + (high - low) * random_sample(), the scale and the angle of every copy are drawn in
+    # turn
+    samples = np.random.random_sample([N, augmentation_factor, 4])
+    scale = 0.8 + (1.1 - 0.8) * samples[:, :, :3]
+    theta = 6 * samples[:, :, 3]
+    augmented_pos = rotate_snippet(pos[:, :, None, :] * scale, theta)
+    augmented_quats = rotate_quats(quats[:, :, None, :], theta)
+    return (np.reshape(augmented_pos, [T, N * augmentation_factor, 3]),
+            np.reshape(augmented_quats, [T, N * augmentation_factor, 4]))
+
+
+def make_noise_models():
     # Parameters for Noise Model responsible for false negatives
     p1 = [0.025, 0.05]
     p2 = [0.1, 0.15]
@@ -710,6 +772,40 @@ def gen_data(N_train, N_test):
     nM_FP = NoiseModelFP(noise_model_FP_states, noise_model_FP_transition_probs, noise_model_FP_initial_probs,
                         fp_scale, fp_prob, radius)
 
+    return nM_FN, nM_FP
+
+
+def load_patterns():
+    if use_colab:
+        patterns = np.load(colab_path_prefix + 'patterns.npy')
+    else:
+        patterns = np.load('data/patterns.npy')
+    return patterns / 10
+
+
+def make_training_stream():
+    # new training data is synthesized in worker processes while training, the detections get harder over the first
+    # half of the epochs, see dataStream.py
+    nM_FN, nM_FP = make_noise_models()
+    schedule = dataStream.linear_difficulty(int(NUM_EPOCHS / 2) * STREAM_BATCHES_PER_EPOCH,
+                                            max_noise_std=NOISE_STD if add_noise else 0)
+    stream = dataStream.SyntheticSequenceStream(load_patterns(),
+                                                nM_FN=nM_FN if drop_some_dets else None,
+                                                nM_FP=nM_FP if add_false_positives else None,
+                                                T=T, batch_size=BATCH_SIZE, seed=SEED, schedule=schedule)
+    loader = torch.utils.data.DataLoader(stream, batch_size=None, num_workers=N_WORKERS)
+    # a single iterator is shared by all epochs, such that no batch is generated twice
+    return iter(loader)
+
+
+def gen_data(N_train, N_test):
+    # the global numpy state drives the selection of snippets, gen_quats and the augmentation,
+    # the detections of train and test set are generated from two independent streams
+    np.random.seed(SEED)
+    train_seed, test_seed = np.random.SeedSequence(SEED).spawn(2)
+
+    nM_FN, nM_FP = make_noise_models()
+
     if not generate_data:
         ratio = N_train / (N_train + N_test)
         pos = np.load('data/cleaned_kalman_pos_all.npy')
@@ -758,14 +854,10 @@ def gen_data(N_train, N_test):
         print('N test')
         print(N_test)
 
-    def gen_datum(N, pos_data=None, quats_data=None):
-        if use_colab:
-            patterns = np.load(colab_path_prefix + 'patterns.npy')
-        else:
-            patterns = np.load('data/patterns.npy')
-            # patterns = patterns[1, :, :]
-            # patterns = np.expand_dims(patterns, axis=0)
-        patterns = patterns / 10
+    def gen_datum(N, seed, pos_data=None, quats_data=None):
+        patterns = load_patterns()
+        # patterns = patterns[1, :, :]
+        # patterns = np.expand_dims(patterns, axis=0)
 
         if generate_data:
             pos = gen_pos(N)
@@ -776,7 +868,7 @@ def gen_data(N_train, N_test):
             #for n in range(N):
             #    quats[:, n, :] = gen_quats(T)
         else:
-            augmentation_factor = 5
+            augmentation_factor = AUGMENTATION_FACTOR
 
             pos = np.zeros(pos_data.shape)
             #quats = quats_data
@@ -801,168 +893,45 @@ def gen_data(N_train, N_test):
             #    plt.plot(quats_real[:, k, 3])
             #    plt.show()
 
-            augmented_pos = []
-            augmented_quats = []
-            for n in range(pos.shape[1]):
-                snip = pos[:, n, :]
-                qsnip = quats[:, n, :]
-                for k in range(augmentation_factor):
-                    scale = np.random.uniform(0.8, 1.1, [1, 3])
-                    theta = np.random.uniform(0, 6)
-                    snippy = snip * scale
-                    snippy = rotate_snippet(snippy, theta)
-                    qsnippy = rotate_quats(qsnip, theta)
-                    augmented_pos.append(snippy)
-                    augmented_quats.append(qsnippy)
-
-            pos = np.stack(augmented_pos, axis=1)
-            quats = np.stack(augmented_quats, axis=1)
+            pos, quats = augment_snippets(pos, quats, augmentation_factor)
             num_positions = N
             N = N * len(patterns) * augmentation_factor
 
-        X = np.zeros([T, N, 12])
-        rotation_matrices = np.zeros([T, N, 3, 3])
+        n_patterns = len(patterns)
+        n_tracks = num_positions * augmentation_factor
+        # sequences are ordered pattern by pattern, every pattern is combined with every quaternion track
+        pattern_idx = np.repeat(np.arange(0, n_patterns), n_tracks)
+        quat_idx = np.tile(np.arange(0, n_tracks), n_patterns)
         print('Gnerating data with size:')
-        print(X.shape)
-        if add_false_positives:
-            X_shuffled = np.zeros([T, N, 6*4])
-        else:
-            X_shuffled = np.zeros([T, N, 4*4])
-
-        all_patterns = np.zeros([T, N, 4, 3])
+        print((T, N, 12))
 
-        marker_identities = np.zeros([T, N, 4])
-
-        for n in range(N):
-            gc.collect()
-            if drop_some_dets:
-                marker_visibility = nM_FN.rollout(T) > 0
-            if add_false_positives:
-                false_positive_detections_list = nM_FP.rollout(T)
-                fp_dets = np.zeros([T, 2, 3])
-                fp_isMissing = np.ones([T, 2])
-                for i, fp_frame in enumerate(false_positive_detections_list):
-                    for j, fp in enumerate(fp_frame):
-                        if len(fp) > 2:
-                            fp_dets[i, j, :] = fp
-                            fp_isMissing[i, j] = 0
-            for t in range(T):
-
-                p_idx = int(n / (num_positions * augmentation_factor))
-                p = patterns[p_idx, :, :]
-                p_copy = np.copy(p)
-                q = Quaternion(quats[t, n % (num_positions * augmentation_factor), :])
-                rotation_matrices[t, n, :, :] = q.rotation_matrix
-                #num_visible = np.nnz(marker_visibility[t, :] > 0)
-                rnd_perm = np.arange(0, 4) #np.random.permutation(np.arange(0, 4))
-                p_copy = p_copy[rnd_perm, :]
-                marker_identities[t, n, :] = rnd_perm[rnd_perm]
-                rotated_pattern = (q.rotation_matrix @ p_copy.T).T
-                isMissing = np.zeros([4])
-                #if add_false_positives:
-
-
-                #    raise ValueError('ADD FALSE POSITIVES IS NOT YET SUPPORTED')
-
-
-                    # rotated_pattern = np.concatenate([rotated_pattern, np.ones([1, 3]) * 0], axis=0)
-                    # if np.random.uniform(0, 1) < 0.1:
-                    #    if drop_some_dets:
-                    #        if np.random.uniform(0, 1) < 0.5:
-                    #            if np.random.uniform(0, 1) < 0.5:
-                    #                rotated_pattern[3, :] = np.ones([1, 3]) * 0
-                    #                rotated_pattern[2, :] = np.random.uniform(-2, 2, [1, 3])
-                    #            else:
-                    #                rotated_pattern[3, :] = np.random.uniform(-2, 2, [1, 3])
-                    #        else:
-                    #            rotated_pattern[4, :] = np.random.uniform(-2, 2, [1, 3])
-                    #    else:
-                    #        rotated_pattern[4, :] = np.random.uniform(-2, 2, [1, 3])
-                    # else:
-                    #    if drop_some_dets and np.random.uniform(0, 1) < 0.5:
-                    #        rotated_pattern[3, :] = np.array([0, 0, 0])
-                    #        if drop_some_dets and np.random.uniform(0, 1) < 0.5:
-                    #            rotated_pattern[2, :] = np.array([0, 0, 0])
-                #else:
-                if drop_some_dets:
-                    rotated_pattern[rnd_perm[np.logical_not(marker_visibility[t, :])], :] = 0
-                    # print(rotated_pattern)
-                    marker_identities[t, n, rnd_perm[np.where(marker_visibility[t, :] < 1)]] = 4
-                    isMissing[rnd_perm[np.where(marker_visibility[t, :] < 1)]] = 1
-                    # print(isMissing)
-                # if drop_some_dets and np.random.uniform(0, 1) < 0.5:
-                #    rotated_pattern[3, :] = np.array([0, 0, 0])
-                #    marker_identities[t, n, rnd_perm[3]] = 4
-                #    isMissing[rnd_perm[3]] = 1
-                #    if drop_some_dets and np.random.uniform(0, 1) < 0.5:
-                #        rotated_pattern[2, :] = np.array([0, 0, 0])
-                #        marker_identities[t, n, rnd_perm[2]] = 4
-                #        isMissing[rnd_perm[2]] = 1
-                if add_false_positives:
-                    rotated_pattern_aug = np.zeros([6, 4])
-                else:
-                    rotated_pattern_aug = np.zeros([4, 4])
-                rotated_pattern_aug[:4, :3] = rotated_pattern
-                if add_false_positives:
-                    rotated_pattern_aug[4:, :3] = fp_dets[t, :, :]
-                rotated_pattern_aug[:4, 3] = isMissing
-                if add_false_positives:
-                    rotated_pattern_aug[4:, 3] = fp_isMissing[t, :]
-
-                if add_noise:
-                    if add_false_positives:
-                        noise = np.random.normal(0, NOISE_STD, [6, 4])
-                        noise[4:, :] = 0
-                        noise[np.concatenate([isMissing == 1, fp_isMissing[t, :] == 1]), :3] = 0
-                    else:
-                        noise = np.random.normal(0, NOISE_STD, [4, 4])
-                        noise[isMissing == 1, :3] = 0
-                    noise[:, 3] = 0
-                    rotated_pattern_aug = rotated_pattern_aug + noise
-                rotated_pattern_aug_ordered = np.zeros(rotated_pattern_aug.shape)
-                if add_false_positives:
-                    print('not implemented yet')
-                else:
-                    index = 0
-                    num_missing = np.count_nonzero(isMissing == 1)
-                    index_missing = 4 - num_missing
-                    for i in range(4):
-                        if isMissing[i] == 1:
-                            rotated_pattern_aug_ordered[index_missing, :] = rotated_pattern_aug[i, :]
-                            index_missing += 1
-                        else:
-                            rotated_pattern_aug_ordered[index, :] = rotated_pattern_aug[i, :]
-                            index += 1
-                rotated_pattern_aug = rotated_pattern_aug_ordered
-                dets = np.reshape(rotated_pattern_aug, -1)
-
-                X_shuffled[t, n, :] = dets
-
-                rotated_pattern = (q.rotation_matrix @ p.T).T
-                X[t, n, :] = np.reshape(rotated_pattern, -1)
-                all_patterns[t, n, :, :] = p
-        # TODO replace 4 with correct value
-        print(X.shape)
-        print(X_shuffled.shape)
-        X = X #+ np.tile(pos, [1, len(patterns), 4])
-        #zero_pos = np.zeros([pos.shape[0], pos.shape[1], 1])
-        #pos_aug = np.concatenate([pos, zero_pos], axis=2)
-        #X_shuffled = X_shuffled #+ np.tile(pos_aug, [1, len(patterns), 4])
-
-        return {'X': X, 'X_shuffled': X_shuffled, 'quat': rotation_matrices,
-                'pos': np.tile(pos, [1, len(patterns), 1]), 'pattern': all_patterns, 'marker_ids': marker_identities}
+        if add_noise:
+            noise_std = NOISE_STD
+        else:
+            noise_std = None
+        data = generate_sequences(quats, patterns, pattern_idx, quat_idx, seed,
+                                  nM_FN=nM_FN if drop_some_dets else None,
+                                  nM_FP=nM_FP if add_false_positives else None,
+                                  noise_std=noise_std, shard_size=SHARD_SIZE, n_workers=N_WORKERS)
+        print(data['X'].shape)
+        print(data['X_shuffled'].shape)
+        data['pos'] = np.tile(pos, [1, len(patterns), 1])
+        data['pattern_table'] = patterns
+        data['pattern_idx'] = pattern_idx
+
+        return data
 
     if generate_data:
-        return (gen_datum(N_train), gen_datum(N_test))
+        return (gen_datum(N_train, train_seed), gen_datum(N_test, test_seed))
     else:
-        train_data = gen_datum(N_train, pos_train, quats_train)
+        train_data = gen_datum(N_train, train_seed, pos_train, quats_train)
         gc.collect()
         N_train = train_data['X'].shape[1]
         print('Generated the following training data:')
         for key in train_data.keys():
             print(key)
             print(train_data[key].shape)
-        test_data = gen_datum(N_test, pos_test, quats_test)
+        test_data = gen_datum(N_test, test_seed, pos_test, quats_test)
         N_test = test_data['X'].shape[1]
         return (train_data, test_data), N_train, N_test
 
@@ -1014,6 +983,7 @@ def gen_data_(N_train, N_test):
         else:
             X_shuffled = np.zeros([T, n_pats * N, 12])
         all_patterns = np.zeros([T, n_pats * N, 4, 3])
+        rotation_matrices = quats_to_rotation_matrices(quat)
         for k in range(n_pats):
             pat = np.expand_dims(np.expand_dims(patterns[k, :, :], axis=0), axis=0)
             pattern = np.tile(pat, [T, N, 1, 1])
@@ -1025,9 +995,9 @@ def gen_data_(N_train, N_test):
                     p = pattern[t, n, :, :]
                     p_copy = np.copy(p)
 
-                    q = Quaternion(quat[t, n, :])
+                    rot_mat = rotation_matrices[t, n]
                     np.random.shuffle(p_copy)
-                    rotated_pattern = (q.rotation_matrix @ p_copy.T).T
+                    rotated_pattern = (rot_mat @ p_copy.T).T
                     if add_false_positives:
                         rotated_pattern = np.concatenate([rotated_pattern, np.ones([1, 3]) * -1000], axis=0)
                         if np.random.uniform(0, 1) < 0.1:
@@ -1058,7 +1028,7 @@ def gen_data_(N_train, N_test):
                         dets = dets + noise
                     X_shuffled[t, n * k, :] = dets
 
-                    rotated_pattern = (q.rotation_matrix @ p.T).T
+                    rotated_pattern = (rot_mat @ p.T).T
                     X[t, n * k, :] = np.reshape(rotated_pattern, -1)
         X = X  # + pos_stacked
         X_shuffled = X_shuffled  # + pos_stacked_fp
@@ -1208,21 +1178,20 @@ class customLSTM(nn.Module):
         x = self.strong_dropout(F.relu(self.fc5_det(x)))
 
         if not use_const_pat:
-            x_pat = self.weak_dropout(F.relu(self.fc1_pat(patterns.view(T - 1, -1, 12))))
+            x_pat = flatten_patterns(patterns)
+            if self.training:
+                # every frame gets its own dropout masks, in eval mode compact patterns are encoded once
+                x_pat = x_pat.expand(x.size(0), -1, -1)
+            x_pat = self.weak_dropout(F.relu(self.fc1_pat(x_pat)))
             x_pat = self.strong_dropout(F.relu(self.fc2_pat(x_pat)))
             x_pat = self.strong_dropout(F.relu(self.fc3_pat(x_pat)))
             x_pat = self.strong_dropout(F.relu(self.fc4_pat(x_pat)))
             # x = torch.cat([x, x_pat], dim=2)
+        else:
+            x_pat = None
 
-        x = torch.unsqueeze(x, dim=0)
-        x_pat = torch.unsqueeze(x_pat, dim=0)
-        lstm_out = []
-
-        for det, pat in zip(torch.unbind(x, dim=1), torch.unbind(x_pat, dim=1)):
-            hidden = self.lstm_cell(det, pat, hidden)
-            lstm_out.append(hidden[0].clone())
-
-        lstm_out = torch.squeeze(torch.stack(lstm_out, dim=1))
+        # the whole recurrence runs in one scripted function, compact patterns are encoded once per sequence
+        lstm_out, hidden = run_pattern_lstm(self.lstm_cell, x, x_pat, hidden)
 
         x_quat = self.weak_dropout(F.relu(self.hidden2quat1(lstm_out)))
         x_quat = self.weak_dropout(F.relu(self.hidden2quat2(x_quat)))
@@ -1235,14 +1204,7 @@ class customLSTM(nn.Module):
         quat_norm = torch.sqrt(torch.sum(torch.pow(x_quat, 2, ), dim=2))
         x_quat = x_quat / torch.unsqueeze(quat_norm, dim=2)
 
-        rotated_marker1 = qrot(x_quat, patterns[:, :, 0, :].contiguous()) + x_pos
-        rotated_marker2 = qrot(x_quat, patterns[:, :, 1, :].contiguous()) + x_pos
-        rotated_marker3 = qrot(x_quat, patterns[:, :, 2, :].contiguous()) + x_pos
-        rotated_marker4 = qrot(x_quat, patterns[:, :, 3, :].contiguous()) + x_pos
-        rotated_pattern = torch.cat([rotated_marker1,
-                                     rotated_marker2,
-                                     rotated_marker3,
-                                     rotated_marker4], dim=2)
+        rotated_pattern = pose_to_markers(x_quat, x_pos, patterns).flatten(start_dim=2)
 
         return x_quat, x_pos, rotated_pattern
 
@@ -1365,11 +1327,6 @@ class BirdPoseTracker(nn.Module):
         self.weak_dropout = nn.Dropout(p=WEAK_DROPOUT_RATE)
 
     def forward(self, detections, patterns):
-        marker1 = patterns[:, :, 0, :].contiguous()
-        marker2 = patterns[:, :, 1, :].contiguous()
-        marker3 = patterns[:, :, 2, :].contiguous()
-        marker4 = patterns[:, :, 3, :].contiguous()
-
         x = self.weak_dropout(F.relu(self.fc1_det(detections)))
         x = self.strong_dropout(F.relu(self.fc2_det(x)))
         x = self.strong_dropout(F.relu(self.fc3_det(x)))
@@ -1377,8 +1334,13 @@ class BirdPoseTracker(nn.Module):
         # x = self.strong_dropout(F.relu(self.fc5_det(x)))
 
         if not use_const_pat:
-            x_pat = self.weak_dropout(F.relu(self.fc1_pat(patterns.view(T - 2, -1, 12))))
+            x_pat = flatten_patterns(patterns)
+            if self.training:
+                # every frame gets its own dropout masks, in eval mode compact patterns are encoded once
+                x_pat = x_pat.expand(x.size(0), -1, -1)
+            x_pat = self.weak_dropout(F.relu(self.fc1_pat(x_pat)))
             x_pat = self.strong_dropout(F.relu(self.fc2_pat(x_pat)))
+            x_pat = x_pat.expand(x.size(0), -1, -1)
             # x_pat = self.strong_dropout(F.relu(self.fc3_pat(x_pat)))
             # x_pat = self.strong_dropout(F.relu(self.fc4_pat(x_pat)))
             x = torch.cat([x, x_pat], dim=2)
@@ -1405,14 +1367,7 @@ class BirdPoseTracker(nn.Module):
         quat_norm = torch.sqrt(torch.sum(torch.pow(x_quat, 2, ), dim=2))
         x_quat = x_quat / torch.unsqueeze(quat_norm, dim=2)
 
-        rotated_marker1 = qrot(x_quat, marker1) + x_pos
-        rotated_marker2 = qrot(x_quat, marker2) + x_pos
-        rotated_marker3 = qrot(x_quat, marker3) + x_pos
-        rotated_marker4 = qrot(x_quat, marker4) + x_pos
-        rotated_pattern = torch.cat([rotated_marker1,
-                                     rotated_marker2,
-                                     rotated_marker3,
-                                     rotated_marker4], dim=2)
+        rotated_pattern = pose_to_markers(x_quat, x_pos, patterns).flatten(start_dim=2)
 
         return x_quat, x_pos, rotated_pattern, m1, m2, m3, m4
 
@@ -1454,11 +1409,6 @@ class LSTMTracker(nn.Module):
         self.weak_dropout = nn.Dropout(p=WEAK_DROPOUT_RATE)
 
     def forward(self, detections, patterns):
-        marker1 = patterns[:, :, 0, :].contiguous()
-        marker2 = patterns[:, :, 1, :].contiguous()
-        marker3 = patterns[:, :, 2, :].contiguous()
-        marker4 = patterns[:, :, 3, :].contiguous()
-
         x = self.weak_dropout(F.relu(self.fc1_det(detections)))
         # x = self.strong_dropout(F.relu(self.fc2_det(x)))
         # x = self.strong_dropout(F.relu(self.fc3_det(x)))
@@ -1466,8 +1416,8 @@ class LSTMTracker(nn.Module):
         # x = self.strong_dropout(F.relu(self.fc5_det(x)))
 
         if not use_const_pat:
-            x_pat = self.weak_dropout(F.relu(self.fc1_pat(patterns.view(T - 3, -1, 12))))
-            # x_pat = self.weak_dropout(F.relu(self.fc1_pat(patterns.view(T - 2, -1, 12))))
+            x_pat = flatten_patterns(patterns).expand(x.size(0), -1, -1)
+            x_pat = self.weak_dropout(F.relu(self.fc1_pat(x_pat)))
             # x_pat = self.strong_dropout(F.relu(self.fc2_pat(x_pat)))
             # x_pat = self.strong_dropout(F.relu(self.fc3_pat(x_pat)))
             # x_pat = self.strong_dropout(F.relu(self.fc4_pat(x_pat)))
@@ -1486,273 +1436,11 @@ class LSTMTracker(nn.Module):
         quat_norm = torch.sqrt(torch.sum(torch.pow(x_quat, 2, ), dim=2))
         x_quat = x_quat / torch.unsqueeze(quat_norm, dim=2)
 
-        rotated_marker1 = qrot(x_quat, marker1) + x_pos
-        rotated_marker2 = qrot(x_quat, marker2) + x_pos
-        rotated_marker3 = qrot(x_quat, marker3) + x_pos
-        rotated_marker4 = qrot(x_quat, marker4) + x_pos
-        rotated_pattern = torch.cat([rotated_marker1,
-                                     rotated_marker2,
-                                     rotated_marker3,
-                                     rotated_marker4], dim=2)
+        rotated_pattern = pose_to_markers(x_quat, x_pos, patterns).flatten(start_dim=2)
 
         return x_quat, x_pos, rotated_pattern
 
 
-class SOTTracker(nn.Module):
-    def __init__(self):
-        super(SOTTracker, self).__init__()
-
-        if add_false_positives:
-            self.fc1_det = nn.Linear(20, 150)
-        else:
-            self.fc1_det = nn.Linear(12, 150)
-        self.bn1 = nn.BatchNorm1d(150)
-        self.fc2_det = nn.Linear(150, 200)
-        self.bn2 = nn.BatchNorm1d(200)
-        self.fc3_det = nn.Linear(200, 250)
-        self.bn3 = nn.BatchNorm1d(250)
-        self.fc4_det = nn.Linear(250, 250)
-        self.bn4 = nn.BatchNorm1d(250)
-        # self.fc5_det = nn.Linear(fc4_det_dim, fc5_det_dim)
-
-        if not use_const_pat:
-            self.fc1_pat = nn.Linear(12, 50)
-            self.fc2_pat = nn.Linear(50, 100)
-            self.fc3_pat = nn.Linear(100, 100)
-            self.fc4_pat = nn.Linear(100, 100)
-
-            self.bn1_pat = nn.BatchNorm1d(50)
-            self.bn2_pat = nn.BatchNorm1d(100)
-            self.bn3_pat = nn.BatchNorm1d(100)
-            self.bn4_pat = nn.BatchNorm1d(100)
-
-            # self.fc3_pat = nn.Linear(fc2_pat_dim, fc3_pat_dim)
-            # self.fc4_pat = nn.Linear(fc3_pat_dim, fc4_pat_dim)
-
-        # if use_const_pat:
-        #    self.lstm_prediction = nn.LSTM(fc3_det_dim, hidden_dim)
-        # else:
-        #    self.lstm_prediction = nn.LSTM(fc3_det_dim + fc2_pat_dim, hidden_dim)
-
-        if use_const_pat:
-            self.lstm = nn.LSTM(250, 500)
-        else:
-            self.lstm = nn.LSTM(250 + 100, 500)
-        self.lstm2 = nn.LSTM(500, 350)
-
-        self.hidden2out1_prediction = nn.Linear(350, 200)
-        self.hidden2out2_prediction = nn.Linear(200, 128)
-        self.hidden2out_bn1 = nn.BatchNorm1d(200)
-        self.hidden2out_bn2 = nn.BatchNorm1d(128)
-
-        self.hidden2quat1_prediction = nn.Linear(128, 128)
-        self.hidden2quat2_prediction = nn.Linear(128, 128)
-        self.hidden2quat3_prediction = nn.Linear(128, 6)
-        self.hidden2quat_bn1 = nn.BatchNorm1d(128)
-        self.hidden2quat_bn2 = nn.BatchNorm1d(128)
-
-        self.hidden2pos1_prediction = nn.Linear(128, 128)
-        self.hidden2pos2_prediction = nn.Linear(128, 3)
-        self.hidden2pos_bn1 = nn.BatchNorm1d(128)
-
-        # self.hidden2out1_correction = nn.Linear(hidden_dim, 500)
-        # self.hidden2out2_correction = nn.Linear(500, 200)
-
-        # self.hidden2quat1_correction = nn.Linear(200, 100)
-        # self.hidden2quat2_correction = nn.Linear(100, 4)
-
-        # self.hidden2pos1_correction = nn.Linear(200, 50)
-        # self.hidden2pos2_correction = nn.Linear(50, 3)
-
-        # self.hidden2m11_prediction = nn.Linear(200, 100)
-        # self.hidden2m12_prediction = nn.Linear(100, 5)
-        # self.hidden2m21_prediction = nn.Linear(200, 100)
-        # self.hidden2m22_prediction = nn.Linear(100, 5)
-        # self.hidden2m31_prediction = nn.Linear(200, 100)
-        # self.hidden2m32_prediction = nn.Linear(100, 5)
-        # self.hidden2m41_prediction = nn.Linear(200, 100)
-        # self.hidden2m42_prediction = nn.Linear(100, 5)
-
-        # self.strong_dropout = nn.Dropout(p=STRONG_DROPOUT_RATE)
-        # self.weak_dropout = nn.Dropout(p=WEAK_DROPOUT_RATE)
-
-    def forward(self, detections, patterns):
-        x = F.leaky_relu(self.bn1(self.fc1_det(detections).permute(0, 2, 1)).permute(0, 2, 1))
-        x = F.leaky_relu(self.bn2(self.fc2_det(x).permute(0, 2, 1)).permute(0, 2, 1))
-        x = F.leaky_relu(self.bn3(self.fc3_det(x).permute(0, 2, 1)).permute(0, 2, 1))
-        x = F.leaky_relu(self.bn4(self.fc4_det(x).permute(0, 2, 1)).permute(0, 2, 1))
-
-        if not use_const_pat:
-            x_pat = F.leaky_relu(self.bn1_pat(self.fc1_pat(patterns.view(T, -1, 12)).permute(0, 2, 1)).permute(0, 2, 1))
-            x_pat = F.leaky_relu(self.bn2_pat(self.fc2_pat(x_pat).permute(0, 2, 1)).permute(0, 2, 1))
-            x_pat = F.leaky_relu(self.bn3_pat(self.fc3_pat(x_pat).permute(0, 2, 1)).permute(0, 2, 1))
-            x_pat = F.leaky_relu(self.bn4_pat(self.fc4_pat(x_pat).permute(0, 2, 1)).permute(0, 2, 1))
-            # x_pat = self.strong_dropout(F.relu(self.fc4_pat(x_pat)))
-            x = torch.cat([x, x_pat], dim=2)
-
-        # x_prediction, _ = self.lstm_prediction(x)
-        # x_correction, _ = self.lstm_correction(torch.cat([x_prediction[:, :, :], x[:, :, :]], dim=2))
-        x, _ = self.lstm(x)
-        x, _ = self.lstm2(x)
-
-        x_prediction = F.leaky_relu(
-            self.hidden2out_bn1(self.hidden2out1_prediction(x).permute(0, 2, 1)).permute(0, 2, 1))
-        x_prediction = F.leaky_relu(
-            self.hidden2out_bn2(self.hidden2out2_prediction(x_prediction).permute(0, 2, 1)).permute(0, 2, 1))
-
-        # x_correction = self.strong_dropout(F.relu(self.hidden2out1_correction(x)))
-        # x_correction = self.weak_dropout(F.relu(self.hidden2out2_correction(x_correction)))
-
-        # m1 = self.weak_dropout(F.relu(self.hidden2m11(x)))
-        # m1 = self.hidden2m12(m1)
-        # m2 = self.weak_dropout(F.relu(self.hidden2m21(x)))
-        # m2 = self.hidden2m22(m2)
-        # m3 = self.weak_dropout(F.relu(self.hidden2m31(x)))
-        # m3 = self.hidden2m32(m3)
-        # m4 = self.weak_dropout(F.relu(self.hidden2m41(x)))
-        # m4 = self.hidden2m42(m4)
-
-        x_quat_prediction = F.leaky_relu(
-            self.hidden2quat_bn1(self.hidden2quat1_prediction(x_prediction).permute(0, 2, 1)).permute(0, 2, 1))
-        x_quat_prediction = F.leaky_relu(
-            self.hidden2quat_bn2(self.hidden2quat2_prediction(x_quat_prediction).permute(0, 2, 1)).permute(0, 2, 1))
-        x_quat_prediction = self.hidden2quat3_prediction(x_quat_prediction)
-
-        # x_quat_correction = self.weak_dropout(F.relu(self.hidden2quat1_correction(x_correction)))
-        # x_quat_correction = self.hidden2quat2_correction(x_quat_correction)
-
-        x_pos_prediction = F.leaky_relu(
-            self.hidden2pos_bn1(self.hidden2pos1_prediction(x_prediction).permute(0, 2, 1)).permute(0, 2, 1))
-        x_pos_prediction = self.hidden2pos2_prediction(x_pos_prediction)
-
-        # x_pos_correction = self.weak_dropout(F.relu(self.hidden2pos1_correction(x_correction)))
-        # x_pos_correction = self.hidden2pos2_correction(x_pos_correction)
-
-        # quat_norm_correction = torch.sqrt(torch.sum(torch.pow(x_quat_correction, 2, ), dim=2))
-        # x_quat_correction = x_quat_correction / torch.unsqueeze(quat_norm_correction, dim=2)
-
-        return x_quat_prediction, x_pos_prediction  # x_quat_correction#, x_pos_correction#rotated_pattern, m1, m2, m3, m4
-
-
-class LSTMEncoderTracker(nn.Module):
-    def __init__(self):
-        super(LSTMEncoderTracker, self).__init__()
-
-        if add_false_positives:
-            self.fc1_det = nn.Linear(6*4, 256)
-            self.bn1 = nn.BatchNorm1d(256)
-        else:
-            self.fc1_det = nn.Linear(4*4, 256)
-            self.bn1 = nn.BatchNorm1d(256)
-            #self.lstm_encoder = nn.LSTM(32, 200)
-        self.fc2_det = nn.Linear(256, 200)
-        self.bn2 = nn.BatchNorm1d(200)
-        self.fc3_det = nn.Linear(200, 250)
-        self.bn3 = nn.BatchNorm1d(250)
-        self.fc4_det = nn.Linear(250, 250)
-        self.bn4 = nn.BatchNorm1d(250)
-        # self.fc5_det = nn.Linear(fc4_det_dim, fc5_det_dim)
-
-        if not use_const_pat:
-            self.fc1_pat = nn.Linear(12, 50)
-            self.fc2_pat = nn.Linear(50, 100)
-            self.fc3_pat = nn.Linear(100, 100)
-            self.fc4_pat = nn.Linear(100, 100)
-
-            self.bn1_pat = nn.BatchNorm1d(50)
-            self.bn2_pat = nn.BatchNorm1d(100)
-            self.bn3_pat = nn.BatchNorm1d(100)
-            self.bn4_pat = nn.BatchNorm1d(100)
-
-            # self.fc3_pat = nn.Linear(fc2_pat_dim, fc3_pat_dim)
-            # self.fc4_pat = nn.Linear(fc3_pat_dim, fc4_pat_dim)
-
-        # if use_const_pat:
-        #    self.lstm_prediction = nn.LSTM(fc3_det_dim, hidden_dim)
-        # else:
-        #    self.lstm_prediction = nn.LSTM(fc3_det_dim + fc2_pat_dim, hidden_dim)
-
-        if use_const_pat:
-            self.lstm = nn.LSTM(250, 500)
-        else:
-            self.lstm = nn.LSTM(250 + 100, 500)
-        self.lstm2 = nn.LSTM(500, 350)
-
-        self.hidden2out1_prediction = nn.Linear(350, 200)
-        self.hidden2out2_prediction = nn.Linear(200, 128)
-        self.hidden2out_bn1 = nn.BatchNorm1d(200)
-        self.hidden2out_bn2 = nn.BatchNorm1d(128)
-
-        self.hidden2quat1_prediction = nn.Linear(128, 128)
-        self.hidden2quat2_prediction = nn.Linear(128, 128)
-        self.hidden2quat3_prediction = nn.Linear(128, 6)
-        self.hidden2quat_bn1 = nn.BatchNorm1d(128)
-        self.hidden2quat_bn2 = nn.BatchNorm1d(128)
-
-        #self.hidden2pos1_prediction = nn.Linear(128, 128)
-        #self.hidden2pos2_prediction = nn.Linear(128, 3)
-        #self.hidden2pos_bn1 = nn.BatchNorm1d(128)
-
-
-
-    def forward(self, detections, patterns):
-        #x = F.leaky_relu(self.bn1(self.fc1_det(detections).view(T, -1, 32).permute(0, 2, 1)).permute(0, 2, 1)).view(T, -1, 4, 32)
-        #x = x.permute(2, 0, 1, 3).view(4, -1, 32)
-        #_, x = self.lstm_encoder(x)
-        #x = x[0]
-        #x = x.view(T, -1, 200)
-        x = F.leaky_relu(self.bn1(self.fc1_det(detections).permute(0, 2, 1)).permute(0, 2, 1))
-        x = F.leaky_relu(self.bn2(self.fc2_det(x).permute(0, 2, 1)).permute(0, 2, 1))
-        x = F.leaky_relu(self.bn3(self.fc3_det(x).permute(0, 2, 1)).permute(0, 2, 1))
-        x = F.leaky_relu(self.bn4(self.fc4_det(x).permute(0, 2, 1)).permute(0, 2, 1))
-
-        if not use_const_pat:
-            x_pat = F.leaky_relu(self.bn1_pat(self.fc1_pat(patterns.view(T, -1, 12)).permute(0, 2, 1)).permute(0, 2, 1))
-            x_pat = F.leaky_relu(self.bn2_pat(self.fc2_pat(x_pat).permute(0, 2, 1)).permute(0, 2, 1))
-            x_pat = F.leaky_relu(self.bn3_pat(self.fc3_pat(x_pat).permute(0, 2, 1)).permute(0, 2, 1))
-            x_pat = F.leaky_relu(self.bn4_pat(self.fc4_pat(x_pat).permute(0, 2, 1)).permute(0, 2, 1))
-            # x_pat = self.strong_dropout(F.relu(self.fc4_pat(x_pat)))
-            x = torch.cat([x, x_pat], dim=2)
-
-        # x_prediction, _ = self.lstm_prediction(x)
-        # x_correction, _ = self.lstm_correction(torch.cat([x_prediction[:, :, :], x[:, :, :]], dim=2))
-        x, _ = self.lstm(x)
-        x, _ = self.lstm2(x)
-
-        x_prediction = F.leaky_relu(
-            self.hidden2out_bn1(self.hidden2out1_prediction(x).permute(0, 2, 1)).permute(0, 2, 1))
-        x_prediction = F.leaky_relu(
-            self.hidden2out_bn2(self.hidden2out2_prediction(x_prediction).permute(0, 2, 1)).permute(0, 2, 1))
-
-        # x_correction = self.strong_dropout(F.relu(self.hidden2out1_correction(x)))
-        # x_correction = self.weak_dropout(F.relu(self.hidden2out2_correction(x_correction)))
-
-        # m1 = self.weak_dropout(F.relu(self.hidden2m11(x)))
-        # m1 = self.hidden2m12(m1)
-        # m2 = self.weak_dropout(F.relu(self.hidden2m21(x)))
-        # m2 = self.hidden2m22(m2)
-        # m3 = self.weak_dropout(F.relu(self.hidden2m31(x)))
-        # m3 = self.hidden2m32(m3)
-        # m4 = self.weak_dropout(F.relu(self.hidden2m41(x)))
-        # m4 = self.hidden2m42(m4)
-
-        x_quat_prediction = F.leaky_relu(
-            self.hidden2quat_bn1(self.hidden2quat1_prediction(x_prediction).permute(0, 2, 1)).permute(0, 2, 1))
-        x_quat_prediction = F.leaky_relu(
-            self.hidden2quat_bn2(self.hidden2quat2_prediction(x_quat_prediction).permute(0, 2, 1)).permute(0, 2, 1))
-        x_quat_prediction = self.hidden2quat3_prediction(x_quat_prediction)
-
-        # x_quat_correction = self.weak_dropout(F.relu(self.hidden2quat1_correction(x_correction)))
-        # x_quat_correction = self.hidden2quat2_correction(x_quat_correction)
-
-        #x_pos_prediction = F.leaky_relu(
-        #    self.hidden2pos_bn1(self.hidden2pos1_prediction(x_prediction).permute(0, 2, 1)).permute(0, 2, 1))
-        #x_pos_prediction = self.hidden2pos2_prediction(x_pos_prediction)
-
-
-        return x_quat_prediction#, x_pos_prediction  # x_quat_correction#, x_pos_correction#rotated_pattern, m1, m2, m3, m4
-
-
 class PointPatternTracker(nn.Module):
     def __init__(self):
         super(PointPatternTracker, self).__init__()
@@ -1797,6 +1485,7 @@ class PointPatternTracker(nn.Module):
         # self.weak_dropout = nn.Dropout(p=WEAK_DROPOUT_RATE)
 
     def forward(self, detections, patterns):
+        patterns = expand_patterns(patterns, T)
         x = F.leaky_relu(self.bn1(self.fc1(detections).view(T, -1, 64).permute(0, 2, 1)).permute(0, 2, 1)).view(T, -1, 4, 64)
         x = F.leaky_relu(self.bn2(self.fc2(x).view(T, -1, 128).permute(0, 2, 1)).permute(0, 2, 1)).view(T, -1, 4, 128)
         x = F.leaky_relu(self.bn3(self.fc3(x).view(T, -1, 512).permute(0, 2, 1)).permute(0, 2, 1)).view(T, -1, 4, 512)
@@ -1871,12 +1560,15 @@ class PointPatternTracker(nn.Module):
 # model = LSTMTracker(hidden_dim)
 # model = MarkerNet()
 # model = BirdPoseTracker(hidden_dim)
-model = LSTMEncoderTracker()
+model = LSTMEncoderTracker(add_false_positives, use_const_pat)
 
+# device the training batches are moved to, None keeps them where they are
+LOADER_DEVICE = None
 if use_colab and torch.cuda.is_available():
     print('USING CUDA DEVICE')
     model.cuda()
     device = torch.device('cuda')
+    LOADER_DEVICE = device
     print(torch.cuda.get_device_name(0))
     print('Memory Usage:')
     print('Allocated:', round(torch.cuda.memory_allocated(0) / 1024 ** 3, 1), 'GB')
@@ -1898,93 +1590,44 @@ hyper_params = HyperParams(N_train, N_test, T, BATCH_SIZE, optimizer, LEARNING_R
 logger = TrainingLogger(MODEL_NAME, TASK, hyper_params)
 name = logger.folder_name + '/model_best.npy'
 
-def normalize_torch(tensor):
-    return tensor / torch.unsqueeze(torch.sqrt(torch.sum(torch.pow(tensor, 2), dim=2)), dim=2)
-
-def pose_loss6D(pos, rot_param, patterns, true_markers):
-    marker1 = patterns[:, :, 0, :].contiguous()
-    marker2 = patterns[:, :, 1, :].contiguous()
-    marker3 = patterns[:, :, 2, :].contiguous()
-    marker4 = patterns[:, :, 3, :].contiguous()
-
-    column1 = normalize_torch(rot_param[:, :, :3])
-    column2 = rot_param[:, :, 3:] - torch.unsqueeze(torch.sum((column1 * rot_param[:, :, 3:]), dim=2), dim=2)*column1
-    column3 = torch.cross(column1, column2, dim=2)
-    rot_mat = torch.stack([column1, column2, column3], dim=2)
-    rotated_marker1 = torch.squeeze(torch.matmul(rot_mat, torch.unsqueeze(marker1, dim=3))) + pos
-    rotated_marker2 = torch.squeeze(torch.matmul(rot_mat, torch.unsqueeze(marker2, dim=3))) + pos
-    rotated_marker3 = torch.squeeze(torch.matmul(rot_mat, torch.unsqueeze(marker3, dim=3))) + pos
-    rotated_marker4 = torch.squeeze(torch.matmul(rot_mat, torch.unsqueeze(marker4, dim=3))) + pos
-
-    rotated_pattern = torch.cat([rotated_marker1,
-                                 rotated_marker2,
-                                 rotated_marker3,
-                                 rotated_marker4], dim=2)
-
-    return loss_function_pos(rotated_pattern, true_markers)
+def pose_loss6D(pos, rot_param, patterns, true_markers, visible=None):
+    rot_mat = rotation_from_6d(rot_param, orthonormal=False)
+    return marker_loss(pose_to_markers(rot_mat, pos, patterns), true_markers, visible)
 
 
 def rot_loss6D(rot_param, true_rot):
-    column1 = normalize_torch(rot_param[:, :, :3])
-    column2 = rot_param[:, :, 3:] - torch.unsqueeze(torch.sum((column1 * rot_param[:, :, 3:]), dim=2), dim=2)*column1
-    column3 = torch.cross(column1, column2, dim=2)
-    rot_mat = torch.stack([column1, column2, column3], dim=2)
-
-    return loss_function_pos(rot_mat, true_rot)
+    return loss_function_pos(rotation_from_6d(rot_param, orthonormal=False), true_rot)
 
 
-def pose_loss(pos, quats, patterns, true_markers):
-    marker1 = patterns[:, :, 0, :].contiguous()
-    marker2 = patterns[:, :, 1, :].contiguous()
-    marker3 = patterns[:, :, 2, :].contiguous()
-    marker4 = patterns[:, :, 3, :].contiguous()
-
+def pose_loss(pos, quats, patterns, true_markers, visible=None):
     quat_norm = torch.sqrt(torch.sum(torch.pow(quats, 2), dim=2))
     quats = quats / torch.unsqueeze(quat_norm, dim=2)
-    rotated_marker1 = qrot(quats, marker1) + pos
-    rotated_marker2 = qrot(quats, marker2) + pos
-    rotated_marker3 = qrot(quats, marker3) + pos
-    rotated_marker4 = qrot(quats, marker4) + pos
-    rotated_pattern = torch.cat([rotated_marker1,
-                                 rotated_marker2,
-                                 rotated_marker3,
-                                 rotated_marker4], dim=2)
-
-    return loss_function_pos(rotated_pattern, true_markers), loss_function_pos(quat_norm,
-                                                                               torch.ones(quat_norm.shape).cuda())
+    return (marker_loss(pose_to_markers(quats, pos, patterns), true_markers, visible),
+            loss_function_pos(quat_norm, torch.ones_like(quat_norm)))
 
 
 def train_assigner(data):
-    data.shuffle()
-    for gci in range(10):
-        gc.collect()
+    loader = dataLoading.make_batch_loader(data, 'train', ['X_shuffled', 'quat', 'pos', 'X', 'delta_pos', 'pattern',
+                                                           'marker_ids'],
+                                           BATCH_SIZE, num_workers=N_LOADER_WORKERS, seed=SEED)
 
     for epoch in range(1, NUM_EPOCHS + 1):
-        gc.collect()
         model.train()
 
-        delta_detection_batches = torch.split(data.X_train_shuffled[:, :, :], BATCH_SIZE, 1)
-        quat_truth_batches = torch.split(data.quat_train[:, :, :], BATCH_SIZE, 1)
-        pos_truth_batches = torch.split(data.pos_train[:, :, :], BATCH_SIZE, 1)
-        delta_pos_truth_batches = torch.split(data.delta_pos_train[:, :, :], BATCH_SIZE, 1)
-        detections_truth_batches = torch.split(data.X_train[:, :, :], BATCH_SIZE, 1)
-        pattern_batches = torch.split(data.pattern_train[:, :, :, :], BATCH_SIZE, 1)
-        marker_assignment_batches = torch.split(data.marker_ids_train[:, :, :], BATCH_SIZE, 1)
         avg_loss_class = 0
         avg_loss_pose = 0
         avg_loss_quat = 0
         avg_loss_pos = 0
-        n_batches_per_epoch = len(delta_detection_batches)
-        for k, [delta_dets, quat_truth, pos_truth, marker_truth, delta_pos_truth, pattern_batch,
-                marker_ass] in enumerate(
-                zip(delta_detection_batches[:-1], quat_truth_batches[:-1], pos_truth_batches[:-1],
-                    detections_truth_batches[:-1],
-                    delta_pos_truth_batches[:-1], pattern_batches[:-1], marker_assignment_batches[:-1])):
+        n_batches_per_epoch = len(loader)
+        for k, batch in enumerate(loader):
+            batch = dataLoading.to_device(batch, LOADER_DEVICE)
+            delta_dets, quat_truth, pos_truth, marker_truth, delta_pos_truth, pattern_batch, marker_ass = (
+                batch['X_shuffled'], batch['quat'], batch['pos'], batch['X'], batch['delta_pos'], batch['pattern'],
+                batch['marker_ids'])
             model.zero_grad()
-            gc.collect()
 
             pred_quat, pred_delta_pos, pred_delta_markers, marker1, marker2, marker3, marker4 = model(
-                delta_dets[:-1, :, :], pattern_batch[:-1, :, :, :])
+                delta_dets[:-1, :, :], pattern_batch)
             # loss_class =  loss_cross_entropy(marker1.contiguous().view(-1, 5), marker_ass[0:-1, :, 0].contiguous().view(-1))
             # loss_class += loss_cross_entropy(marker2.contiguous().view(-1, 5), marker_ass[0:-1, :, 1].contiguous().view(-1))
             # loss_class += loss_cross_entropy(marker3.contiguous().view(-1, 5), marker_ass[0:-1, :, 2].contiguous().view(-1))
@@ -2015,7 +1658,7 @@ def train_assigner(data):
         with torch.no_grad():
             pred_quat, pred_delta_pos, pred_delta_markers, marker1, marker2, marker3, marker4 = model(
                 data.X_test_shuffled[:-1, :, :],
-                data.pattern_test[:-1, :, :, :])
+                data.pattern_test)
             # loss_class = loss_cross_entropy(marker1.contiguous().view(-1, 5),
             #                                data.marker_ids_test[0:-1, :, 0].contiguous().view(-1))
             # loss_class += loss_cross_entropy(marker2.contiguous().view(-1, 5),
@@ -2054,22 +1697,22 @@ def train_assigner(data):
     logger.save_log()
 
 
-def train_sot_tracker(data):
-    data.shuffle()
-    for gci in range(10):
-        gc.collect()
+# with a stream (see make_training_stream) the training batches are generated on the fly and data only provides the
+# test set
+def train_sot_tracker(data, stream=None):
+    if stream is None:
+        loader = dataLoading.make_batch_loader(data, 'train', ['X_shuffled', 'quat', 'pattern'], BATCH_SIZE,
+                                               num_workers=N_LOADER_WORKERS, seed=SEED)
 
     for epoch in range(1, NUM_EPOCHS + 1):
-        gc.collect()
         model.train()
 
-        # delta_detection_batches = torch.split(data.delta_X_train_shuffled[:,:,:], BATCH_SIZE, 1)
-        detection_batches = torch.split(data.X_train_shuffled, BATCH_SIZE, 1)
-        quat_truth_batches = torch.split(data.quat_train[:, :, :], BATCH_SIZE, 1)
-        #pos_truth_batches = torch.split(data.pos_train[:, :, :], BATCH_SIZE, 1)
-        # delta_pos_truth_batches = torch.split(data.delta_pos_train[:,:,:], BATCH_SIZE, 1)
-        #detections_truth_batches = torch.split(data.X_train[:, :, :], BATCH_SIZE, 1)
-        pattern_batches = torch.split(data.pattern_train[:, :, :, :], BATCH_SIZE, 1)
+        if stream is None:
+            n_batches_per_epoch = len(loader)
+            batches = loader
+        else:
+            n_batches_per_epoch = STREAM_BATCHES_PER_EPOCH
+            batches = islice(stream, STREAM_BATCHES_PER_EPOCH)
         # marker_assignment_batches = torch.split(data.marker_ids_train[:,:,:], BATCH_SIZE, 1)
         # avg_loss_class = 0
         avg_loss_pose = 0
@@ -2077,11 +1720,10 @@ def train_sot_tracker(data):
         avg_loss_pos_pred = 0
         avg_loss_quat_corr = 0
         avg_loss_pos_corr = 0
-        n_batches_per_epoch = len(detection_batches)
-        for k, [dets, quat_truth, pattern_batch] in enumerate(
-                zip(detection_batches[:-1], quat_truth_batches[:-1], pattern_batches[:-1])):
+        for k, batch in enumerate(batches):
+            batch = dataLoading.to_device(batch, LOADER_DEVICE)
+            dets, quat_truth, pattern_batch = batch['X_shuffled'], batch['quat'], batch['pattern']
             model.zero_grad()
-            gc.collect()
 
             pred_quats = model(dets, pattern_batch)
             loss_pose= rot_loss6D(pred_quats, quat_truth)
@@ -2128,7 +1770,7 @@ def train_sot_tracker(data):
             #                                                      data.pattern_test[:-1, :, :, :])
             n = data.X_test_shuffled.shape[1]
             X_split = torch.split(data.X_test_shuffled, int(n / 10), dim=1)
-            pattern_split = torch.split(data.pattern_test, int(n / 10), dim=1)
+            pattern_split = torch.split(data.pattern_test, int(n / 10), dim=0)
             rot_split = torch.split(data.quat_test, int(n / 10), dim=1)
             avg_loss_pose_test = 0
             for (X, pattern, rot) in zip(X_split, pattern_split, rot_split):
@@ -2164,8 +1806,6 @@ def train_sot_tracker(data):
 
 
 def train(data):
-    data.shuffle()
-
     # data.convert_to_numpy()
     # data.X_train_shuffled = make_detections_relative(data.X_train, data.pos_train)
     # data.X_train = data.X_train[1:, :, :]
@@ -2182,31 +1822,23 @@ def train(data):
     # data.quat_test = data.quat_test[1:, :, :]
     # data.convert_to_torch()
 
-    for gci in range(10):
-        gc.collect()
+    loader = dataLoading.make_batch_loader(data, 'train', ['X_shuffled', 'quat', 'pos', 'delta_pos', 'X', 'pattern'],
+                                           BATCH_SIZE, num_workers=N_LOADER_WORKERS, seed=SEED)
 
     for epoch in range(1, NUM_EPOCHS + 1):
-        gc.collect()
         model.train()
 
-        delta_detection_batches = torch.split(data.X_train_shuffled, BATCH_SIZE, 1)
-        quat_truth_batches = torch.split(data.quat_train, BATCH_SIZE, 1)
-        pos_truth_batches = torch.split(data.pos_train, BATCH_SIZE, 1)
-        delta_pos_truth_batches = torch.split(data.delta_pos_train, BATCH_SIZE, 1)
-        detections_truth_batches = torch.split(data.X_train, BATCH_SIZE, 1)
-        pattern_batches = torch.split(data.pattern_train, BATCH_SIZE, 1)
         avg_loss_pose = 0
         avg_loss_quat = 0
         avg_loss_pos = 0
-        n_batches_per_epoch = len(delta_detection_batches)
-        for k, [delta_dets, quat_truth, pos_truth, marker_truth, delta_pos_truth, pattern_batch] in enumerate(
-                zip(delta_detection_batches[:-1], quat_truth_batches[:-1], pos_truth_batches[:-1],
-                    detections_truth_batches[:-1],
-                    delta_pos_truth_batches[:-1], pattern_batches[:-1])):
+        n_batches_per_epoch = len(loader)
+        for k, batch in enumerate(loader):
+            batch = dataLoading.to_device(batch, LOADER_DEVICE)
+            delta_dets, quat_truth, pos_truth, marker_truth, delta_pos_truth, pattern_batch = (
+                batch['X_shuffled'], batch['quat'], batch['pos'], batch['X'], batch['delta_pos'], batch['pattern'])
             model.zero_grad()
-            gc.collect()
 
-            pred_quat, pred_delta_pos, pred_delta_markers = model(delta_dets[:-1, :, :], pattern_batch[:-1, :, :, :])
+            pred_quat, pred_delta_pos, pred_delta_markers = model(delta_dets[:-1, :, :], pattern_batch)
 
             pred_markers = pos_truth[:-1, :, :].repeat(1, 1, 4) + pred_delta_markers
             loss_pose = loss_function_pos(pred_markers, marker_truth[1:, :, :])
@@ -2229,7 +1861,7 @@ def train(data):
         model.eval()
         with torch.no_grad():
             pred_quat, pred_delta_pos, pred_delta_markers = model(data.X_test_shuffled[:-1, :, :],
-                                                                  data.pattern_test[:-1, :, :, :])
+                                                                  data.pattern_test)
             pred_markers = data.pos_test[:-1, :, :].repeat(1, 1, 4) + pred_delta_markers
             loss_pose = loss_function_pos(pred_markers, data.X_test[1:, :, :])
             loss_quat = torch.min(loss_function_quat(pred_quat, data.quat_test[1:, :, :]),
@@ -2262,7 +1894,7 @@ def eval(data, name=None):
         model = torch.load(name, map_location=lambda storage, loc: storage)
     model.eval()
     with torch.no_grad():
-        quat_preds = model(data.X_test_shuffled[:, :, :], data.pattern_test[:, :, :, :])
+        quat_preds = model(data.X_test_shuffled[:, :, :], data.pattern_test)
         idx = np.tile(np.array([True, True, True, False]), [4])
         for n in range(3, 100, 21):
             dets = data.X_test_shuffled[:, n, :].numpy()
@@ -2272,17 +1904,208 @@ def eval(data, name=None):
                                np.zeros([T, 3]),
                                data.quat_test[:, n, :, :].detach().numpy(),
                                dets,  # + np.tile(data.pos_test[:-2, n, :].numpy(), [1, 4]),
-                               data.pattern_test[0, n, :].numpy(),
+                               data.pattern_test[n].numpy(),
                                '6d')
 
 
+# compares the rotations of the model on the test set with the closed form solution of umeyama for the noisy
+# detections with known marker correspondences, a non learned baseline
+# detections of the test set in marker order [T x N x 4 x 3] and which of them are missing [T x N x 4]
+def ordered_test_detections(data):
+    T_test, N, _ = data.X_test_shuffled.shape
+    slots = data.X_test_shuffled.numpy().reshape([T_test, N, -1, 4])[:, :, :4, :]
+    # the visible markers fill the first slots in marker order, see dataSynthesis.order_missing_last, marker_ids tells
+    # which markers they are
+    is_missing = data.marker_ids_test.numpy() == 4
+    order = np.argsort(is_missing, axis=2, kind='stable')
+    detections = np.zeros([T_test, N, 4, 3])
+    np.put_along_axis(detections, order[:, :, :, None], slots[:, :, :, :3], axis=2)
+    return detections, is_missing
+
+
+def eval_umeyama(data, name=None):
+    tracker = model
+    if name is not None:
+        tracker = torch.load(name, map_location=lambda storage, loc: storage)
+    tracker.eval()
+    T_test, N, _ = data.X_test_shuffled.shape
+    detections, is_missing = ordered_test_detections(data)
+    patterns = np.tile(data.pattern_test.numpy()[None], [T_test, 1, 1, 1])
+
+    start = time.perf_counter()
+    rot_umeyama, _, _ = umeyama(patterns, detections, np.logical_not(is_missing))
+    umeyama_time = time.perf_counter() - start
+    with torch.no_grad():
+        prediction = tracker(data.X_test_shuffled, data.pattern_test)
+    if isinstance(prediction, tuple):
+        prediction = prediction[0]
+    rot_model = rotation_from_6d(prediction).numpy()
+
+    rot_truth = data.quat_test.numpy()
+    error_umeyama = rotation_angle(rot_umeyama, rot_truth)
+    error_model = rotation_angle(rot_model, rot_truth)
+    print('umeyama: median error {:.2f} deg, {:.1f} % of the frames with less than 3 markers, {:.0f} poses/s'.format(
+        np.nanmedian(error_umeyama), 100 * np.mean(np.isnan(error_umeyama)), T_test * N / umeyama_time))
+    print('model:   median error {:.2f} deg'.format(np.median(error_model)))
+    return error_umeyama, error_model
+
+
+# runs the constant acceleration EKFs of kalmanFilter and lieGroupEKF on the test set, started from the true pose of
+# the first frame, and compares their rotations to the ones of the model
+def eval_kalman(data, name=None):
+    tracker = model
+    if name is not None:
+        tracker = torch.load(name, map_location=lambda storage, loc: storage)
+    tracker.eval()
+    T_test, N, _ = data.X_test_shuffled.shape
+    detections, is_missing = ordered_test_detections(data)
+    rot_truth = data.quat_test.numpy()
+    pos_truth = data.pos_test.numpy()
+    init_quats = rotation_matrices_to_quats(rot_truth[0].astype(np.float64))
+    # the default noise is for detections in mm, the test data is in cm
+    noise = {key: value / 100 for key, value in kalmanFilter.DEFAULT_PROCESS_NOISE.items()}
+    noise['quat'] = kalmanFilter.DEFAULT_PROCESS_NOISE['quat']
+    initial_noise = {key: value / 100 for key, value in kalmanFilter.DEFAULT_INITIAL_NOISE.items()}
+    initial_noise['quat'] = kalmanFilter.DEFAULT_INITIAL_NOISE['quat']
+
+    start = time.perf_counter()
+    pos_kf, _, rot_kf = kalmanFilter.run_kalman(detections, np.logical_not(is_missing), data.pattern_test.numpy(),
+                                                np.arange(N), pos_truth[0], init_quats, process_noise=noise,
+                                                initial_noise=initial_noise,
+                                                measurement_noise=kalmanFilter.DEFAULT_MEASUREMENT_NOISE / 100)
+    kalman_time = time.perf_counter() - start
+    start = time.perf_counter()
+    pos_lg, rot_lg = lieGroupEKF.run_lie_group_kalman(detections, np.logical_not(is_missing),
+                                                      data.pattern_test.numpy(), np.arange(N), pos_truth[0],
+                                                      rot_truth[0].astype(np.float64), process_noise=noise,
+                                                      initial_noise=initial_noise,
+                                                      measurement_noise=kalmanFilter.DEFAULT_MEASUREMENT_NOISE / 100)
+    lie_group_time = time.perf_counter() - start
+    with torch.no_grad():
+        prediction = tracker(data.X_test_shuffled, data.pattern_test)
+    if isinstance(prediction, tuple):
+        prediction = prediction[0]
+    rot_model = rotation_from_6d(prediction).numpy()
+
+    error_kalman = rotation_angle(rot_kf, rot_truth)
+    error_lie_group = rotation_angle(rot_lg, rot_truth)
+    error_model = rotation_angle(rot_model, rot_truth)
+    print('kalman:    median error {:.2f} deg, position error {:.2f}, {:.0f} poses/s'.format(
+        np.median(error_kalman), np.median(np.linalg.norm(pos_kf - pos_truth, axis=2)), T_test * N / kalman_time))
+    print('lie group: median error {:.2f} deg, position error {:.2f}, {:.0f} poses/s'.format(
+        np.median(error_lie_group), np.median(np.linalg.norm(pos_lg - pos_truth, axis=2)),
+        T_test * N / lie_group_time))
+    print('model:     median error {:.2f} deg'.format(np.median(error_model)))
+    return error_kalman, error_lie_group, error_model
+
+
+# runs the test set frame by frame through model.step, asserts that the result matches the full sequence forward pass
+# and reports the time per frame
+def eval_streaming(data, n_sequences=64, name=None):
+    tracker = model
+    if name is not None:
+        tracker = torch.load(name, map_location=lambda storage, loc: storage)
+    tracker.eval()
+    detections = data.X_test_shuffled[:, :n_sequences, :]
+    patterns = data.pattern_test[:n_sequences]
+    with torch.no_grad():
+        full_prediction = tracker(detections, patterns)
+        # LSTMEncoderTracker only predicts rotations
+        full_quats, full_pos = full_prediction if isinstance(full_prediction, tuple) else (full_prediction, None)
+
+        state = None
+        quats = []
+        positions = []
+        frame_times = []
+        for t in range(detections.shape[0]):
+            start = time.perf_counter()
+            quat, pos, state = tracker.step(detections[t], patterns, state)
+            frame_times.append(time.perf_counter() - start)
+            quats.append(quat)
+            positions.append(pos)
+
+    assert torch.allclose(torch.stack(quats, dim=0), full_quats, atol=1e-5), \
+        'streaming rotations differ from the full forward pass'
+    if full_pos is not None:
+        assert torch.allclose(torch.stack(positions, dim=0), full_pos, atol=1e-5), \
+            'streaming positions differ from the full forward pass'
+    frame_time = np.median(frame_times)
+    print('Streaming matches the full forward pass. {:.3f} ms per frame for {} sequences, {:.4f} ms per bird'.format(
+        1000 * frame_time, detections.shape[1], 1000 * frame_time / detections.shape[1]))
+
+
+# exports the model with folded BatchNorm and without dropout in all precisions of inferenceExport, reports the rotation
+# error of every variant against the original model and the truth and the throughput on the test set. With a name, the
+# variants are saved next to the model, e.g. model_best_int8.npy
+def eval_inference_export(data, name=None, n_runs=3):
+    tracker = model
+    if name is not None:
+        tracker = torch.load(name, map_location=lambda storage, loc: storage)
+    tracker = tracker.cpu().eval()
+    T_test, N, _ = data.X_test_shuffled.shape
+    rot_truth = data.quat_test.numpy()
+
+    variants = [('original', tracker)]
+    for precision in inferenceExport.PRECISIONS:
+        exported = inferenceExport.export_for_inference(tracker, precision)
+        variants.append((precision, exported))
+        if name is not None:
+            torch.save(exported, os.path.splitext(name)[0] + '_' + precision + '.npy')
+
+    rot_reference = None
+    for variant_name, variant in variants:
+        run_times = []
+        with torch.no_grad():
+            for _ in range(n_runs):
+                start = time.perf_counter()
+                prediction = variant(data.X_test_shuffled, data.pattern_test)
+                run_times.append(time.perf_counter() - start)
+        if isinstance(prediction, tuple):
+            prediction = prediction[0]
+        rot_variant = rotation_from_6d(prediction.double()).numpy()
+        if rot_reference is None:
+            rot_reference = rot_variant
+        error_reference = rotation_angle(rot_variant, rot_reference)
+        print('{:9s} vs original: median {:.4f} deg, max {:.4f} deg | vs truth: median {:.2f} deg | '
+              '{:.0f} poses/s'.format(variant_name, np.median(error_reference), np.max(error_reference),
+                                      np.median(rotation_angle(rot_variant, rot_truth)), T_test * N / min(run_times)))
+
+
+# tracks the birds of the 20190124 test recording with all live tracks in one batched model.step per frame, the tracks
+# are initialized from the first VICON frame like useVICONinit in ownMOT.m
+def eval_mot(name=None, recording='../datasets/20190124_10BirdsWeightTrials05_testdata'):
+    tracker = model
+    if name is not None:
+        tracker = torch.load(name, map_location=lambda storage, loc: storage)
+    tracker.eval()
+    # mm to cm, the scale of the training data
+    detections = multiObjectTracking.load_unlabeled_detections('../datasets/D_unlabeled.mat') / 10
+    vicon_pos, vicon_quats = multiObjectTracking.load_vicon_csv(recording + '.csv')
+    vicon_pos = vicon_pos / 10
+    # the .vsk files of the recording sort like the subjects of the VICON export, pattern k belongs to bird k
+    _, patterns = viconData.read_vsk_patterns('../datasets/framework')
+
+    mot = multiObjectTracking.MultiObjectTracker(tracker, patterns / 10)
+    visible = np.nonzero(np.logical_not(np.isnan(vicon_pos[:, 0, 0])))[0]
+    mot.initialize(visible, vicon_pos[visible, 0],
+                   quats_to_rotation_matrices(vicon_quats[visible, 0]))
+    positions, rotations, fps = mot.run(detections)
+
+    errors = np.linalg.norm(positions - vicon_pos, axis=2)
+    is_tracked = np.logical_not(np.isnan(positions[:, :, 0]))
+    in_vicon = np.logical_not(np.isnan(vicon_pos[:, :, 0]))
+    print('median position error: {:.2f} cm, {:.1f} % of the VICON poses tracked'.format(
+        np.nanmedian(errors), 100 * np.mean(is_tracked[in_vicon])))
+    return positions, rotations
+
+
 def eval_(name, data):
     model = torch.load(name, map_location=lambda storage, loc: storage)
     model.eval()
     printed_slow = False
     with torch.no_grad():
         quat_preds, pred_delta_pos, _, m1, m2, m3, m4 = model(data.X_test_shuffled[:-1, :, :],
-                                                              data.pattern_test[:-1, :, :, :])
+                                                              data.pattern_test)
         print(m1[:10, 1, :])
         print(data.marker_ids_test[:10, 1, 0])
         # TODO: 1: oder :-1??
@@ -2300,7 +2123,7 @@ def eval_(name, data):
                                data.quat_test[2:, n, :].detach().numpy(),
                                data.X_test_shuffled[1:-1, n, :].numpy() + np.tile(data.pos_test[:-2, n, :].numpy(),
                                                                                   [1, 4]),
-                               data.pattern_test[0, n, :].numpy())
+                               data.pattern_test[n].numpy())
 
 
 def show_data(data):
@@ -2311,7 +2134,7 @@ def show_data(data):
                            data.pos_test[:, n, :].numpy(),
                            data.quat_test[:, n, :].numpy(),
                            data.X_test[:, n, :3].numpy(),
-                           data.pattern_test[0, n, :].numpy())
+                           data.pattern_test[n].numpy())
 
 
 #######################################################################################################################
@@ -2338,7 +2161,13 @@ else:
     else:
         (train_data, test_data) = gen_data(N_train, N_test)
     data.set_data(train_data, test_data)
-    data.save_data(generated_data_dir, 'rot_matrix_noise_ordered')
+    data.save_store(generated_data_dir, 'rot_matrix_noise_ordered')
+    data.check_store(generated_data_dir, 'rot_matrix_noise_ordered')
+    # reopen the data as memory maps, such that the generated arrays can be freed
+    del train_data, test_data
+    data = TrainingData()
+    data.load_store(generated_data_dir, 'rot_matrix_noise_ordered')
+    #data.save_data(generated_data_dir, 'rot_matrix_noise_ordered')
     #data = TrainingData()
     #data.load_data(generated_data_dir, N_train, N_test, 'rot_matrix_all_noise')
     #data.normalize()
@@ -2347,10 +2176,18 @@ else:
 
 gc.collect()
 #train_sot_tracker(data)
+#train_sot_tracker(data, make_training_stream())
 gc.collect()
 #if not use_colab:
     #eval(data, name)
     #eval(data, 'models/SOTNet_rotmat_with_noise_FNs/model_best.npy')
+    #eval_streaming(data, name='models/SOTNet_rotmat_with_noise_FNs/model_best.npy')
+    #eval_mot('models/SOTNet_rotmat_with_noise_FNs/model_best.npy')
+    #eval_umeyama(data, 'models/SOTNet_rotmat_with_noise_FNs/model_best.npy')
+    #eval_kalman(data, 'models/SOTNet_rotmat_with_noise_FNs/model_best.npy')
+    #eval_inference_export(data, 'models/SOTNet_rotmat_with_noise_FNs/model_best.npy')
+    #import batchTracking
+    #batchTracking.run_batch('../datasets/flock3', 'models/SOTNet_rotmat_with_noise_FNs/model_best.npy')
 
 
 # DONE TODO: regress rot mat directly
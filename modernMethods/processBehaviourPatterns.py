@@ -1,89 +1,11 @@
 import numpy as np
 import pickle
 from random import choice
-from math import floor
 from viz import visualize
+import behaviourIntervals
 
 path = '../behaviour/'
 filenames = ['isFlying', 'isStarting', 'isLanding', 'isWalking', 'isSitting']
-files = {}
-for i in range(len(filenames)):
-    with open(path + filenames[i] + '.pkl', 'rb') as fin:
-        files[filenames[i]] = pickle.load(fin)
-
-
-with open(path + 'positionsX.pkl', 'rb') as fin:
-    posX = pickle.load(fin)
-with open(path + 'positionsY.pkl', 'rb') as fin:
-    posY = pickle.load(fin)
-with open(path + 'positionsZ.pkl', 'rb') as fin:
-    posZ = pickle.load(fin)
-
-pos = np.stack([posX[:,:-1], posY[:,:-1], posZ[:,:-1]], axis=2)
-
-#print(np.shape(pos[files['isFlying'] != 0,:]))
-
-
-# Extracts all trajectories for a specified behaviour as a list of 2d numpy arrays
-def get_behaviour_snippets(pos, behaviour_mask, n_objects, min_length):
-    T = np.shape(behaviour_mask)[1]
-    snippets = []
-    for k in range(n_objects):
-        inAction = False
-        actionLength = 0
-
-        for t in range(T):
-            if not inAction:
-                if behaviour_mask[k, t]:
-                    inAction = True
-                    actionLength = 1
-            else:
-                if behaviour_mask[k, t] and t < T - 1:
-                    actionLength += 1
-                elif actionLength > min_length:
-                    #save action snippet
-                    snip = np.squeeze(pos[k,t-actionLength:t, :])
-                    if np.sum(np.isnan(snip)) > 0:
-                        print(snip)
-                        print('HHHHHHAAAAAAALLLLLLLLLLLLLLOOOOOO')
-                    snippets.append(snip)
-                    inAction = False
-                    actionLength = 0
-                else:
-                    inAction = False
-                    actionLength = 0
-
-    return snippets
-
-
-# Cuts snippets such that all snippets have length 'snippet_length'
-def split_snippets(snippets, snippet_length):
-    new_snippets = []
-    for snippet in snippets:
-        if np.shape(snippet)[0] % snippet_length != 0:
-            n_splits = floor(np.shape(snippet)[0] / snippet_length)
-            splits = np.split(snippet[:snippet_length*n_splits,:], n_splits, axis=0)
-            splits.append(snippet[-snippet_length:])
-        else:
-            n_splits = int(np.shape(snippet)[0] / snippet_length)
-            splits = np.split(snippet, n_splits,axis=0)
-        new_snippets += splits
-    return new_snippets
-
-
-# get equal length snippets for all behaviours
-flying_behaviour = split_snippets(get_behaviour_snippets(pos, files['isFlying'], 10, 10), 10)
-starting_behaviour = split_snippets(get_behaviour_snippets(pos, files['isStarting'], 10, 10), 10)
-landing_behaviour = split_snippets(get_behaviour_snippets(pos, files['isLanding'], 10, 10), 10)
-walking_behaviour = split_snippets(get_behaviour_snippets(pos, files['isWalking'], 10, 10), 10)
-sitting_behaviour = split_snippets(get_behaviour_snippets(pos, files['isSitting'], 10, 30), 10)
-
-
-#print(len(flying_behaviour))
-#print(len(starting_behaviour))
-#print(len(landing_behaviour))
-#print(len(sitting_behaviour))
-#print(len(walking_behaviour))
 
 
 # offset_noise basically has no effect
@@ -118,49 +40,6 @@ def get_counter_clockwise_anlge(v, u):
     return np.arcsin((v[0]*u[1] - v[1]*u[0])/(np.linalg.norm(v)*np.linalg.norm(u)))
 
 
-# TODO figure out what is wrong!!!
-for i in range(1000):
-    u = np.random.normal(0,1,[3])
-    u[2] = 0
-    v = np.random.normal(0, 1, [3])
-    v[2] = 0
-    theta = get_counter_clockwise_anlge(v/np.linalg.norm(v), u/np.linalg.norm(u))
-    c, s = np.cos(theta), np.sin(theta)
-    R = np.array(((c, -s), (s, c)))
-    rot_v = np.matmul(R, v[:2])
-    rot_v3 = np.zeros(3)
-    rot_v3[:2] = rot_v
-    rot_v3[2] = 0
-    new_angle = get_counter_clockwise_anlge(rot_v, u)
-
-    theta = get_counter_clockwise_anlge(v/np.linalg.norm(v), u/np.linalg.norm(u))
-    c, s = np.cos(theta), np.sin(theta)
-    R = np.array(((c, -s), (s, c)))
-    rot_v = np.matmul(R, v[:2])
-    rot_v3 = np.zeros(3)
-    rot_v3[:2] = rot_v
-    rot_v3[2] = 0
-    new_angle2 = get_counter_clockwise_anlge(rot_v, u)
-
-    if min(new_angle, new_angle2) > 0.01:
-        print(new_angle)
-        print(u)
-        print(v)
-
-u = np.array([0.4, 0.06, 0])
-v = np.array([0.136, 1.05, 0])
-
-theta = -get_counter_clockwise_anlge(v, u)
-c, s = np.cos(theta), np.sin(theta)
-R = np.array(((c, -s), (s, c)))
-rot_v = np.matmul(R, v[:2])
-print(rot_v/np.linalg.norm(rot_v))
-print(u/np.linalg.norm(u))
-
-
-print('DDDOOOONNNNEEEEE')
-
-
 # Walk through markov chain specified by transitions_probs for n_steps
 # Generates trajectory in 2d numpy array of shape (n_steps * snippet_length) x (3)
 def simulate_trajectory(snippets, transition_probs, n_steps):
@@ -205,40 +84,116 @@ def simulate_trajectory(snippets, transition_probs, n_steps):
 
     return trajectory
 
-biggest_p = 0.5
-bigger_p = 0.25
-big_p = 0.2
-small_p = 0.05
-tiny_p = 0
-
-assert biggest_p + bigger_p +  big_p + small_p + tiny_p == 1
-
-transition_matrix = np.array([ [biggest_p, bigger_p, big_p, small_p, tiny_p],
-                               [bigger_p, biggest_p, big_p, small_p, tiny_p],
-                               [tiny_p, small_p, biggest_p, bigger_p, big_p],
-                               [small_p, big_p, tiny_p, biggest_p, bigger_p],
-                               [bigger_p, big_p, small_p, tiny_p, biggest_p]])
 
-assert np.array_equal(np.sum(transition_matrix, axis=1), np.ones([np.shape(transition_matrix)[0]]))
+if __name__ == '__main__':
+    files = {}
+    for i in range(len(filenames)):
+        with open(path + filenames[i] + '.pkl', 'rb') as fin:
+            files[filenames[i]] = pickle.load(fin)
+
+
+    with open(path + 'positionsX.pkl', 'rb') as fin:
+        posX = pickle.load(fin)
+    with open(path + 'positionsY.pkl', 'rb') as fin:
+        posY = pickle.load(fin)
+    with open(path + 'positionsZ.pkl', 'rb') as fin:
+        posZ = pickle.load(fin)
+
+    pos = np.stack([posX[:,:-1], posY[:,:-1], posZ[:,:-1]], axis=2)
+
+    #print(np.shape(pos[files['isFlying'] != 0,:]))
+
+
+    # bouts of all behaviours within the frames of pos as an interval table
+    table, offsets = behaviourIntervals.build_interval_table({name: files[name][:, :pos.shape[1]]
+                                                              for name in filenames})
+    behaviourIntervals.save_interval_table(path + 'behaviourIntervals', table, offsets, flags={'source': path})
+
+    # get equal length snippets for all behaviours
+    flying_behaviour = behaviourIntervals.behaviour_snippets(pos, table, offsets, 'isFlying', 10, 10)
+    starting_behaviour = behaviourIntervals.behaviour_snippets(pos, table, offsets, 'isStarting', 10, 10)
+    landing_behaviour = behaviourIntervals.behaviour_snippets(pos, table, offsets, 'isLanding', 10, 10)
+    walking_behaviour = behaviourIntervals.behaviour_snippets(pos, table, offsets, 'isWalking', 10, 10)
+    sitting_behaviour = behaviourIntervals.behaviour_snippets(pos, table, offsets, 'isSitting', 30, 10)
+
+
+    #print(len(flying_behaviour))
+    #print(len(starting_behaviour))
+    #print(len(landing_behaviour))
+    #print(len(sitting_behaviour))
+    #print(len(walking_behaviour))
+
+
+    # TODO figure out what is wrong!!!
+    for i in range(1000):
+        u = np.random.normal(0,1,[3])
+        u[2] = 0
+        v = np.random.normal(0, 1, [3])
+        v[2] = 0
+        theta = get_counter_clockwise_anlge(v/np.linalg.norm(v), u/np.linalg.norm(u))
+        c, s = np.cos(theta), np.sin(theta)
+        R = np.array(((c, -s), (s, c)))
+        rot_v = np.matmul(R, v[:2])
+        rot_v3 = np.zeros(3)
+        rot_v3[:2] = rot_v
+        rot_v3[2] = 0
+        new_angle = get_counter_clockwise_anlge(rot_v, u)
+
+        theta = get_counter_clockwise_anlge(v/np.linalg.norm(v), u/np.linalg.norm(u))
+        c, s = np.cos(theta), np.sin(theta)
+        R = np.array(((c, -s), (s, c)))
+        rot_v = np.matmul(R, v[:2])
+        rot_v3 = np.zeros(3)
+        rot_v3[:2] = rot_v
+        rot_v3[2] = 0
+        new_angle2 = get_counter_clockwise_anlge(rot_v, u)
+
+        if min(new_angle, new_angle2) > 0.01:
+            print(new_angle)
+            print(u)
+            print(v)
+
+    u = np.array([0.4, 0.06, 0])
+    v = np.array([0.136, 1.05, 0])
+
+    theta = -get_counter_clockwise_anlge(v, u)
+    c, s = np.cos(theta), np.sin(theta)
+    R = np.array(((c, -s), (s, c)))
+    rot_v = np.matmul(R, v[:2])
+    print(rot_v/np.linalg.norm(rot_v))
+    print(u/np.linalg.norm(u))
 
-snippets = [sitting_behaviour, walking_behaviour, starting_behaviour, flying_behaviour, landing_behaviour]
 
-traj = simulate_trajectory(snippets, transition_matrix, 100)
-print(np.shape(traj))
-print(traj)
+    print('DDDOOOONNNNEEEEE')
 
-traj = traj / np.max(np.abs(traj), axis=0)
 
-visualize(np.expand_dims(traj,axis=1), isNumpy=True)
+    biggest_p = 0.5
+    bigger_p = 0.25
+    big_p = 0.2
+    small_p = 0.05
+    tiny_p = 0
 
+    assert biggest_p + bigger_p +  big_p + small_p + tiny_p == 1
 
+    transition_matrix = np.array([ [biggest_p, bigger_p, big_p, small_p, tiny_p],
+                                   [bigger_p, biggest_p, big_p, small_p, tiny_p],
+                                   [tiny_p, small_p, biggest_p, bigger_p, big_p],
+                                   [small_p, big_p, tiny_p, biggest_p, bigger_p],
+                                   [bigger_p, big_p, small_p, tiny_p, biggest_p]])
 
+    assert np.array_equal(np.sum(transition_matrix, axis=1), np.ones([np.shape(transition_matrix)[0]]))
 
-# TODO 3: define markov chain to generate new behaviour
-# TODO 4: visualize results
-# TODO 5: refine markov chain in order to get smooth results, maybe with curves to transit in flying mode
+    snippets = [sitting_behaviour, walking_behaviour, starting_behaviour, flying_behaviour, landing_behaviour]
 
+    traj = simulate_trajectory(snippets, transition_matrix, 100)
+    print(np.shape(traj))
+    print(traj)
 
+    traj = traj / np.max(np.abs(traj), axis=0)
 
+    visualize(np.expand_dims(traj,axis=1), isNumpy=True)
 
 
+# TODO 3: define markov chain to generate new behaviour
+# TODO 4: visualize results
+# TODO 5: refine markov chain in order to get smooth results, maybe with curves to transit in flying mode
@@ -4,7 +4,7 @@ import torch.nn.functional as F
 import torch.optim as optim
 import numpy as np
 
-from pyquaternion import Quaternion as Quaternion
+from rotations import qrot, quats_to_rotation_matrices
 
 
 from vizTracking import visualize_tracking
@@ -56,15 +56,11 @@ marker4 = np.array([1.1, -1, 0.8])
 
 pattern = np.stack([marker1, marker2, marker3, marker4], axis=0)
 
-stacked_marker1 = np.tile(marker1, reps=(T-1, BATCH_SIZE, 1))
-stacked_marker2 = np.tile(marker2, reps=(T-1, BATCH_SIZE, 1))
-stacked_marker3 = np.tile(marker3, reps=(T-1, BATCH_SIZE, 1))
-stacked_marker4 = np.tile(marker4, reps=(T-1, BATCH_SIZE, 1))
-
-stacked_marker1 = torch.from_numpy(stacked_marker1).float()
-stacked_marker2 = torch.from_numpy(stacked_marker2).float()
-stacked_marker3 = torch.from_numpy(stacked_marker3).float()
-stacked_marker4 = torch.from_numpy(stacked_marker4).float()
+# qrot broadcasts the markers over time steps and batches of any size
+stacked_marker1 = torch.from_numpy(marker1).float()
+stacked_marker2 = torch.from_numpy(marker2).float()
+stacked_marker3 = torch.from_numpy(marker3).float()
+stacked_marker4 = torch.from_numpy(marker4).float()
 
 
 def gen_quats(length, dims):
@@ -83,34 +79,6 @@ def gen_quats(length, dims):
     return quats
 
 
-def qrot(q, v):
-    #TODO can I change this function to also work with constant v and changing quaternions?
-    # if not just tile/stack v accordingly
-    """
-    Rotate vector(s) v about the rotation described by quaternion(s) q.
-    Expects a tensor of shape (*, 4) for q and a tensor of shape (*, 3) for v,
-    where * denotes any number of dimensions.
-    Returns a tensor of shape (*, 3).+
-
-    source: https://github.com/facebookresearch/QuaterNet/blob/master/common/quaternion.py
-    """
-    assert q.shape[-1] == 4
-    assert v.shape[-1] == 3
-    if not q.shape[:-1] == v.shape[:-1]:
-        q_batch_size = list(q.shape)[1]
-        size = int(q_batch_size/BATCH_SIZE)
-        v = v.repeat([1, size, 1])
-
-    original_shape = list(v.shape)
-    q = q.view(-1, 4)
-    v = v.view(-1, 3)
-
-    qvec = q[:, 1:]
-    uv = torch.cross(qvec, v, dim=1)
-    uuv = torch.cross(qvec, uv, dim=1)
-    return (v + 2 * (q[:, :1] * uv + uuv)).view(original_shape)
-
-
 def gen_training_data(N):
 
     quat_train = np.zeros([T, N, 4], dtype=np.float32)
@@ -127,23 +95,23 @@ def gen_training_data(N):
 
 
     p = np.copy(patternq)
+    rot_train = quats_to_rotation_matrices(quat_train)
+    rot_test = quats_to_rotation_matrices(quat_test)
 
     for t in range(T):
         for n in range(N):
-            q = Quaternion(quat_train[t, n, :])
             np.random.shuffle(p)
-            rotated_pattern = (q.rotation_matrix @ p.T).T
+            rotated_pattern = (rot_train[t, n] @ p.T).T
             X_train_shuffled[t, n, :] = np.reshape(rotated_pattern, -1)
 
-            rotated_pattern = (q.rotation_matrix @ pattern.T).T
+            rotated_pattern = (rot_train[t, n] @ pattern.T).T
             X_train[t, n, :] = np.reshape(rotated_pattern, -1)
 
-            q = Quaternion(quat_test[t, n, :])
             np.random.shuffle(p)
-            rotated_pattern = (q.rotation_matrix @ p.T).T
+            rotated_pattern = (rot_test[t, n] @ p.T).T
             X_test_shuffled[t, n, :] = np.reshape(rotated_pattern, -1)
 
-            rotated_pattern = (q.rotation_matrix @ pattern.T).T
+            rotated_pattern = (rot_test[t, n] @ pattern.T).T
             X_test[t, n, :] = np.reshape(rotated_pattern, -1)
 
     #maxi1 = max(np.max(quat_train[:, :, 0]), np.max(quat_test[:, :, 0])) / 5
@@ -0,0 +1,204 @@
+import numpy as np
+import torch
+
+
+# Batched rotation kernels shared by data generation, losses, tracking and visualisation. Quaternions are in
+# (w, x, y, z) order like pyquaternion. The 6D representation holds the first two rows of the rotation matrix, which is
+# how posQuatPrediction.rot_loss6D stacks its columns. Every function takes NumPy arrays or torch tensors of any leading
+# shape and broadcasts them against each other, e.g. quaternions [T x N x 1 x 4] with markers [N x 4 x 3].
+
+
+def _is_torch(x):
+    return isinstance(x, torch.Tensor)
+
+
+def _stack(arrays, axis):
+    if _is_torch(arrays[0]):
+        return torch.stack(arrays, dim=axis)
+    return np.stack(arrays, axis=axis)
+
+
+def _cat(arrays, axis):
+    if _is_torch(arrays[0]):
+        return torch.cat(arrays, dim=axis)
+    return np.concatenate(arrays, axis=axis)
+
+
+def _cross(a, b):
+    if _is_torch(a):
+        return torch.linalg.cross(*torch.broadcast_tensors(a, b), dim=-1)
+    return np.cross(a, b)
+
+
+def _dot(a, b):
+    # inner product of the last dimension, keeping it with size 1
+    if _is_torch(a):
+        return torch.sum(a * b, dim=-1, keepdim=True)
+    return np.sum(a * b, axis=-1, keepdims=True)
+
+
+def _normalize(x):
+    return x / _dot(x, x) ** 0.5
+
+
+def qrot(q, v):
+    """
+    Rotates vector(s) v [..., 3] by the unit quaternion(s) q [..., 4], the leading dimensions are broadcast.
+    source: https://github.com/facebookresearch/QuaterNet/blob/master/common/quaternion.py
+    """
+    qvec = q[..., 1:]
+    uv = _cross(qvec, v)
+    uuv = _cross(qvec, uv)
+    return v + 2 * (q[..., :1] * uv + uuv)
+
+
+def quat_multiply(a, b):
+    # Hamilton product a * b of quaternions [..., 4], the leading dimensions are broadcast
+    aw, ax, ay, az = a[..., 0], a[..., 1], a[..., 2], a[..., 3]
+    bw, bx, by, bz = b[..., 0], b[..., 1], b[..., 2], b[..., 3]
+    return _stack([aw * bw - ax * bx - ay * by - az * bz,
+                   aw * bx + ax * bw + ay * bz - az * by,
+                   aw * by - ax * bz + ay * bw + az * bx,
+                   aw * bz + ax * by - ay * bx + az * bw], axis=-1)
+
+
+def quat_conjugate(q):
+    return _cat([q[..., :1], -q[..., 1:]], axis=-1)
+
+
+def slerp(q0, q1, t):
+    """
+    Spherical linear interpolation between unit quaternions q0 and q1 [..., 4] at t [...] (0 gives q0, 1 gives q1)
+    along the shorter arc. Nearly identical quaternions are interpolated linearly.
+    """
+    t = t[..., None]
+    d = _dot(q0, q1)
+    # q and -q are the same rotation, take the one closer to q0
+    q1 = q1 * ((d >= 0) * 2 - 1)
+    d = abs(d)
+    is_close = d > 1 - 1e-6
+    if _is_torch(d):
+        theta = torch.arccos(torch.clamp(d, max=1.0))
+        sin_theta = torch.where(is_close, torch.ones_like(theta), torch.sin(theta))
+        w0 = torch.where(is_close, 1 - t, torch.sin((1 - t) * theta) / sin_theta)
+        w1 = torch.where(is_close, t, torch.sin(t * theta) / sin_theta)
+    else:
+        theta = np.arccos(np.minimum(d, 1.0))
+        sin_theta = np.where(is_close, 1.0, np.sin(theta))
+        w0 = np.where(is_close, 1 - t, np.sin((1 - t) * theta) / sin_theta)
+        w1 = np.where(is_close, t, np.sin(t * theta) / sin_theta)
+    return _normalize(w0 * q0 + w1 * q1)
+
+
+def quats_to_rotation_matrices(quats):
+    """
+    Converts quaternion(s) of shape (*, 4) in (w, x, y, z) order to rotation matrices of shape (*, 3, 3).
+
+    For NumPy arrays this mirrors pyquaternion.Quaternion(q).rotation_matrix operation by operation (including the
+    implicit normalisation of non unit quaternions), so the results are bit-for-bit identical to the per frame
+    version. Tensors are normalised and converted with the closed form, which is differentiable.
+    """
+    if _is_torch(quats):
+        w, x, y, z = torch.unbind(_normalize(quats), dim=-1)
+        return torch.stack([torch.stack([1 - 2 * (y * y + z * z), 2 * (x * y - w * z), 2 * (x * z + w * y)], dim=-1),
+                            torch.stack([2 * (x * y + w * z), 1 - 2 * (x * x + z * z), 2 * (y * z - w * x)], dim=-1),
+                            torch.stack([2 * (x * z - w * y), 2 * (y * z + w * x), 1 - 2 * (x * x + y * y)], dim=-1)],
+                           dim=-2)
+
+    original_shape = list(quats.shape[:-1])
+    q = np.reshape(quats, [-1, 4]).astype(np.float64)
+
+    # pyquaternion only normalises if the squared norm differs from 1 by more than 1e-14
+    sum_of_squares = np.matmul(np.expand_dims(q, axis=1), np.expand_dims(q, axis=2))[:, 0, 0]
+    needs_normalisation = np.logical_and(np.abs(1.0 - sum_of_squares) >= 1e-14, sum_of_squares > 0)
+    q = np.copy(q)
+    q[needs_normalisation] = q[needs_normalisation] / np.expand_dims(np.sqrt(sum_of_squares[needs_normalisation]),
+                                                                     axis=1)
+
+    w, x, y, z = q[:, 0], q[:, 1], q[:, 2], q[:, 3]
+    q_matrix = np.stack([np.stack([w, -x, -y, -z], axis=1),
+                         np.stack([x, w, -z, y], axis=1),
+                         np.stack([y, z, w, -x], axis=1),
+                         np.stack([z, -y, x, w], axis=1)], axis=1)
+    q_bar_matrix = np.stack([np.stack([w, -x, -y, -z], axis=1),
+                             np.stack([x, w, z, -y], axis=1),
+                             np.stack([y, -z, w, x], axis=1),
+                             np.stack([z, y, -x, w], axis=1)], axis=1)
+    product_matrix = np.matmul(q_matrix, np.transpose(q_bar_matrix, [0, 2, 1]))
+
+    return np.reshape(product_matrix[:, 1:, 1:], original_shape + [3, 3])
+
+
+def rotation_matrices_to_quats(R):
+    """
+    Unit quaternions [..., 4] with w >= 0 of rotation matrices [..., 3, 3]. Each quaternion is computed from the
+    largest of its four components (Shepperd's method), which keeps it accurate for all rotations.
+    """
+    r00, r11, r22 = R[..., 0, 0], R[..., 1, 1], R[..., 2, 2]
+    # four candidates, each scaled by 4 times one of the components
+    candidates = _stack([_stack([1 + r00 + r11 + r22, R[..., 2, 1] - R[..., 1, 2],
+                                 R[..., 0, 2] - R[..., 2, 0], R[..., 1, 0] - R[..., 0, 1]], axis=-1),
+                         _stack([R[..., 2, 1] - R[..., 1, 2], 1 + r00 - r11 - r22,
+                                 R[..., 0, 1] + R[..., 1, 0], R[..., 0, 2] + R[..., 2, 0]], axis=-1),
+                         _stack([R[..., 0, 2] - R[..., 2, 0], R[..., 0, 1] + R[..., 1, 0],
+                                 1 - r00 + r11 - r22, R[..., 1, 2] + R[..., 2, 1]], axis=-1),
+                         _stack([R[..., 1, 0] - R[..., 0, 1], R[..., 0, 2] + R[..., 2, 0],
+                                 R[..., 1, 2] + R[..., 2, 1], 1 - r00 - r11 + r22], axis=-1)], axis=-2)
+    largest = _stack([1 + r00 + r11 + r22, 1 + r00 - r11 - r22, 1 - r00 + r11 - r22, 1 - r00 - r11 + r22], axis=-1)
+    if _is_torch(R):
+        best = torch.argmax(largest, dim=-1)
+        quats = torch.gather(candidates, -2, best[..., None, None].expand(best.shape + (1, 4)))[..., 0, :]
+        quats = quats * torch.where(quats[..., :1] < 0, -1.0, 1.0)
+    else:
+        best = np.argmax(largest, axis=-1)
+        quats = np.take_along_axis(candidates, best[..., None, None], axis=-2)[..., 0, :]
+        quats = quats * np.where(quats[..., :1] < 0, -1.0, 1.0)
+    return _normalize(quats)
+
+
+def rotation_from_6d(rot_param, orthonormal=True):
+    """
+    Rotation matrices [..., 3, 3] from the 6D representation [..., 6] (Gram-Schmidt of the two rows).
+    orthonormal=False leaves the length of the second row as it is, like posQuatPrediction.rot_loss6D.
+    """
+    row1 = _normalize(rot_param[..., :3])
+    row2 = rot_param[..., 3:] - _dot(row1, rot_param[..., 3:]) * row1
+    if orthonormal:
+        row2 = _normalize(row2)
+    row3 = _cross(row1, row2)
+    return _stack([row1, row2, row3], axis=-2)
+
+
+def rotation_to_6d(R):
+    # [..., 3, 3] -> [..., 6], inverse of rotation_from_6d for rotation matrices
+    return _cat([R[..., 0, :], R[..., 1, :]], axis=-1)
+
+
+def pose_to_markers(rotation, translation, patterns):
+    """
+    Markers [..., M, 3] of the poses given by rotation and translation [..., 3] for patterns [..., M, 3] with any number
+    of markers M. The rotation is either unit quaternions [..., 4] or rotation matrices [..., 3, 3]. All leading
+    dimensions are broadcast, e.g. quaternions [T x N x 4] with compact patterns [N x 4 x 3].
+    """
+    if rotation.shape[-1] == 4:
+        rotated = qrot(rotation[..., None, :], patterns)
+    elif _is_torch(rotation):
+        rotated = torch.matmul(patterns, rotation.transpose(-1, -2))
+    else:
+        rotated = np.matmul(patterns, np.swapaxes(rotation, -1, -2))
+    return rotated + translation[..., None, :]
+
+
+def marker_loss(pred_markers, true_markers, visible=None):
+    """
+    Mean squared error between predicted markers [..., M, 3] and true markers with the same number of elements, e.g.
+    flattened [T x N x 3M]. visible [..., M] excludes missing markers, the mean is then over the visible ones only.
+    Without visible this is nn.MSELoss.
+    """
+    squared_error = (pred_markers - true_markers.reshape(pred_markers.shape)) ** 2
+    if visible is None:
+        return squared_error.mean()
+    visible = visible[..., None]
+    if _is_torch(squared_error):
+        return torch.sum(squared_error * visible) / torch.clamp(3 * torch.sum(visible), min=1)
+    return np.sum(squared_error * visible) / max(3 * np.sum(visible), 1)
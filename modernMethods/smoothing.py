@@ -0,0 +1,109 @@
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+
+# Rolling median and mean of trajectories [K x T x D] (objects x frames x dimensions) for all objects and dimensions at
+# once, on sliding window views along time. Like pandas rolling(window), only the complete windows are returned, i.e.
+# T - window + 1 frames where output frame t covers the input frames t, ..., t + window - 1. A window is NaN if it has
+# fewer than min_periods valid values, the default (the window size) gives NaN for every window that touches a gap,
+# the pandas default. Quaternions are brought into one hemisphere before they are filtered and normalised afterwards.
+# smooth streams over long recordings (e.g. memory maps of viconData stores) in chunks of frames that overlap by the
+# window sizes, its result does not depend on the chunk size.
+
+
+def _rolling_valid_counts(is_valid, window):
+    # number of valid values in the windows along the last axis, exact also for long sequences
+    counts = np.concatenate([np.zeros(is_valid.shape[:-1] + (1,), dtype=np.int64),
+                             np.cumsum(is_valid, axis=-1, dtype=np.int64)], axis=-1)
+    return counts[..., window:] - counts[..., :-window]
+
+
+def rolling_median(x, window, min_periods=None):
+    """
+    Rolling median of x [K x T x D] along time, returns [K x T - window + 1 x D].
+    The windows are sorted with the NaNs last, the median of the valid values is read at the position given by their
+    number, so windows with gaps do not need a separate path.
+    """
+    min_periods = window if min_periods is None else min_periods
+    # time as the last, contiguous axis: [K x D x T]
+    values = np.ascontiguousarray(np.moveaxis(x, 1, -1))
+    sorted_windows = np.sort(sliding_window_view(values, window, axis=-1), axis=-1)
+    n_valid = _rolling_valid_counts(np.logical_not(np.isnan(values)), window)
+    lower = np.take_along_axis(sorted_windows, np.maximum((n_valid - 1) // 2, 0)[..., None], axis=-1)[..., 0]
+    upper = np.take_along_axis(sorted_windows, np.minimum(n_valid // 2, window - 1)[..., None], axis=-1)[..., 0]
+    median = np.where(n_valid >= max(min_periods, 1), (lower + upper) / 2, np.nan)
+    return np.moveaxis(median, -1, 1)
+
+
+def rolling_mean(x, window, min_periods=None):
+    # rolling mean of x [K x T x D] along time, returns [K x T - window + 1 x D]
+    min_periods = window if min_periods is None else min_periods
+    values = np.ascontiguousarray(np.moveaxis(x, 1, -1))
+    is_valid = np.logical_not(np.isnan(values))
+    sums = np.sum(sliding_window_view(np.where(is_valid, values, 0), window, axis=-1), axis=-1)
+    n_valid = _rolling_valid_counts(is_valid, window)
+    mean = np.where(n_valid >= max(min_periods, 1), sums / np.maximum(n_valid, 1), np.nan)
+    return np.moveaxis(mean, -1, 1)
+
+
+def align_quaternion_signs(quats, previous=None):
+    """
+    Flips quaternions [K x T x 4], T > 0, (q and -q are the same rotation) such that each one is in the hemisphere of
+    the previous valid one of its object, NaN frames are skipped. previous [K x 4] are the last valid aligned
+    quaternions before this block of frames (NaN or None for none).
+    Returns the aligned quaternions and the last valid aligned quaternion of every object, for the next block.
+    """
+    K, T = quats.shape[:2]
+    if previous is None:
+        previous = np.full([K, 4], np.nan, dtype=quats.dtype)
+    is_valid = np.logical_not(np.isnan(quats[:, :, 0]))
+    # index of the last valid frame before every frame, -1 before the first one
+    last_valid = np.maximum.accumulate(np.where(is_valid, np.arange(T), -1), axis=1)
+    before = np.concatenate([np.full([K, 1], -1), last_valid[:, :-1]], axis=1)
+    reference = np.where((before >= 0)[:, :, None],
+                         np.take_along_axis(quats, np.maximum(before, 0)[:, :, None], axis=1),
+                         previous[:, None, :])
+    # flips relative to the unaligned reference, the first valid frame compares with the aligned previous
+    flips = np.where(np.sum(quats * reference, axis=2) < 0, -1, 1)
+    aligned = quats * np.cumprod(flips, axis=1).astype(quats.dtype)[:, :, None]
+
+    last = np.take_along_axis(aligned, np.maximum(last_valid[:, -1:], 0)[:, :, None], axis=1)[:, 0]
+    return aligned, np.where((last_valid[:, -1] >= 0)[:, None], last, previous)
+
+
+def smooth(x, median_window=20, mean_window=10, quaternions=False, min_periods=None, chunk_size=20000, out=None):
+    """
+    Rolling median followed by a rolling mean, like pd.DataFrame(x[k]).rolling(median_window).median() and
+    .rolling(mean_window).mean() per object without the incomplete windows.
+    x:            [K x T x D] trajectories, e.g. positions or quaternions (w, x, y, z) of all birds, or a memory map
+    quaternions:  align the signs before filtering and normalise the result
+    min_periods:  fewest valid values of a window (at most the window size) for a result, None for complete windows
+    chunk_size:   output frames per chunk, the memory used is about (median_window + 2) times a chunk of x
+    out:          optional output array [K x T - median_window - mean_window + 2 x D], e.g. np.lib.format.open_memmap
+    """
+    K, T, D = x.shape
+    # float32 input (e.g. viconData stores) is filtered in float32, the sorts of the median are faster
+    dtype = x.dtype if x.dtype in [np.float32, np.float64] else np.float64
+    overlap = median_window + mean_window - 2
+    T_out = max(T - overlap, 0)
+    if out is None:
+        out = np.empty([K, T_out, D], dtype=dtype)
+    median_periods = None if min_periods is None else min(min_periods, median_window)
+    mean_periods = None if min_periods is None else min(min_periods, mean_window)
+
+    previous = None
+    # the last overlap input frames of the previous chunk, already aligned
+    carry = np.zeros([K, 0, D], dtype=dtype)
+    for lo in range(0, T_out, chunk_size):
+        hi = min(lo + chunk_size, T_out)
+        new = np.asarray(x[:, lo + carry.shape[1]:hi + overlap], dtype=dtype)
+        if quaternions:
+            new, previous = align_quaternion_signs(new, previous)
+        chunk = np.concatenate([carry, new], axis=1)
+        carry = chunk[:, chunk.shape[1] - overlap:]
+
+        smoothed = rolling_mean(rolling_median(chunk, median_window, median_periods), mean_window, mean_periods)
+        if quaternions:
+            smoothed = smoothed / np.linalg.norm(smoothed, axis=2, keepdims=True)
+        out[:, lo:hi] = smoothed
+    return out
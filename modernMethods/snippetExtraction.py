@@ -0,0 +1,112 @@
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+
+# Extraction of training snippets [N x length x D] from trajectories [K x T x D] (objects x frames x dimensions). All
+# windows of a trajectory are a sliding window view (no copy), the NaN frames and jumps of every window are counted for
+# all windows at once with cumulative sums, and only the accepted windows are gathered (copied). Instead of printing
+# every rejected window the functions return statistics, the numbers of accepted and rejected windows by reason.
+
+# jump measures between consecutive frames:
+# displacement: distance between the positions, e.g. a marker swap of the tracker
+# norm:         increase of the distance to the origin, the measure of cleanKalman
+JUMP_MEASURES = ['displacement', 'norm']
+
+
+def frame_validity(pos, max_jump=None, jump_measure='displacement'):
+    """
+    Returns the NaN frames [K x T] (any dimension NaN) and the jumps [K x T - 1] larger than max_jump between frames t
+    and t + 1 of the positions pos [K x T x D] (no jumps for max_jump None).
+    """
+    assert jump_measure in JUMP_MEASURES, 'jump_measure has to be one of {}'.format(JUMP_MEASURES)
+    is_nan = np.any(np.isnan(pos), axis=2)
+    if max_jump is None:
+        return is_nan, np.zeros([pos.shape[0], max(pos.shape[1] - 1, 0)], dtype=bool)
+    if jump_measure == 'displacement':
+        steps = np.linalg.norm(np.diff(pos, axis=1), axis=2)
+    else:
+        steps = np.diff(np.linalg.norm(pos, axis=2), axis=1)
+    # comparisons with NaN are False, those frames are NaN frames already
+    return is_nan, steps > max_jump
+
+
+def _window_counts(mask, window):
+    # number of True values in all windows along the last axis
+    counts = np.concatenate([np.zeros(mask.shape[:-1] + (1,), dtype=np.int64),
+                             np.cumsum(mask, axis=-1, dtype=np.int64)], axis=-1)
+    return counts[..., window:] - counts[..., :-window]
+
+
+def find_runs(mask, breaks=None):
+    """
+    Runs of True values of mask [K x T] along time, breaks [K x T - 1] optionally splits runs between frame t and t + 1.
+    Returns the objects, first frames and lengths of the runs [R], sorted by object and first frame.
+    """
+    linked = np.logical_and(mask[:, 1:], mask[:, :-1])
+    if breaks is not None:
+        linked = np.logical_and(linked, np.logical_not(breaks))
+    starts = mask.copy()
+    starts[:, 1:] &= np.logical_not(linked)
+    ends = mask.copy()
+    ends[:, :-1] &= np.logical_not(linked)
+    # every run has one start and one end, nonzero returns both in the same order
+    objects, first_frames = np.nonzero(starts)
+    last_frames = np.nonzero(ends)[1]
+    return objects, first_frames, last_frames - first_frames + 1
+
+
+def gather_windows(x, objects, starts, length):
+    # copies of the windows x[objects[n], starts[n]:starts[n] + length] of x [K x T x D], returns [N x length x D]
+    if len(objects) == 0:
+        return np.zeros((0, length) + x.shape[2:], dtype=x.dtype)
+    windows = sliding_window_view(x, length, axis=1)[objects, starts]
+    return np.ascontiguousarray(np.moveaxis(windows, -1, 1))
+
+
+def extract_snippets(pos, length, interval, max_jump=None, jump_measure='displacement', arrays=()):
+    """
+    Windows of length frames starting every interval frames of every object of pos [K x T x D] that contain neither a
+    NaN frame nor a jump larger than max_jump (see frame_validity).
+    arrays: further [K x T x ...] arrays, e.g. quaternions, whose windows at the same frames are returned as well
+    Returns the position snippets [N x length x D], the list of snippets of arrays and the statistics
+    {'windows', 'valid', 'nan', 'jump'}: windows with NaN frames are counted as 'nan' only.
+    """
+    K, T = pos.shape[:2]
+    starts = np.arange(0, max(T - length + 1, 0), interval)
+    is_nan, is_jump = frame_validity(pos, max_jump, jump_measure)
+    # [K x windows], a window has length - 1 transitions
+    has_nan = _window_counts(is_nan, length)[:, starts] > 0
+    if length > 1:
+        has_jump = np.logical_and(_window_counts(is_jump, length - 1)[:, starts] > 0, np.logical_not(has_nan))
+    else:
+        has_jump = np.zeros_like(has_nan)
+    objects, window_indices = np.nonzero(np.logical_not(np.logical_or(has_nan, has_jump)))
+
+    snippets = gather_windows(pos, objects, starts[window_indices], length)
+    array_snippets = [gather_windows(array, objects, starts[window_indices], length) for array in arrays]
+    stats = {'windows': K * len(starts), 'valid': len(objects), 'nan': int(np.sum(has_nan)),
+             'jump': int(np.sum(has_jump))}
+    return snippets, array_snippets, stats
+
+
+def extract_segment_snippets(pos, length, max_jump=None, jump_measure='displacement', arrays=()):
+    """
+    Cuts the clean segments of every object of pos [K x T x D], the runs of frames without NaN frames and jumps, into
+    consecutive snippets of length frames from the start of each segment, the rest of a segment is dropped.
+    Returns the position snippets [N x length x D], the list of snippets of arrays (see extract_snippets) and the
+    statistics {'segments', 'valid', 'nan', 'jump'}: the numbers of segments, snippets, NaN frames and jumps.
+    """
+    is_nan, is_jump = frame_validity(pos, max_jump, jump_measure)
+    segment_objects, segment_starts, segment_lengths = find_runs(np.logical_not(is_nan), is_jump)
+    n_snippets = segment_lengths // length
+    # snippet n of a segment starts n * length frames after the start of the segment
+    first_snippet = np.cumsum(n_snippets) - n_snippets
+    offsets = (np.arange(np.sum(n_snippets)) - np.repeat(first_snippet, n_snippets)) * length
+    objects = np.repeat(segment_objects, n_snippets)
+    starts = np.repeat(segment_starts, n_snippets) + offsets
+
+    snippets = gather_windows(pos, objects, starts, length)
+    array_snippets = [gather_windows(array, objects, starts, length) for array in arrays]
+    stats = {'segments': len(segment_starts), 'valid': len(objects), 'nan': int(np.sum(is_nan)),
+             'jump': int(np.sum(is_jump))}
+    return snippets, array_snippets, stats
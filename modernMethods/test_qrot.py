@@ -3,33 +3,8 @@ import torch
 
 from pyquaternion import Quaternion as Quaternion
 
+from rotations import qrot
 
-def qrot(q, v):
-    #TODO check order of quaternion
-    #TODO should I make 12 dim output?
-    #TODO can I change this function to also work with constant v and changing quaternions?
-    # if not just tile/stack v accordingly
-    """
-    Rotate vector(s) v about the rotation described by quaternion(s) q.
-    Expects a tensor of shape (*, 4) for q and a tensor of shape (*, 3) for v,
-    where * denotes any number of dimensions.
-    Returns a tensor of shape (*, 3).
-
-    source: https://github.com/facebookresearch/QuaterNet/blob/master/common/quaternion.py
-    """
-    assert q.shape[-1] == 4
-    assert v.shape[-1] == 3
-    assert q.shape[:-1] == v.shape[:-1]
-
-
-    original_shape = list(v.shape)
-    q = q.view(-1, 4)
-    v = v.view(-1, 3)
-
-    qvec = q[:, 1:]
-    uv = torch.cross(qvec, v, dim=1)
-    uuv = torch.cross(qvec, uv, dim=1)
-    return (v + 2 * (q[:, :1] * uv + uuv)).view(original_shape)
 
 def quat2matbad(q):
     """
@@ -0,0 +1,89 @@
+import torch
+
+import inferenceExport
+from trackerModels import SOTTracker, LSTMEncoderTracker, detection_input_size, input_layout
+
+
+# Frame by frame inference with step() has to give the same poses as the full forward pass over the sequences.
+# Runs with pytest or as a script: python test_streaming.py
+
+T = 20
+N = 8
+
+
+def random_batch(add_false_positives):
+    detections = torch.randn(T, N, detection_input_size(add_false_positives))
+    patterns = torch.randn(N, 4, 3)
+    return detections, patterns
+
+
+def stream(model, detections, patterns):
+    quats = []
+    positions = []
+    state = None
+    with torch.no_grad():
+        for t in range(detections.shape[0]):
+            quat, pos, state = model.step(detections[t], patterns, state)
+            quats.append(quat)
+            positions.append(pos)
+    return torch.stack(quats, dim=0), positions
+
+
+def trained_like(model):
+    # a few training steps give the BatchNorm layers running statistics that differ from the initial ones
+    model.train()
+    with torch.no_grad():
+        for _ in range(3):
+            model(*random_batch(model.fc1_det.in_features == detection_input_size(True)))
+    return model.eval()
+
+
+def test_sot_tracker_step_matches_forward():
+    for add_false_positives in [False, True]:
+        for use_const_pat in [False, True]:
+            torch.manual_seed(0)
+            model = trained_like(SOTTracker(add_false_positives, use_const_pat))
+            detections, patterns = random_batch(add_false_positives)
+            with torch.no_grad():
+                full_quats, full_pos = model(detections, patterns)
+            quats, positions = stream(model, detections, patterns)
+            assert torch.allclose(quats, full_quats, atol=1e-5)
+            assert torch.allclose(torch.stack(positions, dim=0), full_pos, atol=1e-5)
+
+
+def test_lstm_encoder_tracker_step_matches_forward():
+    for add_false_positives in [False, True]:
+        for use_const_pat in [False, True]:
+            torch.manual_seed(0)
+            model = trained_like(LSTMEncoderTracker(add_false_positives, use_const_pat))
+            detections, patterns = random_batch(add_false_positives)
+            with torch.no_grad():
+                full_quats = model(detections, patterns)
+            quats, positions = stream(model, detections, patterns)
+            assert torch.allclose(quats, full_quats, atol=1e-5)
+            assert all(pos is None for pos in positions)
+
+
+def test_exported_tracker_step_matches_forward():
+    torch.manual_seed(0)
+    model = inferenceExport.export_for_inference(trained_like(LSTMEncoderTracker()), 'float32')
+    detections, patterns = random_batch(False)
+    with torch.no_grad():
+        full_quats = model(detections, patterns)
+    quats, _ = stream(model, detections, patterns)
+    assert torch.allclose(quats, full_quats, atol=1e-5)
+
+
+def test_input_layout():
+    assert input_layout(LSTMEncoderTracker()) == (True, 0)
+    assert input_layout(SOTTracker(add_false_positives=True)) == (True, 2)
+    assert input_layout(inferenceExport.export_for_inference(LSTMEncoderTracker(True), 'int8')) == (True, 2)
+    assert input_layout(inferenceExport.export_for_inference(SOTTracker(), 'bfloat16')) == (True, 0)
+
+
+if __name__ == '__main__':
+    test_sot_tracker_step_matches_forward()
+    test_lstm_encoder_tracker_step_matches_forward()
+    test_exported_tracker_step_matches_forward()
+    test_input_layout()
+    print('step() matches forward()')
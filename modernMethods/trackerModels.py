@@ -0,0 +1,209 @@
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+
+# The single object trackers of posQuatPrediction that can also run frame by frame (step), in a module of their own so
+# they can be built and tested without running the training script. Their input is a frame of the X_shuffled
+# detections of dataSynthesis.synthesize_detections: x, y, z and a missing flag per detection slot, the N_MARKERS
+# marker slots followed by N_FALSE_POSITIVE_SLOTS slots for false positives if the data has them.
+
+N_MARKERS = 4
+FEATURES_PER_DETECTION = 4
+N_FALSE_POSITIVE_SLOTS = 2
+
+
+def detection_input_size(add_false_positives):
+    n_slots = N_MARKERS + (N_FALSE_POSITIVE_SLOTS if add_false_positives else 0)
+    return n_slots * FEATURES_PER_DETECTION
+
+
+def flatten_patterns(patterns):
+    # [T x N x 4 x 3] -> [T x N x 12], compact patterns [N x 4 x 3] -> [1 x N x 12]
+    return patterns.view(-1, patterns.size(-3), 12)
+
+
+def expand_patterns(patterns, n_frames):
+    """
+    Patterns are either given per frame [T x N x 4 x 3] or compact, once per sequence [N x 4 x 3].
+    Compact patterns are broadcast over n_frames as a view, without copying them.
+    """
+    if patterns.dim() == 3:
+        return patterns.unsqueeze(0).expand(n_frames, -1, -1, -1)
+    return patterns
+
+
+def batchnorm(bn, x):
+    # BatchNorm1d over the features of [T x N x F]
+    return bn(x.permute(0, 2, 1)).permute(0, 2, 1)
+
+
+class SOTTracker(nn.Module):
+    """
+    Predicts the 6D rotation and the position of every frame.
+    add_false_positives: the detections have the false positive slots
+    use_const_pat:       all birds share one pattern, the pattern encoder is left out
+    """
+    def __init__(self, add_false_positives=False, use_const_pat=False, fc1_det_dim=150):
+        super(SOTTracker, self).__init__()
+
+        self.fc1_det = nn.Linear(detection_input_size(add_false_positives), fc1_det_dim)
+        self.bn1 = nn.BatchNorm1d(fc1_det_dim)
+        self.fc2_det = nn.Linear(fc1_det_dim, 200)
+        self.bn2 = nn.BatchNorm1d(200)
+        self.fc3_det = nn.Linear(200, 250)
+        self.bn3 = nn.BatchNorm1d(250)
+        self.fc4_det = nn.Linear(250, 250)
+        self.bn4 = nn.BatchNorm1d(250)
+
+        if not use_const_pat:
+            self.fc1_pat = nn.Linear(12, 50)
+            self.fc2_pat = nn.Linear(50, 100)
+            self.fc3_pat = nn.Linear(100, 100)
+            self.fc4_pat = nn.Linear(100, 100)
+
+            self.bn1_pat = nn.BatchNorm1d(50)
+            self.bn2_pat = nn.BatchNorm1d(100)
+            self.bn3_pat = nn.BatchNorm1d(100)
+            self.bn4_pat = nn.BatchNorm1d(100)
+
+        if use_const_pat:
+            self.lstm = nn.LSTM(250, 500)
+        else:
+            self.lstm = nn.LSTM(250 + 100, 500)
+        self.lstm2 = nn.LSTM(500, 350)
+
+        self.hidden2out1_prediction = nn.Linear(350, 200)
+        self.hidden2out2_prediction = nn.Linear(200, 128)
+        self.hidden2out_bn1 = nn.BatchNorm1d(200)
+        self.hidden2out_bn2 = nn.BatchNorm1d(128)
+
+        self.hidden2quat1_prediction = nn.Linear(128, 128)
+        self.hidden2quat2_prediction = nn.Linear(128, 128)
+        self.hidden2quat3_prediction = nn.Linear(128, 6)
+        self.hidden2quat_bn1 = nn.BatchNorm1d(128)
+        self.hidden2quat_bn2 = nn.BatchNorm1d(128)
+
+        self.init_position_head()
+
+    def init_position_head(self):
+        self.hidden2pos1_prediction = nn.Linear(128, 128)
+        self.hidden2pos2_prediction = nn.Linear(128, 3)
+        self.hidden2pos_bn1 = nn.BatchNorm1d(128)
+
+    @property
+    def has_patterns(self):
+        # models trained with use_const_pat have no pattern encoder
+        return hasattr(self, 'fc1_pat')
+
+    def encode_detections(self, detections):
+        x = F.leaky_relu(batchnorm(self.bn1, self.fc1_det(detections)))
+        x = F.leaky_relu(batchnorm(self.bn2, self.fc2_det(x)))
+        x = F.leaky_relu(batchnorm(self.bn3, self.fc3_det(x)))
+        x = F.leaky_relu(batchnorm(self.bn4, self.fc4_det(x)))
+        return x
+
+    def encode_patterns(self, patterns):
+        if not self.has_patterns:
+            return None
+        x_pat = F.leaky_relu(batchnorm(self.bn1_pat, self.fc1_pat(flatten_patterns(patterns))))
+        x_pat = F.leaky_relu(batchnorm(self.bn2_pat, self.fc2_pat(x_pat)))
+        x_pat = F.leaky_relu(batchnorm(self.bn3_pat, self.fc3_pat(x_pat)))
+        x_pat = F.leaky_relu(batchnorm(self.bn4_pat, self.fc4_pat(x_pat)))
+        return x_pat
+
+    def recurrence(self, x, x_pat, hidden1=None, hidden2=None):
+        # compact patterns [1 x N x F] are broadcast over the frames of x
+        if x_pat is not None:
+            x = torch.cat([x, x_pat.expand(x.size(0), -1, -1)], dim=2)
+        x, hidden1 = self.lstm(x, hidden1)
+        x, hidden2 = self.lstm2(x, hidden2)
+        return x, hidden1, hidden2
+
+    def decode_rotation(self, x):
+        x = F.leaky_relu(batchnorm(self.hidden2out_bn1, self.hidden2out1_prediction(x)))
+        x = F.leaky_relu(batchnorm(self.hidden2out_bn2, self.hidden2out2_prediction(x)))
+
+        x_quat = F.leaky_relu(batchnorm(self.hidden2quat_bn1, self.hidden2quat1_prediction(x)))
+        x_quat = F.leaky_relu(batchnorm(self.hidden2quat_bn2, self.hidden2quat2_prediction(x_quat)))
+        return self.hidden2quat3_prediction(x_quat), x
+
+    def decode(self, x):
+        x_quat, x = self.decode_rotation(x)
+        x_pos = F.leaky_relu(batchnorm(self.hidden2pos_bn1, self.hidden2pos1_prediction(x)))
+        return x_quat, self.hidden2pos2_prediction(x_pos)
+
+    def forward(self, detections, patterns):
+        x, _, _ = self.recurrence(self.encode_detections(detections), self.encode_patterns(patterns))
+        return self.decode(x)
+
+    def step(self, detections_t, patterns, state=None):
+        """
+        Streaming inference, processes a single frame of N sequences.
+        detections_t: [N x 16] (or [N x 24] with false positives) detections of the current frame
+        patterns:     [N x 4 x 3] compact patterns, only used for the first frame
+        state:        None for the first frame, afterwards the state returned by the previous call. It carries the
+                      hidden and cell states of both LSTMs and the encoded patterns.
+        Returns the 6D rotation [N x 6] and the position [N x 3] of the current frame and the new state.
+
+        BatchNorm has to use its running statistics for single frames, so the model has to be in eval mode.
+        """
+        assert not self.training, 'call model.eval() before streaming inference'
+        if state is None:
+            x_pat, hidden1, hidden2 = self.encode_patterns(patterns), None, None
+        else:
+            x_pat, hidden1, hidden2 = state
+
+        x, hidden1, hidden2 = self.recurrence(self.encode_detections(detections_t.unsqueeze(0)), x_pat, hidden1,
+                                              hidden2)
+        x_quat, x_pos = self.decode(x)
+        return x_quat[0], x_pos[0], (x_pat, hidden1, hidden2)
+
+
+class LSTMEncoderTracker(SOTTracker):
+    """
+    SOTTracker with a wider first detection layer and without the position head, it only predicts the 6D rotation.
+    forward returns the rotations [T x N x 6], step returns None for the position.
+    """
+    def __init__(self, add_false_positives=False, use_const_pat=False):
+        super(LSTMEncoderTracker, self).__init__(add_false_positives, use_const_pat, fc1_det_dim=256)
+
+    def init_position_head(self):
+        pass
+
+    def forward(self, detections, patterns):
+        x, _, _ = self.recurrence(self.encode_detections(detections), self.encode_patterns(patterns))
+        return self.decode_rotation(x)[0]
+
+    def step(self, detections_t, patterns, state=None):
+        # see SOTTracker.step
+        assert not self.training, 'call model.eval() before streaming inference'
+        if state is None:
+            x_pat, hidden1, hidden2 = self.encode_patterns(patterns), None, None
+        else:
+            x_pat, hidden1, hidden2 = state
+
+        x, hidden1, hidden2 = self.recurrence(self.encode_detections(detections_t.unsqueeze(0)), x_pat, hidden1,
+                                              hidden2)
+        return self.decode_rotation(x)[0][0], None, (x_pat, hidden1, hidden2)
+
+
+def can_stream(model):
+    # trackers with step() for frame by frame inference, also after inferenceExport.export_for_inference
+    return callable(getattr(model, 'step', None))
+
+
+def input_layout(model):
+    """
+    Detection layout of a tracker from the width of its first detection layer (also for models exported with
+    inferenceExport). Returns whether every detection has a missing flag and the number of false positive slots.
+    """
+    model = getattr(model, 'model', model)
+    n_inputs = model.fc1_det.in_features
+    if n_inputs == 3 * N_MARKERS:
+        # trackers trained on detections without missing flags
+        return False, 0
+    n_slots, remainder = divmod(n_inputs, FEATURES_PER_DETECTION)
+    if remainder != 0 or n_slots < N_MARKERS:
+        raise ValueError('unknown detection layout with {} input features'.format(n_inputs))
+    return True, n_slots - N_MARKERS
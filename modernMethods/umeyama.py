@@ -0,0 +1,69 @@
+import numpy as np
+import torch
+
+
+# Batched version of patterns/umeyama.m. Solves detections ~ R @ pattern + t for many problems with known marker
+# correspondences in one batched SVD, markers that were not detected are masked out. With fewer than 3 visible markers
+# the rotation is not determined and NaN is returned.
+
+
+def umeyama_torch(patterns, detections, visible=None):
+    """
+    patterns:   [B x M x 3] marker positions in the body frame
+    detections: [B x M x 3] detected positions of the same markers
+    visible:    [B x M] bool, None means all markers are visible
+    Returns the rotation [B x 3 x 3], translation [B x 3] and the mean distance between the visible detections and
+    the transformed pattern [B] (MSE in umeyama.m).
+    """
+    if visible is None:
+        visible = torch.ones(patterns.shape[:2], dtype=torch.bool, device=patterns.device)
+    weights = visible.to(patterns.dtype).unsqueeze(2)
+    n_visible = weights.sum(dim=1)
+    # missing detections may hold anything (NaN, zeros), they must not reach the sums
+    patterns = torch.where(visible.unsqueeze(2), patterns, torch.zeros_like(patterns))
+    detections = torch.where(visible.unsqueeze(2), detections, torch.zeros_like(detections))
+
+    mean_pattern = (weights * patterns).sum(dim=1) / n_visible.clamp(min=1)
+    mean_detection = (weights * detections).sum(dim=1) / n_visible.clamp(min=1)
+    pattern_demean = weights * (patterns - mean_pattern.unsqueeze(1))
+    detection_demean = weights * (detections - mean_detection.unsqueeze(1))
+    sigma = torch.matmul(detection_demean.transpose(1, 2), pattern_demean) / n_visible.clamp(min=1).unsqueeze(2)
+
+    U, _, Vh = torch.linalg.svd(sigma)
+    # improper rotations are turned into proper ones by flipping the axis of the smallest singular value, for three or
+    # more visible markers sigma has at least rank 2, which is the first case of umeyama.m
+    S = torch.ones([sigma.size(0), 3], dtype=sigma.dtype, device=sigma.device)
+    S[:, 2] = torch.sign(torch.det(U) * torch.det(Vh))
+    R = torch.matmul(U * S.unsqueeze(1), Vh)
+    t = mean_detection - torch.matmul(R, mean_pattern.unsqueeze(2)).squeeze(2)
+
+    distances = torch.norm(detections - (torch.matmul(patterns, R.transpose(1, 2)) + t.unsqueeze(1)), dim=2)
+    error = (distances * weights.squeeze(2)).sum(dim=1) / n_visible.squeeze(1).clamp(min=1)
+
+    is_determined = (n_visible.squeeze(1) >= 3).to(R.dtype)
+    nan = torch.tensor(float('nan'), dtype=R.dtype, device=R.device)
+    R = torch.where(is_determined.view(-1, 1, 1) > 0, R, nan)
+    t = torch.where(is_determined.view(-1, 1) > 0, t, nan)
+    error = torch.where(is_determined > 0, error, nan)
+    return R, t, error
+
+
+def umeyama(patterns, detections, visible=None):
+    """
+    NumPy interface of umeyama_torch, arrays of any leading shape [... x M x 3] and visible [... x M].
+    """
+    batch_shape = patterns.shape[:-2]
+    n_markers = patterns.shape[-2]
+    patterns = torch.from_numpy(np.reshape(np.asarray(patterns, dtype=np.float64), [-1, n_markers, 3]))
+    detections = torch.from_numpy(np.reshape(np.asarray(detections, dtype=np.float64), [-1, n_markers, 3]))
+    if visible is not None:
+        visible = torch.from_numpy(np.reshape(np.asarray(visible, dtype=bool), [-1, n_markers]))
+    R, t, error = umeyama_torch(patterns, detections, visible)
+    return (np.reshape(R.numpy(), list(batch_shape) + [3, 3]), np.reshape(t.numpy(), list(batch_shape) + [3]),
+            np.reshape(error.numpy(), batch_shape))
+
+
+def rotation_angle(R_a, R_b):
+    # angle in degrees of the relative rotation R_a^T R_b, [... x 3 x 3] -> [...]
+    trace = np.trace(np.matmul(np.swapaxes(R_a, -1, -2), R_b), axis1=-2, axis2=-1)
+    return np.degrees(np.arccos(np.clip((trace - 1) / 2, -1, 1)))
@@ -0,0 +1,176 @@
+import os
+import re
+import xml.etree.ElementTree as ET
+
+import numpy as np
+import pandas as pd
+
+import dataStore
+
+
+# Reader for the VICON exports like datasets/20190124_10BirdsWeightTrials05_testdata.csv. The header has five rows:
+# the section name ('Objects'), the frame rate, one 'Global Angle (Quaternion) <subject>:<segment>' entry at the first
+# column of every subject, the column names (Frame, Sub Frame, then RX, RY, RZ, RW, TX, TY, TZ per subject) and the
+# units. The frames follow until an empty line or the end of the file, empty fields are frames where a subject was not
+# tracked. Positions and quaternions are returned per subject, [K x T x 3] and [K x T x 4] in (w, x, y, z) order, which
+# keeps the frames of one bird contiguous.
+
+HEADER_ROWS = 5
+# columns of a subject in the order of the returned arrays: the quaternion (w, x, y, z), then the position
+SUBJECT_COLUMNS = ['RW', 'RX', 'RY', 'RZ', 'TX', 'TY', 'TZ']
+
+
+def read_vicon_header(file_name):
+    """
+    Returns the subject names [K], the column indices of SUBJECT_COLUMNS for every subject [K x 7], the column of the
+    frame numbers and the frame rate.
+    """
+    with open(file_name) as f:
+        header = [next(f).rstrip('\r\n').split(',') for _ in range(HEADER_ROWS)]
+    frame_rate = float(header[1][0])
+    subject_row, column_row = header[2], header[3]
+    starts = [i for i, name in enumerate(subject_row) if name]
+    subjects = []
+    columns = []
+    for start, end in zip(starts, starts[1:] + [len(column_row)]):
+        names = column_row[start:end]
+        subjects.append(subject_row[start].split(':')[0].split(' ')[-1])
+        columns.append([start + names.index(name) for name in SUBJECT_COLUMNS])
+    return subjects, np.array(columns, dtype=np.int64), column_row.index('Frame'), frame_rate
+
+
+def count_frames(file_name):
+    # number of rows of the first section, it ends at the first empty line
+    with open(file_name) as f:
+        for _ in range(HEADER_ROWS):
+            next(f)
+        n_rows = 0
+        for line in f:
+            if not line.strip():
+                break
+            n_rows += 1
+    return n_rows
+
+
+def read_vicon_csv(file_name, dtype=np.float64, chunk_rows=100000):
+    """
+    Reads all frames of a VICON export with the pandas C parser, chunk_rows frames at a time, and gathers the columns
+    of all subjects of a chunk in one indexing operation, so memory beyond the result is one chunk.
+    Frames missing from the file (gaps in the frame numbers) are NaN like untracked subjects.
+    Returns the arrays {'frames': [T], 'pos': [K x T x 3], 'quats': [K x T x 4]} and
+    the info {'subjects': [K], 'frame_rate', 'source'}.
+    """
+    subjects, columns, frame_column, frame_rate = read_vicon_header(file_name)
+    n_rows = count_frames(file_name)
+    frames = np.zeros([n_rows], dtype=np.int64)
+    # [K x T x 7]
+    subject_values = np.zeros([len(subjects), n_rows, len(SUBJECT_COLUMNS)], dtype=dtype)
+    if n_rows > 0:
+        reader = pd.read_csv(file_name, skiprows=HEADER_ROWS, header=None, nrows=n_rows,
+                             usecols=range(np.max(columns) + 1), dtype=np.float64, chunksize=chunk_rows)
+        lo = 0
+        for chunk in reader:
+            values = chunk.to_numpy()
+            frames[lo:lo + len(values)] = values[:, frame_column]
+            subject_values[:, lo:lo + len(values)] = values[:, columns].transpose([1, 0, 2])
+            lo += len(values)
+
+    T = frames[-1] - frames[0] + 1 if n_rows > 0 else 0
+    if n_rows != T:
+        all_values = np.full([len(subjects), T, len(SUBJECT_COLUMNS)], np.nan, dtype=dtype)
+        all_values[:, frames - frames[0]] = subject_values
+        subject_values = all_values
+        frames = np.arange(frames[0], frames[0] + T)
+
+    arrays = {'frames': frames, 'pos': np.ascontiguousarray(subject_values[:, :, 4:]),
+              'quats': np.ascontiguousarray(subject_values[:, :, :4])}
+    info = {'subjects': subjects, 'frame_rate': frame_rate, 'source': file_name}
+    return arrays, info
+
+
+def split_subjects(values):
+    """
+    Splits a VICON table [T x 7K] with the columns RX, RY, RZ, RW, TX, TY, TZ per subject into the positions
+    [K x T x 3] and quaternions [K x T x 4] in (w, x, y, z) order.
+    """
+    n_subjects = values.shape[1] // 7
+    values = np.reshape(values[:, :n_subjects * 7], [values.shape[0], n_subjects, 7]).transpose([1, 0, 2])
+    return values[:, :, 4:], np.concatenate([values[:, :, 3:4], values[:, :, :3]], axis=2)
+
+
+def save_vicon_store(dir_name, file_name, chunk_size=100000):
+    """
+    Converts a VICON export into a dataStore directory (float32, NaN where a subject was not tracked), the subjects,
+    frame rate and source file are kept in the flags of the manifest.
+    """
+    arrays, info = read_vicon_csv(file_name, dtype=np.float32)
+    return dataStore.save_store(dir_name, arrays, flags=info, chunk_size=chunk_size)
+
+
+def load_vicon_store(dir_name):
+    # memory mapped arrays of save_vicon_store and the info of read_vicon_csv
+    arrays, manifest = dataStore.load_store(dir_name)
+    return arrays, manifest['flags']
+
+
+FRAME_LINE = re.compile(r'Frame Number: (\d+)')
+UNLABELED_LINE = re.compile(r'\s*Unlabeled Markers \((\d+)\)')
+
+
+def read_vicon_txt(file_name):
+    """
+    Python version of datasets/readTxtData.m, reads the unlabeled detections of a VICON .txt log. Every frame starts
+    with 'Frame Number: t', its detections follow the line 'Unlabeled Markers (n)' as one '(x, y, z)' line each. Logs
+    that start over at their first frame are read up to there, like in readTxtData.m.
+    Returns the detections [T x maxDetectionsPerFrame x 3], NaN padded, the same layout as
+    multiObjectTracking.load_unlabeled_detections.
+    """
+    frame_detections = {}
+    t = -1
+    first_frame = -1
+    with open(file_name) as f:
+        for line in f:
+            match = FRAME_LINE.match(line)
+            if match:
+                t = int(match.group(1))
+                if first_frame >= 0 and t + 1 == first_frame:
+                    break
+                continue
+            match = UNLABELED_LINE.match(line)
+            if match:
+                n_detections = int(match.group(1))
+                detections = []
+                for _ in range(n_detections):
+                    marker_line = next(f)
+                    detections.append(marker_line[marker_line.index('(') + 1:marker_line.rindex(')')].split(','))
+                frame_detections[t] = detections
+                if first_frame < 0 and n_detections > 0:
+                    first_frame = t + 1
+
+    T = max(frame_detections) + 1 if frame_detections else 0
+    width = max([len(detections) for detections in frame_detections.values()] + [0])
+    all_detections = np.full([T, width, 3], np.nan)
+    for t, detections in frame_detections.items():
+        if detections:
+            all_detections[t, :len(detections)] = np.array(detections, dtype=np.float64)
+    return all_detections
+
+
+def read_vsk_pattern(file_name):
+    # marker positions [M x 3] of a VICON subject file, from its '<subject>_<marker>_x|y|z' parameters
+    markers = {}
+    for parameter in ET.parse(file_name).getroot().iter('Parameter'):
+        name = parameter.get('NAME')
+        if name[-2:] in ['_x', '_y', '_z']:
+            markers.setdefault(name[:-2], [0.0, 0.0, 0.0])['xyz'.index(name[-1])] = float(parameter.get('VALUE'))
+    return np.array(list(markers.values()))
+
+
+def read_vsk_patterns(dir_name):
+    """
+    Patterns of all .vsk files of a directory in file name order, like patterns/read_patterns.m.
+    Returns the subject names [P] and the patterns [P x M x 3] in the units of the files (mm).
+    """
+    file_names = sorted(f for f in os.listdir(dir_name) if f.endswith('.vsk'))
+    patterns = np.stack([read_vsk_pattern(os.path.join(dir_name, f)) for f in file_names], axis=0)
+    return [os.path.splitext(f)[0] for f in file_names], patterns
@@ -27,7 +27,8 @@ import matplotlib.pyplot as plt
 import mpl_toolkits.mplot3d.axes3d as p3
 import matplotlib.animation as animation
 
-from pyquaternion import Quaternion as Quaternion
+import viconData
+from rotations import quats_to_rotation_matrices, rotation_from_6d
 
 import os, os.path
 
@@ -49,14 +50,6 @@ save_animation = False
 
 patterns = np.load('data/patterns.npy')
 
-def rot_mat_from_6d(rot):
-    column1 = rot[:3] / np.linalg.norm(rot[:3])
-    tmp = np.sum(column1* rot[3:]) * column1
-    column2 = rot[3:] - tmp
-    column3 = np.cross(column1, column2)
-    return np.stack([column1, column2, column3], axis=0)
-
-
 class MetaParams:
     def __init__(self, first_frame, last_frame, use_corrected_vicon):
         self.first_frame = first_frame
@@ -121,10 +114,9 @@ def run_tracking_animation(tracked_objects, length, animation_params, fig, ax):
                 lines.append(object.true_line)
 
             if object.rot_representation == 'quat':
-                q_predicted = Quaternion(object.predicted_rot[t, :])
-                rot_mat_predicted = q_predicted.rotation_matrix
+                rot_mat_predicted = quats_to_rotation_matrices(object.predicted_rot[t, :])
             else:
-                rot_mat_predicted = rot_mat_from_6d(object.predicted_rot[t, :])
+                rot_mat_predicted = rotation_from_6d(object.predicted_rot[t, :])
 
             rotated_pattern_predicted = (rot_mat_predicted @ object.pattern.T).T
             if object.predicted_pos is not None:
@@ -134,10 +126,9 @@ def run_tracking_animation(tracked_objects, length, animation_params, fig, ax):
 
             # now with VICON predictions
             #if object.rot_representation == 'quat':
-            q_true = Quaternion(object.true_rot[t, :])
-            rot_mat_true = q_true.rotation_matrix
+            rot_mat_true = quats_to_rotation_matrices(object.true_rot[t, :])
             #else:
-            #    rot_mat_true = rot_mat_from_6d(object.true_rot[t, :])
+            #    rot_mat_true = rotation_from_6d(object.true_rot[t, :])
             rotated_pattern_true = (rot_mat_true @ object.pattern.T).T
             if object.predicted_pos is not None:
                 true_markers = rotated_pattern_true + object.true_pos[t, :]
@@ -258,14 +249,12 @@ def run_animation(dataAndLines, length, animation_params, ax, fig):
 
                 # calculate the expected marker locations
                 # first with the kalman predictions
-                q = Quaternion(bird.kalmanQuat[t, :])
-                rot_mat = q.rotation_matrix
+                rot_mat = quats_to_rotation_matrices(bird.kalmanQuat[t, :])
                 rotated_pattern = np.dot(rot_mat, pattern.T).T
                 expected_markers_kalman = rotated_pattern + bird.kalmanPos[t, :]
 
                 # now with VICON predictions
-                q_vicon = Quaternion(bird.viconQuat[t, :])
-                rot_mat_vicon = q_vicon.rotation_matrix
+                rot_mat_vicon = quats_to_rotation_matrices(bird.viconQuat[t, :])
                 rotated_pattern_vicon = np.dot(rot_mat_vicon, pattern.T).T
                 expected_markers_vicon = rotated_pattern_vicon + bird.viconPos[t, :]
 
@@ -332,14 +321,8 @@ def load_corrected_vicon():
     import pandas as pd
     corrected_vicon_df = pd.read_csv('../../correctedVICON.csv')
     corrected_vicon = corrected_vicon_df.to_numpy()
-    corrected_vicon = corrected_vicon[1:,1:-1]
-    viconPos = np.zeros([10, np.shape(corrected_vicon)[0], 3]) * np.NaN
-    viconQuats = np.zeros([10, np.shape(corrected_vicon)[0], 4]) * np.NaN
-    for t in range(np.shape(corrected_vicon)[0]):
-        for k in range(10):
-            viconPos[k, t, :] = corrected_vicon[t, k * 7 + 4:(k + 1) * 7]
-            viconQuats[k, t, 0] = corrected_vicon[t, k * 7 + 3]
-            viconQuats[k, t, 1:] = corrected_vicon[t, k * 7:k * 7 + 3]
+    corrected_vicon = corrected_vicon[1:,1:-1].astype(np.float64)
+    viconPos, viconQuats = viconData.split_subjects(corrected_vicon)
     np.save('data/corrected_vicon_pos.npy', viconPos)
     np.save('data/corrected_vicon_quats.npy', viconQuats)
 
@@ -379,13 +362,7 @@ def importAndStoreMATLABData():
         vicon = pickle.load(fin)
     # extract positions and quaternions from unified table
     # make sure to bring quaternions into normal order
-    viconPos = np.zeros([10, np.shape(vicon)[0], 3]) * np.NaN
-    viconQuats = np.zeros([10, np.shape(vicon)[0], 4]) * np.NaN
-    for t in range(np.shape(vicon)[0]):
-        for k in range(10):
-            viconPos[k, t, :] = vicon[t, k*7+4:(k+1)*7]
-            viconQuats[k, t, 0] = vicon[t, k*7+3]
-            viconQuats[k, t, 1:] = vicon[t, k*7:k*7+3]
+    viconPos, viconQuats = viconData.split_subjects(np.asarray(vicon, dtype=np.float64))
     np.save('data/viconPos.npy', viconPos)
     np.save('data/viconQuats.npy', viconQuats)
 